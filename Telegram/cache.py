@@ -0,0 +1,268 @@
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from cachetools import LRUCache
+
+from Telegram.metrics import Counter, Gauge
+
+CACHE_LOOKUPS = Counter("telearchive_cache_lookups_total", "Download cache lookups", ["result"])
+CACHE_EVICTIONS = Counter("telearchive_cache_evictions_total", "Files evicted from the disk cache")
+CACHE_BYTES = Gauge("telearchive_cache_bytes", "Bytes held by the download cache", ["tier"])
+
+
+def getsizeofelt(val):
+    try:
+        s = len(val)
+        return s
+    except:
+        return 1
+
+
+class TieredCache:
+    """
+    Two-tier file cache: a small in-process LRU for hot, small files in front
+    of a size-bounded directory on disk. The disk tier keeps its index in
+    SQLite next to the files so it survives restarts, and evicts the least
+    recently used files once the directory grows past ``disk_max_bytes``.
+    """
+
+    def __init__(self, cache_dir, disk_max_bytes, memory_max_bytes, memory_item_max_bytes):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.maxsize = disk_max_bytes
+        # An item larger than the whole memory tier would be refused by it.
+        self.memory_item_max_bytes = min(memory_item_max_bytes, memory_max_bytes)
+        self.memory = LRUCache(memory_max_bytes, getsizeof=getsizeofelt)
+        self.lock = threading.Lock()
+        # Room promised to writers still filling their temp files; it counts
+        # against disk_max_bytes like the files already in.
+        self.reserved = 0
+
+        self.conn = sqlite3.connect(str(self.dir / "index.db"), check_same_thread=False)
+        # Every lookup bumps last_used; with WAL that doesn't cost an fsync.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                size_bytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+        self._recover()
+
+    def _recover(self):
+        # Drop index rows whose file vanished and files the index never
+        # committed (e.g. a download that was cut off by a crash).
+        known = set()
+        for key, size in self.conn.execute("SELECT key, size_bytes FROM entries").fetchall():
+            path = self._path(key)
+            if path.exists() and path.stat().st_size == size:
+                known.add(path.name)
+            else:
+                self.conn.execute("DELETE FROM entries WHERE key=?", (key,))
+        for path in self.dir.iterdir():
+            if (path.name.endswith(".bin") and path.name not in known) or path.name.endswith(".part"):
+                path.unlink(missing_ok=True)
+        self.conn.commit()
+        self.currsize = self.conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM entries").fetchone()[0]
+        self._report_size()
+
+    def _report_size(self):
+        CACHE_BYTES.set(self.currsize, tier="disk")
+        CACHE_BYTES.set(self.memory.currsize, tier="memory")
+
+    def _path(self, key):
+        return self.dir / f"{key}.bin"
+
+    def __contains__(self, key):
+        key = str(key)
+        if key in self.memory:
+            return True
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM entries WHERE key=?", (key,)).fetchone()
+        return row is not None
+
+    def get(self, key):
+        """
+        Returns the cached bytes: a bytearray from the memory tier, or a
+        read-only mmap of the disk file. None on a miss.
+        """
+        key = str(key)
+        data = self.memory.get(key)
+        if data is not None:
+            CACHE_LOOKUPS.inc(result="memory_hit")
+            return data
+        path = self.path(key)
+        if path is None:
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+        CACHE_LOOKUPS.inc(result="disk_hit")
+        if len(data) <= self.memory_item_max_bytes:
+            small = bytearray(data)
+            data.close()
+            self.memory[key] = small
+            self._report_size()
+            return small
+        return data
+
+    def path(self, key):
+        """Returns the disk-tier path for ``key`` and marks it as recently used."""
+        key = str(key)
+        with self.lock:
+            cur = self.conn.execute(
+                "UPDATE entries SET last_used=? WHERE key=?",
+                (time.time(), key),
+            )
+            self.conn.commit()
+        if not cur.rowcount:
+            return None
+        return self._path(key)
+
+    def put(self, key, data):
+        with self.writer(key) as w:
+            w.write(data)
+        if len(data) <= self.memory_item_max_bytes:
+            self.memory[str(key)] = bytearray(data)
+            self._report_size()
+
+    def writer(self, key, size=None):
+        """
+        Returns a _CacheWriter for ``key``. With ``size``, room for that many
+        bytes is made before anything is written, so the temp file doesn't
+        take the directory past disk_max_bytes either; None is returned when
+        it can't fit next to the other writers.
+        """
+        if size is not None:
+            with self.lock:
+                if size > self.maxsize - self.reserved:
+                    return None
+                self.reserved += size
+                self._evict()
+                self.conn.commit()
+            self._report_size()
+        return _CacheWriter(self, str(key), size)
+
+    def adopt(self, key, path):
+        """
+        Makes the file at ``path`` the disk entry for ``key``. It is hard
+        linked when it lives on the same filesystem, so nothing is copied
+        and the caller can still remove ``path`` afterwards.
+        """
+        key = str(key)
+        tmp_path = self.dir / f"{key}.{uuid.uuid4().hex}.part"
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        self._commit(key, tmp_path, tmp_path.stat().st_size)
+
+    def pop(self, key, default=None):
+        key = str(key)
+        self.memory.pop(key, None)
+        with self.lock:
+            row = self.conn.execute("SELECT size_bytes FROM entries WHERE key=?", (key,)).fetchone()
+            if not row:
+                return default
+            self.conn.execute("DELETE FROM entries WHERE key=?", (key,))
+            self.conn.commit()
+            self.currsize -= row[0]
+            self._report_size()
+        self._path(key).unlink(missing_ok=True)
+        return key
+
+    def _release(self, reserved):
+        with self.lock:
+            self.reserved -= reserved
+
+    def _commit(self, key, tmp_path, size, reserved=0):
+        if size > self.maxsize:
+            tmp_path.unlink(missing_ok=True)
+            self._release(reserved)
+            return
+        with self.lock:
+            self.reserved -= reserved
+            old = self.conn.execute("SELECT size_bytes FROM entries WHERE key=?", (key,)).fetchone()
+            if old:
+                self.currsize -= old[0]
+            os.replace(tmp_path, self._path(key))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, size_bytes, last_used) VALUES (?, ?, ?)",
+                (key, size, time.time()),
+            )
+            self.currsize += size
+            self._evict()
+            self.conn.commit()
+        self.memory.pop(key, None)
+        self._report_size()
+
+    def _evict(self):
+        # Called with self.lock held. Files still open elsewhere (mmaps,
+        # responses being sent) stay readable after the unlink.
+        while self.currsize + self.reserved > self.maxsize:
+            row = self.conn.execute(
+                "SELECT key, size_bytes FROM entries ORDER BY last_used ASC LIMIT 1"
+            ).fetchone()
+            if not row:
+                break
+            self.conn.execute("DELETE FROM entries WHERE key=?", (row[0],))
+            self.currsize -= row[1]
+            self.memory.pop(row[0], None)
+            self._path(row[0]).unlink(missing_ok=True)
+            CACHE_EVICTIONS.inc()
+            print("CACHE EVICTED", row[0])
+
+
+class _CacheWriter:
+    """Writes a cache entry to a temp file; it only becomes visible on commit."""
+
+    def __init__(self, cache, key, reserved=None):
+        self.cache = cache
+        self.key = key
+        self.reserved = reserved
+        self.tmp_path = cache.dir / f"{key}.{uuid.uuid4().hex}.part"
+        self.file = open(self.tmp_path, "wb")
+        self.size = 0
+
+    def write(self, data):
+        if self.reserved is not None and self.size + len(data) > self.reserved:
+            raise OSError(f"Cache entry {self.key} is larger than the {self.reserved} bytes reserved for it")
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        # Makes what was written so far readable through other descriptors.
+        self.file.flush()
+
+    def commit(self):
+        self.file.close()
+        self.cache._commit(self.key, self.tmp_path, self.size, self.reserved or 0)
+
+    def abort(self):
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+        self.cache._release(self.reserved or 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,102 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Values stored in web_files.codec (NULL means none)
+CODEC_NONE = "none"
+CODEC_ZSTD = "zstd"
+CODEC_ZLIB = "zlib"
+
+# First bytes of a zstd frame; zlib streams are told apart by their header.
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+SAMPLE_BYTES = 256 * 1024
+# Skip compression unless the sample shrinks to at most this fraction;
+# media and archives barely move and would only cost CPU on both ends.
+MIN_SAVING_RATIO = 0.9
+
+
+def available_codec(setting):
+    """Maps the COMPRESSION setting to a codec this install can use."""
+    setting = (setting or CODEC_NONE).lower()
+    if setting == CODEC_ZSTD and zstandard is None:
+        print("COMPRESSION=zstd but the zstandard package is not installed; using zlib")
+        return CODEC_ZLIB
+    if setting in (CODEC_ZSTD, CODEC_ZLIB):
+        return setting
+    return CODEC_NONE
+
+
+def _compressobj(codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6)
+
+
+def choose_codec(codec, sample):
+    """Returns ``codec`` if compressing ``sample`` is worth it, else CODEC_NONE."""
+    if codec == CODEC_NONE or not sample:
+        return CODEC_NONE
+    c = _compressobj(codec)
+    packed = len(c.compress(sample)) + len(c.flush())
+    if packed > len(sample) * MIN_SAVING_RATIO:
+        return CODEC_NONE
+    return codec
+
+
+def detect_codec(sample):
+    """
+    Guesses the codec from the first bytes of a stored file, for files with
+    no record of how they were stored. A zlib header is only trusted if the
+    sample also decodes as zlib.
+    """
+    sample = bytes(sample)
+    if sample.startswith(ZSTD_MAGIC):
+        return CODEC_ZSTD
+    # CM 8 with a 32K window, no preset dictionary, and a valid check value
+    if len(sample) >= 2 and sample[0] == 0x78 and not sample[1] & 0x20 and (sample[0] << 8 | sample[1]) % 31 == 0:
+        try:
+            zlib.decompressobj().decompress(sample)
+            return CODEC_ZLIB
+        except zlib.error:
+            pass
+    return CODEC_NONE
+
+
+class CompressingReader:
+    """File-like wrapper whose ``read`` returns the compressed form of ``source``."""
+
+    def __init__(self, source, codec, read_size=1024 * 1024):
+        self.source = source
+        self.compressor = _compressobj(codec)
+        self.read_size = read_size
+        self.buf = bytearray()
+        self.done = False
+
+    def read(self, n=-1):
+        while not self.done and (n < 0 or len(self.buf) < n):
+            data = self.source.read(self.read_size)
+            if data:
+                self.buf += self.compressor.compress(data)
+            else:
+                self.buf += self.compressor.flush()
+                self.done = True
+        if n < 0 or n >= len(self.buf):
+            out, self.buf = bytes(self.buf), bytearray()
+            return out
+        with memoryview(self.buf) as view:
+            out = bytes(view[:n])
+        del self.buf[:n]
+        return out
+
+
+def decompressor(codec):
+    """Returns an object with ``decompress(chunk)`` for a streamed decode."""
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("This file is zstd-compressed; install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
@@ -0,0 +1,221 @@
+import base64
+import os
+import struct
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.hmac import HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Values stored in web_files.cipher
+CIPHER_NONE = "none"
+CIPHER_FERNET = "fernet" # legacy whole-file format, read-only
+CIPHER_AESGCM = "aesgcm1"
+
+# Stream layout: header, then frames of FRAME_SIZE plaintext bytes, each
+# encrypted on its own with AES-GCM and followed by its 16 byte tag. Every
+# frame sits at a fixed offset, so any byte range can be decrypted without
+# reading what comes before it.
+MAGIC = b"TGAE"
+VERSION = 1
+FRAME_SIZE = 64 * 1024
+TAG_SIZE = 16
+_HEADER = struct.Struct(">4sBI16s") # magic, version, frame size, per-file salt
+HEADER_SIZE = _HEADER.size
+
+
+def derive_key(encryption_key, salt):
+    # ENCRYPTION_KEY is a Fernet key; every file gets its own AES key from it.
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=b"telearchive frames v1",
+    ).derive(base64.urlsafe_b64decode(encryption_key))
+
+
+def frame_count(plain_size):
+    # An empty file still gets one (empty) final frame so truncation is detectable.
+    return max(1, -(-plain_size // FRAME_SIZE))
+
+
+def encrypted_size(plain_size):
+    return HEADER_SIZE + plain_size + frame_count(plain_size) * TAG_SIZE
+
+
+def plain_size(encrypted_size):
+    frames = -(-(encrypted_size - HEADER_SIZE) // (FRAME_SIZE + TAG_SIZE))
+    return encrypted_size - HEADER_SIZE - frames * TAG_SIZE
+
+
+def frame_offset(index):
+    return HEADER_SIZE + index * (FRAME_SIZE + TAG_SIZE)
+
+
+def _nonce(index):
+    return index.to_bytes(12, "big")
+
+
+def _aad(header, final):
+    return header + (b"\x01" if final else b"\x00")
+
+
+def parse_header(header):
+    magic, version, frame_size, salt = _HEADER.unpack(bytes(header[:HEADER_SIZE]))
+    if magic != MAGIC:
+        raise ValueError("Not a TeleArchive encrypted stream")
+    if version != VERSION or frame_size != FRAME_SIZE:
+        raise ValueError(f"Unsupported encrypted stream (version {version}, frame size {frame_size})")
+    return salt
+
+
+class EncryptingReader:
+    """
+    File-like wrapper that yields the encrypted form of ``source`` from
+    ``read``. Frames are encrypted as they are needed, with one frame of
+    read-ahead to know which frame is the final one.
+    """
+
+    def __init__(self, source, encryption_key):
+        self.source = source
+        salt = os.urandom(16)
+        self.header = _HEADER.pack(MAGIC, VERSION, FRAME_SIZE, salt)
+        self.aead = AESGCM(derive_key(encryption_key, salt))
+        self.buf = bytearray(self.header)
+        self.index = 0
+        self.next_frame = source.read(FRAME_SIZE)
+        self.done = False
+
+    def _encrypt_next(self):
+        frame = self.next_frame
+        self.next_frame = self.source.read(FRAME_SIZE) if len(frame) == FRAME_SIZE else b""
+        final = not self.next_frame
+        self.buf += self.aead.encrypt(_nonce(self.index), frame, _aad(self.header, final))
+        self.index += 1
+        self.done = final
+
+    def read(self, n=-1):
+        while not self.done and (n < 0 or len(self.buf) < n):
+            self._encrypt_next()
+        if n < 0 or n >= len(self.buf):
+            out, self.buf = bytes(self.buf), bytearray()
+            return out
+        return _take(self.buf, n)
+
+
+def _take(buf, n):
+    """Removes and returns the first ``n`` bytes of bytearray ``buf``, copying them once."""
+    with memoryview(buf) as view:
+        out = bytes(view[:n])
+    del buf[:n]
+    return out
+
+
+class FrameDecryptor:
+    """
+    Decrypts the frames ``first`` up to (not including) ``stop``. ``last``
+    is the index of the file's final frame, which is authenticated as such.
+    """
+
+    def __init__(self, encryption_key, header, first, stop, last):
+        self.header = bytes(header[:HEADER_SIZE])
+        self.aead = AESGCM(derive_key(encryption_key, parse_header(self.header)))
+        self.index = first
+        self.stop = stop
+        self.last = last
+        self.buf = bytearray()
+
+    def feed(self, data):
+        # Whole frames are decrypted straight out of ``data``; only a frame
+        # split across two chunks is put together in ``buf``.
+        out = []
+        step = FRAME_SIZE + TAG_SIZE
+        view = memoryview(data)
+        if self.buf:
+            need = step - len(self.buf)
+            self.buf += view[:need]
+            view = view[need:]
+            if len(self.buf) < step:
+                return out
+            out.append(self._decrypt(self.buf))
+            self.buf = bytearray()
+        while len(view) >= step:
+            out.append(self._decrypt(view[:step]))
+            view = view[step:]
+        self.buf += view
+        return out
+
+    def finish(self):
+        # The final frame may be shorter than a full one; whatever is left
+        # once the stream ends is that frame.
+        out = []
+        if self.buf:
+            out.append(self._decrypt(self.buf))
+            self.buf = bytearray()
+        if self.index != self.stop:
+            raise ValueError("Encrypted stream ended early")
+        return out
+
+    def _decrypt(self, frame):
+        plain = self.aead.decrypt(_nonce(self.index), frame, _aad(self.header, self.index == self.last))
+        self.index += 1
+        return plain
+
+
+class FernetDecryptor:
+    """
+    Decrypts a legacy whole-file Fernet token as it arrives, so the token
+    never has to be held in memory. Plaintext comes out before the token's
+    HMAC is checked by ``finalize``; whatever was produced must be thrown
+    away if that raises InvalidToken.
+    """
+
+    def __init__(self, encryption_key):
+        key = base64.urlsafe_b64decode(encryption_key)
+        self.encryption_key = key[16:]
+        self.hmac = HMAC(key[:16], hashes.SHA256())
+        self.unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        self.decryptor = None
+        self.encoded = bytearray()  # base64 not yet decoded, less than a 4 character group
+        self.head = bytearray()     # version, timestamp and IV, until all have arrived
+        self.tail = b""             # the last 32 bytes seen, which may be the HMAC
+
+    def update(self, data):
+        self.encoded += data
+        usable = len(self.encoded) - len(self.encoded) % 4
+        if not usable:
+            return b""
+        try:
+            decoded = base64.urlsafe_b64decode(_take(self.encoded, usable))
+        except ValueError:
+            raise InvalidToken
+        decoded, self.tail = self.tail + decoded, b""
+        if len(decoded) > 32:
+            decoded, self.tail = decoded[:-32], decoded[-32:]
+        else:
+            decoded, self.tail = b"", decoded
+        self.hmac.update(decoded)
+        if self.decryptor is None:
+            self.head += decoded
+            if len(self.head) < 25:
+                return b""
+            if self.head[0] != 0x80:
+                raise InvalidToken
+            self.decryptor = Cipher(algorithms.AES(self.encryption_key), modes.CBC(bytes(self.head[9:25]))).decryptor()
+            decoded, self.head = bytes(self.head[25:]), None
+        return self.unpadder.update(self.decryptor.update(decoded))
+
+    def finalize(self):
+        if self.encoded or self.decryptor is None:
+            raise InvalidToken
+        try:
+            self.hmac.verify(self.tail)
+        except InvalidSignature:
+            raise InvalidToken
+        try:
+            return self.unpadder.update(self.decryptor.finalize()) + self.unpadder.finalize()
+        except ValueError:
+            raise InvalidToken
@@ -1,61 +1,442 @@
-import logging
 import asyncio
+import concurrent.futures
+import json
 import threading
-logging.basicConfig(filename='example.log', encoding='utf-8', level=logging.DEBUG)
-from telethon import TelegramClient
+from telethon import TelegramClient, helpers, utils
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputFile, InputFileBig, InputPeerChannel
 from dotenv import load_dotenv
 import os
 from io import BytesIO
-from cryptography.fernet import Fernet
-from collections import defaultdict
+from collections import defaultdict, deque
 from cachetools import LRUCache
-import gc
+import itertools
+import hashlib
+import time
 from telethon.sessions import StringSession
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError, FloodWaitError
+
+from Telegram.cache import TieredCache
+from Telegram.compression import (
+    CODEC_NONE, SAMPLE_BYTES, CompressingReader, available_codec, choose_codec, decompressor, detect_codec,
+)
+from Telegram.metrics import FLOOD_WAITS, RPC_SECONDS, THROUGHPUT_BUCKETS, Counter, Histogram
+from Telegram.crypto import (
+    CIPHER_AESGCM, CIPHER_FERNET, CIPHER_NONE, FRAME_SIZE, HEADER_SIZE, MAGIC,
+    EncryptingReader, FernetDecryptor, FrameDecryptor, encrypted_size, frame_count, frame_offset, plain_size,
+)
+from Telegram.transfer import (
+    ChannelMessage, CdnRedirectError, SenderPool, document_from_message, document_location, iter_blocks,
+)
 
 load_dotenv()
 
 FILE_MAX_SIZE_BYTES = int(2 * 1e9) # 2GB
+UPLOAD_PART_SIZE = 512 * 1024 # largest part telegram accepts
+SMALL_FILE_MAX_BYTES = 10 * 1024 * 1024 # above this telegram wants saveBigFilePart
+CHUNK_MAX_PARTS = FILE_MAX_SIZE_BYTES // UPLOAD_PART_SIZE # parts per _partN message
+DOWNLOAD_CHUNK_SIZE = 512 * 1024 # largest upload.getFile request
 
-# Real LRU cache implementation very cool
-CACHE_MAXSIZE = 5e9 # 5GB
-def getsizeofelt(val):
-    try:
-        s = len(val)
-        return s
-    except:
-        return 1
+# Disk cache with a small in-memory tier in front of it
+CACHE_DIR = os.getenv("CACHE_DIR", "telegram_cache")
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAX_BYTES", str(int(5e9)))) # 5GB on disk
+CACHE_MEMORY_MAXSIZE = int(os.getenv("CACHE_MEMORY_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_MEMORY_ITEM_MAXSIZE = 8 * 1024 * 1024 # only small files are kept on the heap
+
+# Parallel transfers: extra connections per DC, and block requests kept in flight per download
+TRANSFER_CONNECTIONS = int(os.getenv("TRANSFER_CONNECTIONS", "4"))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+
+# Compress compressible uploads before encrypting them: zstd, zlib or none
+COMPRESSION = os.getenv("COMPRESSION", "none")
+
+# Document locations kept in memory, and how get_messages calls for unknown
+# or expired ones are batched: ids asked for within REFRESH_BATCH_SECONDS of
+# each other share calls of up to GET_MESSAGES_BATCH ids.
+DOCUMENT_CACHE_SIZE = 65536
+GET_MESSAGES_BATCH = 100
+REFRESH_BATCH_SECONDS = 0.02
+FILE_REFERENCE_ERRORS = (FileReferenceExpiredError, FileReferenceInvalidError)
+# Calls that need Telegram wait this long for the connection before giving up.
+READY_TIMEOUT_SECONDS = 30
+CONNECT_RETRY_MAX_SECONDS = 60
+# With more than one account, _partN messages are kept this small, so a file
+# is spread over the accounts and a download can read from all of them.
+SHARD_CHUNK_BYTES = int(os.getenv("SHARD_CHUNK_BYTES", str(64 * 1024 * 1024)))
+# What a download of a file spread over several accounts may fetch ahead of
+# what it has passed on, shared by the parts being read ahead.
+DOWNLOAD_READAHEAD_BYTES = int(os.getenv("DOWNLOAD_READAHEAD_BYTES", str(64 * 1024 * 1024)))
+# Memory a download shared by several requests keeps for the slower ones
+# when the file doesn't fit in the cache (see _Flight).
+FLIGHT_BUFFER_BYTES = int(os.getenv("FLIGHT_BUFFER_BYTES", str(16 * 1024 * 1024)))
+# How long such a fetch waits for a reader that holds it back (a paused
+# browser download, say) before leaving it to fetch the file on its own.
+FLIGHT_STALL_SECONDS = 5
+# The last _partN message of a file is captioned with what it takes to list
+# the file again from the channel alone (see file_caption).
+CAPTION_PREFIX = "telearchive:"
+# Every other _partN message says there is more to come, so a file whose
+# upload stopped (or hasn't finished) can't pass for a complete one.
+PART_CAPTION = CAPTION_PREFIX + "part"
+# Fernet tokens are base64 of a 0x80 version byte and a 64-bit timestamp.
+FERNET_PREFIX = b"gAAAAA"
+# Messages per channel_messages call; Telethon fetches them 100 at a time.
+SCAN_BATCH = 1000
+
+UPLOAD_BYTES = Counter("telearchive_upload_bytes_total", "Bytes sent to Telegram, after compression and encryption")
+DOWNLOAD_BYTES = Counter("telearchive_download_bytes_total", "Bytes received from Telegram")
+UPLOAD_THROUGHPUT = Histogram(
+    "telearchive_upload_throughput_bytes_per_second",
+    "Throughput of completed uploads, in bytes of the original file",
+    buckets=THROUGHPUT_BUCKETS,
+)
+DOWNLOAD_THROUGHPUT = Histogram(
+    "telearchive_download_throughput_bytes_per_second",
+    "Throughput of completed reads from Telegram",
+    buckets=THROUGHPUT_BUCKETS,
+)
+DOWNLOAD_FLIGHTS = Counter(
+    "telearchive_download_flights_total",
+    "Requests for a whole file from Telegram, by whether they started a fetch or joined one already running, and readers a fetch dropped for lagging",
+    ["result"],
+)
+
+def _stream_size(stream):
+    """Bytes left in ``stream``, or None for streams that can't tell (still being written)."""
+    if not stream.seekable():
+        return None
+    pos = stream.tell()
+    end = stream.seek(0, os.SEEK_END)
+    stream.seek(pos)
+    return end - pos
+
+class _CountingReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        self.count += len(data)
+        return data
+
+class _PartReader:
+    """
+    Cuts a stream into UPLOAD_PART_SIZE parts. When the stream's size is
+    known, ``available`` answers from it; when it isn't (compressed uploads),
+    parts are read ahead as far as needed to tell how many are left.
+    """
+
+    def __init__(self, stream, size=None):
+        self.stream = stream
+        self.size = size
+        self.ahead = deque()
+        self.eof = False
+
+    def _read(self):
+        part = self.stream.read(UPLOAD_PART_SIZE)
+        if part and len(part) < UPLOAD_PART_SIZE:
+            # Short reads (a request body still arriving) are joined once
+            # rather than grown piece by piece.
+            pieces, size = [part], len(part)
+            while size < UPLOAD_PART_SIZE:
+                more = self.stream.read(UPLOAD_PART_SIZE - size)
+                if not more:
+                    break
+                pieces.append(more)
+                size += len(more)
+            part = b"".join(pieces)
+        if len(part) < UPLOAD_PART_SIZE:
+            self.eof = True
+        return part
+
+    def available(self, n):
+        """Number of parts left, counting no further than ``n``."""
+        if self.size is not None:
+            return min(n, -(-self.size // UPLOAD_PART_SIZE))
+        while len(self.ahead) < n and not self.eof:
+            part = self._read()
+            if part:
+                self.ahead.append(part)
+        return min(n, len(self.ahead))
+
+    def next(self):
+        if self.ahead:
+            return self.ahead.popleft()
+        part = b"" if self.eof else self._read()
+        if self.size is not None:
+            if len(part) != min(UPLOAD_PART_SIZE, self.size):
+                raise ValueError("Stream ended early while uploading")
+            self.size -= len(part)
+        return part
+
+class _Flight:
+    """
+    A fetch of a whole file from Telegram, shared by every request for the
+    file while it runs. A file the cache can hold is written through a
+    cache writer, and readers follow its temp file as it grows through a
+    descriptor of their own, which stays valid after the file is renamed
+    into the cache or dropped. Otherwise only FLIGHT_BUFFER_BYTES of it are
+    kept in memory: the fetch waits FLIGHT_STALL_SECONDS at most for the
+    slowest reader to get through them, then lets go of the readers still
+    that far behind. Those, and requests that come after the bytes they
+    need were let go of, start a fetch of their own.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.fd = os.open(writer.tmp_path, os.O_RDONLY) if writer is not None else None
+        # Offset of buffer[0] in the file, and where each reader reads next.
+        self.buffer = bytearray()
+        self.buffer_start = 0
+        self.positions = {}
+        self.users = 0
+        self.progress_cbs = []
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def join(self, start, progress_cb=None):
+        """
+        Adds a reader from ``start`` on and returns the handle it reads
+        through, or None if those bytes were already let go of. A reader
+        with ``start`` None only waits for the fetch to end.
+        """
+        with self.cond:
+            if self.fd is None and start is not None and start < self.buffer_start:
+                return None
+            self.users += 1
+            if progress_cb is not None:
+                self.progress_cbs.append(progress_cb)
+            if self.fd is not None:
+                return os.dup(self.fd)
+            handle = object()
+            if start is not None:
+                self.positions[handle] = start
+            return handle
+
+    def leave(self, handle, progress_cb=None):
+        if self.writer is not None:
+            os.close(handle)
+        with self.cond:
+            self.users -= 1
+            self.positions.pop(handle, None)
+            if progress_cb in self.progress_cbs:
+                self.progress_cbs.remove(progress_cb)
+            self.cond.notify_all()
+
+    def write(self, chunk):
+        if self.writer is not None:
+            self.writer.write(chunk)
+            self.writer.flush()
+        with self.cond:
+            if self.writer is None:
+                self._trim(len(chunk))
+                deadline = time.monotonic() + FLIGHT_STALL_SECONDS
+                while self.users and self.buffer and len(self.buffer) + len(chunk) > FLIGHT_BUFFER_BYTES:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._drop_laggards(len(chunk))
+                        break
+                    self.cond.wait(remaining)
+                    self._trim(len(chunk))
+                self.buffer += chunk
+            self.size += len(chunk)
+            self.cond.notify_all()
+
+    def _trim(self, incoming):
+        # Called with self.cond held: makes room for ``incoming`` bytes by
+        # dropping the oldest ones, as far as every reader is past them.
+        over = len(self.buffer) + incoming - FLIGHT_BUFFER_BYTES
+        keep = min(self.buffer_start + over, min(self.positions.values(), default=self.size), self.size)
+        if keep > self.buffer_start:
+            del self.buffer[:keep - self.buffer_start]
+            self.buffer_start = keep
+
+    def _drop_laggards(self, incoming):
+        # Called with self.cond held: the readers keeping the buffer from
+        # making room for ``incoming`` bytes are let go of, see read.
+        keep = min(self.buffer_start + len(self.buffer) + incoming - FLIGHT_BUFFER_BYTES, self.size)
+        for handle, pos in list(self.positions.items()):
+            if pos < keep:
+                del self.positions[handle]
+                DOWNLOAD_FLIGHTS.inc(result="dropped")
+        self._trim(incoming)
+
+    def read(self, handle, pos, size):
+        """
+        Up to ``size`` bytes from ``pos``, or None if the reader fell too
+        far behind and has to fetch the rest on its own.
+        """
+        if self.writer is not None:
+            return os.pread(handle, size, pos)
+        with self.cond:
+            if handle not in self.positions:
+                return None
+            offset = pos - self.buffer_start
+            chunk = bytes(self.buffer[offset:offset + size])
+            self.positions[handle] = pos + len(chunk)
+            self.cond.notify_all()
+        return chunk
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def abandoned(self):
+        # With nobody left waiting, a fetch the cache won't keep is stopped.
+        with self.cond:
+            return not self.users and self.writer is None
+
+    def progress(self, done_bytes, total_bytes):
+        for cb in list(self.progress_cbs):
+            cb(done_bytes, total_bytes)
+
+    def wait_for(self, size=None):
+        """
+        Blocks until ``size`` bytes came in, or the whole file when None;
+        returns the size so far. Raises the fetch's error if it failed first.
+        """
+        with self.cond:
+            while not self.done and (size is None or self.size < size):
+                self.cond.wait()
+            if self.error is not None and (size is None or self.size < size):
+                raise self.error
+            return self.size
 
 def default_progress_cb(sent_bytes, total):
+    if not total:
+        return
     percentTotal = int(sent_bytes/total * 100)
     if percentTotal % 5 == 0:
         print(f"Progress: {percentTotal}%...")
 
+def file_caption(parts, size, cipher, codec):
+    """Caption for a file's last _partN message: how many there are, and how to read them back."""
+    info = {"parts": parts, "size": size, "cipher": cipher, "codec": codec}
+    return CAPTION_PREFIX + json.dumps(info, separators=(",", ":"))
+
+def parse_file_caption(caption):
+    """The dict file_caption() was given, or None for any other caption."""
+    if not caption or not caption.startswith(CAPTION_PREFIX):
+        return None
+    try:
+        info = json.loads(caption[len(CAPTION_PREFIX):])
+    except ValueError:
+        return None
+    if not isinstance(info, dict) or not isinstance(info.get("parts"), int) or not isinstance(info.get("size"), int):
+        return None
+    return info
+
+def _as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _part_refs(msgIds, shards=None):
+    """(shard, msg_id) of each _partN message; files without shards are all on the first account."""
+    return list(zip(shards or [0] * len(msgIds), msgIds))
+
+
+class TelegramNotReady(ConnectionError):
+    """Telegram is still connecting (or can't be reached) in the background."""
+
+
+class _Shard:
+    """One account and the channel it sends _partN messages to."""
+
+    def __init__(self, index, client, channel_link, session_string=None):
+        self.index = index
+        self.client = client
+        self.channel_link = channel_link
+        # The saved channel's access hash is only valid for this account.
+        self.session_key = hashlib.sha256((session_string or "").encode("utf-8")).hexdigest()[:16]
+        self.channel_entity = None
+        self.pools = {}
+        # Bytes of upload parts queued or in flight, _partN messages sent so
+        # far, and when the last FloodWait on this account ends.
+        self.load = 0
+        self.chunks = 0
+        self.flood_until = 0
+
+
 class TelegramFileClient():
-    def __init__(self, session_name, api_id, api_hash, channel_link):
+    def __init__(self, session_name, api_id, api_hash, channel_link, client=None, pool_factory=SenderPool, store=None):
+        # ``session_name`` and ``channel_link`` may be lists, one entry per
+        # account; a single channel is shared by all accounts. Uploads are
+        # spread over the accounts, so their rate limits add up. The order
+        # must stay the same across restarts: files record parts by index.
+        # ``client`` (one or a list) and ``pool_factory`` stand in for the
+        # Telethon clients and SenderPool, e.g. with the fake backend in
+        # bench/. ``store`` (e.g. WebStore) keeps the resolved channels and
+        # document locations across restarts.
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
         self._thread = threading.Thread(target=self._run_loop, daemon=True)
         self._thread.start()
 
-        session_string = os.getenv("SESSION_STRING")
-        self.client = TelegramClient(
-            StringSession(session_string),
-            api_id,
-            api_hash,
-            loop=self.loop
-        )
-        # Make sure Telethon uses our loop even in newer versions.
-        try:
-            self.client._loop = self.loop
-        except Exception:
-            pass
+        clients = _as_list(client)
+        sessions = _as_list(session_name)
+        if not clients:
+            sessions = sessions or [os.getenv("SESSION_STRING")]
+            clients = [
+                TelegramClient(StringSession(session_string), api_id, api_hash, loop=self.loop)
+                for session_string in sessions
+            ]
+        links = _as_list(channel_link)
+        if len(links) not in (1, len(clients)):
+            raise ValueError(f"{len(clients)} Telegram sessions but {len(links)} channel links")
+        self.shards = [
+            _Shard(i, c, links[i] if len(links) > 1 else links[0], sessions[i] if i < len(sessions) else None)
+            for i, c in enumerate(clients)
+        ]
+        self.client = self.shards[0].client
+        self.pool_factory = pool_factory
+        for shard in self.shards:
+            # Make sure Telethon uses our loop even in newer versions.
+            try:
+                shard.client._loop = self.loop
+            except Exception:
+                pass
+        self.chunk_parts = CHUNK_MAX_PARTS
+        if len(self.shards) > 1:
+            # Never below the small-file limit: a chunk is one Telegram file.
+            small_parts = SMALL_FILE_MAX_BYTES // UPLOAD_PART_SIZE
+            self.chunk_parts = min(CHUNK_MAX_PARTS, max(small_parts + 1, SHARD_CHUNK_BYTES // UPLOAD_PART_SIZE))
+        self._load_lock = threading.Lock()
+        # (shard, msg_id) of every _partN message this process sent; see sent_messages.
+        self._sent = set()
+        self._sent_lock = threading.Lock()
 
-        self._run(self.client.start())
-        self.channel_entity = self._run(self.client.get_entity(channel_link))
+        # Connecting happens in the background so the caller can start serving
+        # what doesn't need Telegram; calls that do wait for ``ready``.
+        self.store = store
+        self.connect_error = None
+        self.ready = asyncio.run_coroutine_threadsafe(self._connect(), self.loop)
         # key to use for encryption, if not set, not encrypted.
         self.encryption_key = os.getenv("ENCRYPTION_KEY")
-        self.cached_files = LRUCache(CACHE_MAXSIZE, getsizeof=getsizeofelt)
+        # what new uploads are stored as; callers record it next to the file
+        self.upload_cipher = CIPHER_AESGCM if self.encryption_key != None else CIPHER_NONE
+        self.compression = available_codec(COMPRESSION)
+        self.cached_files = TieredCache(CACHE_DIR, CACHE_MAXSIZE, CACHE_MEMORY_MAXSIZE, CACHE_MEMORY_ITEM_MAXSIZE)
         self.fname_to_msgs = defaultdict(tuple)
+        self._headers = LRUCache(4096)
+        self._headers_lock = threading.Lock()
+        # (shard, msg_id) -> TelegramDocument. ``document_store`` (get_documents /
+        # save_documents, e.g. WebStore) keeps them across restarts.
+        self.document_store = store
+        self._documents = LRUCache(DOCUMENT_CACHE_SIZE)
+        self._documents_lock = threading.Lock()
+        self._refresh_pending = {}
+        self._refresh_task = None
+        # fh -> _Flight of the whole-file fetches running now
+        self._flights = {}
+        self._flights_lock = threading.Lock()
 
         print("USING ENCRYPTION: ", self.encryption_key != None)
 
@@ -64,131 +445,844 @@ class TelegramFileClient():
         self.loop.run_forever()
 
     def _run(self, coro):
+        try:
+            self.wait_ready()
+        except TelegramNotReady:
+            coro.close()
+            raise
         future = asyncio.run_coroutine_threadsafe(coro, self.loop)
         return future.result()
 
-    def upload_file(self, bytesio, fh, file_name=None, progress_cb=None):
-        # invalidate cache as soon as we upload file
-        if fh in self.cached_files:
-            self.cached_files.pop(fh)
-            print("CLEANED UP ", gc.collect())
+    async def _connect(self):
+        await asyncio.gather(*(self._connect_shard(shard) for shard in self.shards))
+        self.connect_error = None
+        print("CONNECTED TO TELEGRAM")
+
+    async def _connect_shard(self, shard):
+        delay = 1
+        while True:
+            try:
+                await shard.client.start()
+                shard.channel_entity = await self._resolve_channel(shard)
+                return
+            except Exception as exc:
+                self.connect_error = exc
+                print(f"TELEGRAM CONNECT FAILED (account {shard.index}), retrying in {delay}s: {exc}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, CONNECT_RETRY_MAX_SECONDS)
 
-        # file_bytes is bytesio obj
-        file_bytes = bytesio.read()
+    async def _resolve_channel(self, shard):
+        # Resolving a link costs a round trip (a flood-limited one for
+        # usernames), so the channel it names is kept in the store.
+        key = "channel_entity" if shard.index == 0 else f"channel_entity:{shard.index}"
+        if self.store is not None:
+            saved = await self.loop.run_in_executor(None, self.store.get_config, key)
+            if saved:
+                saved = json.loads(saved)
+                if saved["link"] == shard.channel_link and saved.get("session") == shard.session_key:
+                    return InputPeerChannel(saved["channel_id"], saved["access_hash"])
+        peer = utils.get_input_peer(await shard.client.get_entity(shard.channel_link))
+        if self.store is not None and isinstance(peer, InputPeerChannel):
+            saved = json.dumps({
+                "link": shard.channel_link,
+                "session": shard.session_key,
+                "channel_id": peer.channel_id,
+                "access_hash": peer.access_hash,
+            })
+            await self.loop.run_in_executor(None, self.store.set_config, key, saved)
+        return peer
 
+    def _shard(self, index):
+        if index >= len(self.shards):
+            raise RuntimeError(
+                f"This file was stored with Telegram account {index + 1}, but only {len(self.shards)} are configured"
+            )
+        return self.shards[index]
+
+    def _pick_shard(self):
+        """
+        The account for the next _partN message: one not waiting out a
+        FloodWait, then the one with the fewest upload bytes in flight, then
+        the one that was sent the fewest messages.
+        """
+        now = time.time()
+        with self._load_lock:
+            shard = min(self.shards, key=lambda s: (s.flood_until > now, s.load, s.chunks, s.index))
+            shard.chunks += 1
+        return shard
+
+    def _add_load(self, shard, nbytes):
+        with self._load_lock:
+            shard.load += nbytes
+
+    def is_ready(self):
+        return self.ready.done()
+
+    def wait_ready(self, timeout=READY_TIMEOUT_SECONDS):
+        """Blocks until Telegram is connected; raises TelegramNotReady after ``timeout`` seconds."""
+        try:
+            self.ready.result(timeout)
+        except concurrent.futures.TimeoutError:
+            error = self.connect_error or "still connecting"
+            raise TelegramNotReady(f"Telegram is not connected: {error}") from None
+
+    def probe_codec(self, stream):
+        """
+        Picks the compression for an upload of ``stream`` (which must be
+        seekable) by trying it on the first few hundred KB.
+        """
+        if self.compression == CODEC_NONE:
+            return CODEC_NONE
+        pos = stream.tell()
+        sample = stream.read(SAMPLE_BYTES)
+        stream.seek(pos)
+        return choose_codec(self.compression, sample)
+
+    def upload_file(self, stream, file_name=None, progress_cb=None, file_size=None, codec=CODEC_NONE):
+        self.wait_ready()
+        if isinstance(stream, (bytes, bytearray)):
+            stream = BytesIO(stream)
+
+        if file_size is None:
+            file_size = _stream_size(stream)
+        if file_size == 0:
+            raise ValueError(f"Cannot upload empty file {file_name}")
+
+        # Progress is measured on the bytes read from the caller's stream,
+        # since compression leaves the size of what gets sent unknown.
+        source = _CountingReader(stream)
+        stream, stored_size = source, file_size
+        if codec != CODEC_NONE:
+            print("COMPRESSING", codec)
+            stream, stored_size = CompressingReader(stream, codec), None
         if self.encryption_key != None:
             print("ENCRYPTING")
-            f = Fernet(bytes(self.encryption_key, 'utf-8'))
-            file_bytes = f.encrypt(file_bytes)
-
-        chunks = []
-        file_len = len(file_bytes)
-
-        if isinstance(file_len, float):
-            print("UH OH FILEBYTES LENGTH IS FLOAT", file_len)
-        if isinstance(FILE_MAX_SIZE_BYTES, float):
-            print("UH OH FILE_MAX_SIZE_BYTES IS FLOAT", FILE_MAX_SIZE_BYTES)
-
-        if file_len > FILE_MAX_SIZE_BYTES:
-            # Calculate the number of chunks needed
-            num_chunks = (len(file_bytes) + FILE_MAX_SIZE_BYTES) // FILE_MAX_SIZE_BYTES
-            
-            if isinstance(num_chunks, float):
-                print("UH OH num_chunks IS FLOAT", num_chunks)
-
-            # Split the file into chunks
-            for i in range(num_chunks):
-                start = i * FILE_MAX_SIZE_BYTES
-                end = (i + 1) * FILE_MAX_SIZE_BYTES
-                chunk = file_bytes[start:end]
-                chunks.append(chunk)
-        else:
-            # File is within the size limit, no need to split
-            chunks = [file_bytes]
+            stream = EncryptingReader(stream, self.encryption_key)
+            stored_size = None if stored_size is None else encrypted_size(stored_size)
+        parts = _PartReader(stream, stored_size)
+        if file_size is None and not (parts.available(1) and source.count):
+            raise ValueError(f"Cannot upload empty file {file_name}")
 
-        upload_results = []
+        cb = progress_cb or default_progress_cb
+        reported = 0
+        started = time.perf_counter()
 
-        fname=file_name
+        def on_part(consumed):
+            nonlocal reported
+            # parts finish out of order; never let the bar move backwards
+            reported = max(reported, consumed if file_size is None else min(consumed, file_size))
+            cb(reported, file_size)
 
-        i = 0
+        # Parts of consecutive _partN chunks share one window of in-flight
+        # requests, so the next chunk starts uploading while the previous
+        # one is still finishing, and memory stays at window * part size.
+        window = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+        failed = []
+        chunk_futures = []
         try:
-            for c in chunks:
+            for i in itertools.count():
                 fname = f"{file_name}_part{i}.txt" # convert everything to text. tgram is weird about some formats
-                cb = progress_cb or default_progress_cb
-                f = self._run(self.client.upload_file(c, file_name=fname, part_size_kb=512, progress_callback=cb))
-                result = self._run(self.client.send_file(self.channel_entity, f))
-                upload_results.append(result)
-                i += 1
+                describe = lambda n=i + 1: file_caption(n, source.count, self.upload_cipher, codec)
+                chunk_futures.append(self._upload_chunk(parts, source, fname, window, failed, on_part, describe))
+                if failed or not parts.available(1):
+                    break
+            documents = [f.result() for f in chunk_futures]
         except Exception:
             # Cleanup any partially uploaded messages
-            try:
-                ids = [m.id for m in upload_results]
-                if ids:
-                    self.delete_messages(ids)
-            finally:
-                if fh in self.cached_files:
-                    self.cached_files.pop(fh, None)
+            failed.append(True)
+            sent = []
+            for f in chunk_futures:
+                try:
+                    sent.append(f.result())
+                except Exception:
+                    pass
+            if sent:
+                self.delete_messages([d.msg_id for d in sent], [d.shard for d in sent])
             raise
 
-        self.fname_to_msgs[file_name] = tuple([m.id for m in upload_results])
-        print(f"CACHED FILE! NEW SIZE: {self.cached_files.currsize}; maxsize: {self.cached_files.maxsize}")
-        return upload_results
+        elapsed = time.perf_counter() - started
+        RPC_SECONDS.observe(elapsed, method="upload_file")
+        UPLOAD_THROUGHPUT.observe(source.count / max(elapsed, 1e-6))
+        self.fname_to_msgs[file_name] = tuple(d.msg_id for d in documents)
+        self._remember_documents(documents, persist=True)
+        return documents
+
+    def _upload_chunk(self, parts, source, file_name, window, failed, on_part, describe):
+        """
+        Uploads the next ``chunk_parts`` parts (or what is left) of ``parts``
+        as a single Telegram file, so memory use does not depend on the size
+        of the file. Parts are handed to the event loop as soon as they are
+        read, up to ``window`` at once; the returned future resolves to the
+        sent message's TelegramDocument once every part has been saved. If
+        it turns out to be the file's last chunk, it is captioned with
+        ``describe()``, otherwise with PART_CAPTION.
+        """
+        shard = self._pick_shard()
+        chunk_parts = self.chunk_parts
+        file_id = helpers.generate_random_long()
+        small_parts = SMALL_FILE_MAX_BYTES // UPLOAD_PART_SIZE
+        is_big = parts.available(small_parts + 1) > small_parts
+        if not is_big:
+            part_count = parts.available(small_parts)
+        elif parts.size is not None:
+            part_count = parts.available(chunk_parts)
+        else:
+            part_count = None # found out when the stream runs dry
+        hash_md5 = hashlib.md5()
+        part_futures = []
+        complete = False
+
+        def part_done(future, consumed, nbytes):
+            window.release()
+            self._add_load(shard, -nbytes)
+            if future.cancelled() or future.exception() is not None:
+                failed.append(future)
+            else:
+                on_part(consumed)
+
+        try:
+            for part_index in range(chunk_parts):
+                part = parts.next()
+                if part_count is not None:
+                    last = part_index == part_count - 1
+                else:
+                    last = part_index == chunk_parts - 1 or not parts.available(1)
+
+                if is_big:
+                    # A big file of unknown size reports -1 parts until its last one.
+                    total = part_count or (part_index + 1 if last else -1)
+                    request = SaveBigFilePartRequest(file_id, part_index, total, part)
+                else:
+                    hash_md5.update(part)
+                    request = SaveFilePartRequest(file_id, part_index, part)
+
+                window.acquire()
+                if failed:
+                    window.release()
+                    break
+                self._add_load(shard, len(part))
+                future = asyncio.run_coroutine_threadsafe(self._save_part(shard, request, file_name), self.loop)
+                future.add_done_callback(lambda f, n=source.count, b=len(part): part_done(f, n, b))
+                part_futures.append(future)
+                if last:
+                    complete = True
+                    break
+        except BaseException:
+            for future in part_futures:
+                future.cancel()
+            raise
+
+        if is_big:
+            input_file = InputFileBig(file_id, len(part_futures), file_name)
+        else:
+            input_file = InputFile(file_id, len(part_futures), file_name, hash_md5.hexdigest())
+        # The whole file has been read once nothing is left after this chunk.
+        caption = describe() if complete and not parts.available(1) else PART_CAPTION
+        return asyncio.run_coroutine_threadsafe(
+            self._send_chunk(shard, part_futures, complete, input_file, caption), self.loop
+        )
+
+    async def _save_part(self, shard, request, file_name):
+        with RPC_SECONDS.time(method="save_part"):
+            try:
+                if TRANSFER_CONNECTIONS > 1:
+                    ok = await self._pool(shard, shard.client.session.dc_id).call(request)
+                else:
+                    ok = await shard.client(request)
+            except FloodWaitError as exc:
+                if TRANSFER_CONNECTIONS <= 1:
+                    FLOOD_WAITS.inc() # SenderPool counts its own
+                # New chunks go to other accounts until this one may send again.
+                shard.flood_until = time.time() + exc.seconds
+                raise
+        if not ok:
+            raise RuntimeError(f"Failed to upload part {request.file_part} of {file_name}")
+        UPLOAD_BYTES.inc(len(request.bytes))
+
+    async def _send_chunk(self, shard, part_futures, complete, input_file, caption=None):
+        await asyncio.gather(*(asyncio.wrap_future(f) for f in part_futures))
+        if not complete:
+            raise RuntimeError(f"Upload of {input_file.name} was aborted")
+        with RPC_SECONDS.time(method="send_file"):
+            try:
+                message = await shard.client.send_file(shard.channel_entity, input_file, caption=caption)
+            except FloodWaitError as exc:
+                shard.flood_until = time.time() + exc.seconds
+                raise
+        with self._sent_lock:
+            self._sent.add((shard.index, message.id))
+        return document_from_message(message, shard.index)
 
     def get_cached_file(self, fh):
-        if fh in self.cached_files and self.cached_files[fh] != bytearray(b''):
+        cached = self.cached_files.get(fh)
+        if cached is not None:
             print("CACHE HIT")
-            return self.cached_files[fh]
-        return None
+        return cached
+
+    def cached_path(self, fh):
+        return self.cached_files.path(fh)
 
-    # download entire file from telegram
-    def download_file(self, fh, msgIds, progress_cb=None, total_size=None):
-        if fh in self.cached_files and self.cached_files[fh] != bytearray(b''):
-            print("CACHE HIT in download")
-            return self.cached_files[fh]
+    def cache_upload(self, fh, path):
+        """
+        Writes a file that was just uploaded through to the cache as ``fh``,
+        from the plaintext copy at ``path``, so the first download of it
+        doesn't go back to Telegram.
+        """
+        self.cached_files.adopt(fh, path)
+        print(f"CACHED FILE! NEW SIZE: {self.cached_files.currsize}; maxsize: {self.cached_files.maxsize}")
+
+    def _cipher_for(self, cipher):
+        # Rows from before web_files.cipher existed were Fernet-encrypted
+        # exactly when ENCRYPTION_KEY was set.
+        if cipher is None:
+            cipher = CIPHER_FERNET if self.encryption_key != None else CIPHER_NONE
+        if cipher != CIPHER_NONE and self.encryption_key == None:
+            raise RuntimeError("This file is encrypted but ENCRYPTION_KEY is not set")
+        return cipher
+
+    # download entire file from telegram into the cache
+    def download_file(self, fh, msgIds, progress_cb=None, total_size=None, cipher=None, codec=None, shards=None):
+        cached = self.get_cached_file(fh)
+        if cached is not None:
+            return cached
+        if total_size is not None and total_size > self.cached_files.maxsize:
+            return None
+        cipher = self._cipher_for(cipher)
+        flight, handle = self._join_flight(fh, msgIds, progress_cb, total_size, cipher, codec, shards, start=None)
         try:
-            msgs = self.get_messages(msgIds)
-            buf = BytesIO()
-            downloaded = 0
-            for m in msgs:
-                def part_cb(received, total, base=downloaded):
-                    if not progress_cb:
-                        return
-                    if total_size:
-                        progress_cb(min(base + received, total_size), total_size)
-                    else:
-                        progress_cb(received, total)
-
-                part = self.download_message(m, progress_cb=part_cb if progress_cb else None) # error handling WHO??
-                buf.write(part)
-                downloaded += len(part)
-                if progress_cb and total_size:
-                    progress_cb(min(downloaded, total_size), total_size)
-            numBytes = buf.getbuffer().nbytes
-            print(f"Downloaded file is size {numBytes}")
-            buf.seek(0)
-            readBytes = buf.read()
-
-            if self.encryption_key != None:
-                print("DECRYPTING")
-                f = Fernet(bytes(self.encryption_key, 'utf-8'))
-                readBytes = f.decrypt(readBytes)
-
-            barr = bytearray(readBytes)
-            # add to cache
-            self.cached_files[fh] = barr
-            return barr
-        except Exception:
-            if fh in self.cached_files:
-                self.cached_files.pop(fh, None)
-            raise
+            size = flight.wait_for()
+        finally:
+            flight.leave(handle, progress_cb)
+        print(f"Downloaded file is size {size}")
+        return self.cached_files.get(fh)
+
+    def iter_file(
+        self, fh, msgIds, progress_cb=None, total_size=None, start=0, end=None, cipher=None, codec=None, shards=None
+    ):
+        """
+        Yields the file's bytes as they arrive from Telegram instead of
+        collecting the whole file first. ``start``/``end`` select a byte range
+        (end exclusive), and only the _partN messages that overlap it are
+        fetched. Cached files are served from the cache. Legacy Fernet files
+        are only authenticated once the whole token is in, so those the cache
+        can hold go through download_file first; larger ones are streamed
+        like compressed files, and a bad token cuts the response short.
+        Compressed files can't be entered mid-stream, so a range of one is
+        decoded from the start and the bytes before it are dropped.
+        Whole-file reads go through a single fetch per file (see _Flight):
+        requests for a file that is already coming in read along with it,
+        and the fetch is written through to the cache if it has room. ``shards`` says which
+        account holds each message (all on the first when None).
+        """
+        cipher = self._cipher_for(cipher)
+        cached = self.get_cached_file(fh)
+        if cached is None and cipher == CIPHER_FERNET and (total_size or 0) <= self.cached_files.maxsize:
+            cached = self.download_file(fh, msgIds, progress_cb, total_size, cipher, shards=shards)
+        if cached is not None:
+            view = memoryview(cached)[start:end]
+            for pos in range(0, len(view), DOWNLOAD_CHUNK_SIZE):
+                yield bytes(view[pos:pos + DOWNLOAD_CHUNK_SIZE])
+            return
+
+        # Whole files, and files that can only be read from the start, are
+        # fetched once for everyone asking; a range joins a fetch already
+        # under way if it has got that far.
+        whole = start == 0 and end in (None, total_size)
+        sequential = cipher == CIPHER_FERNET or codec not in (None, CODEC_NONE)
+        pos = start
+        while True:
+            joined = self._join_flight(
+                fh, msgIds, progress_cb, total_size, cipher, codec, shards, pos, reach=None if whole or sequential else pos
+            )
+            if joined is None:
+                break
+            pos = yield from self._iter_flight(*joined, progress_cb, pos, end)
+            if pos is None:
+                return
+            # Dropped by the fetch for lagging behind: files that can be
+            # entered mid-stream go on from there, others start over.
+            if not sequential:
+                break
+        yield from self._iter_plain(_part_refs(msgIds, shards), cipher, progress_cb, total_size, pos, end)
+
+    def _join_flight(self, fh, msgIds, progress_cb, total_size, cipher, codec, shards, start=0, reach=None):
+        """
+        Joins the fetch of ``fh`` running now, or starts one, to read from
+        ``start`` on (see _Flight.join). Returns the _Flight and the handle
+        to read it through, which the caller gives back to _Flight.leave.
+        With ``reach`` set, only a fetch that already has that many bytes is
+        joined, and None is returned when there is none.
+        """
+        with self._flights_lock:
+            flight = self._flights.get(fh)
+            handle = None
+            if flight is not None and (reach is None or flight.size >= reach):
+                handle = flight.join(start, progress_cb)
+            if handle is None:
+                if reach is not None:
+                    return None
+                # Files the cache can't make room for are only buffered.
+                writer = self.cached_files.writer(fh, total_size) if total_size is not None else None
+                flight = self._flights[fh] = _Flight(writer)
+                handle = flight.join(start, progress_cb)
+                refs = _part_refs(msgIds, shards)
+                if cipher == CIPHER_FERNET:
+                    chunks = self._iter_fernet(refs, flight.progress, total_size)
+                elif codec not in (None, CODEC_NONE):
+                    chunks = self._iter_decompressed(refs, cipher, codec, flight.progress)
+                else:
+                    chunks = self._iter_plain(refs, cipher, flight.progress, total_size)
+                threading.Thread(target=self._fly, args=(fh, flight, chunks), name=f"download-{fh}", daemon=True).start()
+                DOWNLOAD_FLIGHTS.inc(result="started")
+            else:
+                DOWNLOAD_FLIGHTS.inc(result="joined")
+            return flight, handle
+
+    def _fly(self, fh, flight, chunks):
+        error = None
+        try:
+            for chunk in chunks:
+                # A compressed part can decode to far more than the buffer
+                # holds; it is passed on a piece at a time.
+                view = memoryview(chunk)
+                for pos in range(0, len(view), DOWNLOAD_CHUNK_SIZE):
+                    if flight.abandoned():
+                        raise RuntimeError("Download abandoned by every reader")
+                    flight.write(view[pos:pos + DOWNLOAD_CHUNK_SIZE])
+        except BaseException as exc:
+            error = exc
+            if flight.writer is not None:
+                flight.writer.abort()
+        else:
+            # Committed while still registered, so a request coming in
+            # meanwhile either joins this flight or finds the cache entry.
+            if flight.writer is not None:
+                flight.writer.commit()
+        finally:
+            chunks.close()
+            with self._flights_lock:
+                # A later fetch may have taken over for requests this one
+                # had already let go of the bytes for.
+                if self._flights.get(fh) is flight:
+                    del self._flights[fh]
+                if flight.fd is not None:
+                    os.close(flight.fd)
+            flight.finish(error)
+
+    def _iter_flight(self, flight, handle, progress_cb, start=0, end=None):
+        """
+        Yields ``flight``'s bytes from ``start`` to ``end``. Returns None
+        once done, or the offset it got to if the flight let go of it.
+        """
+        try:
+            pos = start
+            while end is None or pos < end:
+                size = flight.wait_for(pos + 1)
+                if size <= pos:
+                    break
+                stop = size if end is None else min(size, end)
+                while pos < stop:
+                    chunk = flight.read(handle, pos, min(stop - pos, DOWNLOAD_CHUNK_SIZE))
+                    if chunk is None:
+                        return pos
+                    if not chunk:
+                        raise OSError("Download is shorter than what was fetched")
+                    pos += len(chunk)
+                    yield chunk
+        finally:
+            flight.leave(handle, progress_cb)
+
+    def _iter_plain(self, refs, cipher, progress_cb=None, total_size=None, start=0, end=None):
+        if cipher == CIPHER_NONE:
+            yield from self._iter_messages(refs, progress_cb, total_size, start, end)
+            return
+
+        # CIPHER_AESGCM: fetch only the frames covering [start, end) and
+        # decrypt them one at a time.
+        if total_size is None:
+            total_size = self._stored_size(refs, cipher)
+        stop = total_size if end is None else min(end, total_size)
+        if start >= stop and total_size:
+            return
+        first = start // FRAME_SIZE
+        last_needed = max(stop - 1, 0) // FRAME_SIZE
+        cipher_end = min(frame_offset(last_needed + 1), encrypted_size(total_size))
+
+        if first == 0:
+            chunks = self._iter_messages(refs, progress_cb, total_size, 0, cipher_end)
+            header = bytearray()
+            for chunk in chunks:
+                header += chunk
+                if len(header) >= HEADER_SIZE:
+                    break
+            rest = [header[HEADER_SIZE:]]
+        else:
+            header = self._file_header(refs)
+            chunks = self._iter_messages(refs, progress_cb, total_size, frame_offset(first), cipher_end)
+            rest = []
+
+        decryptor = FrameDecryptor(self.encryption_key, header, first, last_needed + 1, frame_count(total_size) - 1)
+        pos = first * FRAME_SIZE
+        for chunk in itertools.chain(rest, chunks, [None]):
+            frames = decryptor.finish() if chunk is None else decryptor.feed(chunk)
+            for frame in frames:
+                frame_end = pos + len(frame)
+                if pos < start or frame_end > stop:
+                    frame = frame[max(start - pos, 0):stop - pos]
+                pos = frame_end
+                if frame:
+                    yield frame
+
+    def _iter_fernet(self, refs, progress_cb=None, total_size=None):
+        # The token's HMAC is only checked after the last chunk; callers
+        # must throw away what they got if this raises.
+        decryptor = FernetDecryptor(self.encryption_key)
+        for chunk in itertools.chain(self._iter_messages(refs, progress_cb, total_size), [None]):
+            chunk = decryptor.finalize() if chunk is None else decryptor.update(chunk)
+            if chunk:
+                yield chunk
+
+    def _iter_decompressed(self, refs, cipher, codec, progress_cb=None):
+        # size_bytes is the uncompressed size; what's stored has to be looked up
+        d = decompressor(codec)
+        for chunk in self._iter_plain(refs, cipher, progress_cb, self._stored_size(refs, cipher)):
+            chunk = d.decompress(chunk)
+            if chunk:
+                yield chunk
+        if not getattr(d, "eof", True):
+            raise ValueError("Compressed stream ended early")
+
+    def probe_file(self, msgIds, shards=None):
+        """
+        Works out how a file with no record of it was stored, from its
+        _partN messages: returns (cipher, codec, size of the original).
+        Compressed and Fernet files have to be read in full for their size.
+        """
+        refs = _part_refs(msgIds, shards)
+        header = self._file_header(refs)
+        if header.startswith(MAGIC):
+            cipher = CIPHER_AESGCM
+        elif header.startswith(FERNET_PREFIX):
+            cipher = CIPHER_FERNET
+        else:
+            cipher = CIPHER_NONE
+        if cipher != CIPHER_NONE and self.encryption_key == None:
+            raise RuntimeError("This file is encrypted but ENCRYPTION_KEY is not set")
+        if cipher == CIPHER_FERNET:
+            return cipher, CODEC_NONE, sum(len(chunk) for chunk in self._iter_fernet(refs))
+        sample = b"".join(self._iter_plain(refs, cipher, end=FRAME_SIZE))
+        codec = detect_codec(sample)
+        if codec != CODEC_NONE:
+            return cipher, codec, sum(len(chunk) for chunk in self._iter_decompressed(refs, cipher, codec))
+        return cipher, codec, self._stored_size(refs, cipher)
+
+    def _stored_size(self, refs, cipher):
+        """Size of the (possibly compressed) plaintext held by the _partN messages."""
+        size = sum(doc.size for doc in self._get_documents(refs))
+        return plain_size(size) if cipher == CIPHER_AESGCM else size
+
+    def _file_header(self, refs):
+        key = tuple(refs)
+        with self._headers_lock:
+            header = self._headers.get(key)
+        if header is None:
+            # Fetched without the lock held; two threads may both fetch it.
+            header = b"".join(self._iter_messages(refs, start=0, end=HEADER_SIZE))
+            with self._headers_lock:
+                self._headers[key] = header
+        return header
+
+    def _remember_documents(self, documents, persist=False):
+        with self._documents_lock:
+            for doc in documents:
+                self._documents[(doc.shard, doc.msg_id)] = doc
+        if persist and self.document_store is not None and documents:
+            self.document_store.save_documents(documents)
+
+    def _get_documents(self, refs):
+        """
+        Locations of the _partN documents, by (shard, msg_id), from memory
+        or the document store when known; only the rest are looked up on
+        Telegram.
+        """
+        with self._documents_lock:
+            found = {r: self._documents[r] for r in refs if r in self._documents}
+        missing = [r for r in refs if r not in found]
+        if missing and self.document_store is not None:
+            stored = self.document_store.get_documents(missing)
+            self._remember_documents(stored.values())
+            found.update(stored)
+            missing = [r for r in missing if r not in found]
+        if missing:
+            found.update(self._run(self._refresh_documents(missing)))
+        docs = [found.get(r) for r in refs]
+        if None in docs:
+            raise FileNotFoundError(f"Telegram message for this file is missing (ids {[m for _, m in refs]})")
+        return docs
+
+    async def _refresh_documents(self, refs):
+        """
+        Reads the messages again for their current document and file
+        reference. Messages asked for by concurrent callers are fetched
+        together. Returns {(shard, msg_id): TelegramDocument or None if the
+        message is gone}.
+        """
+        futures = {}
+        for ref in refs:
+            future = self._refresh_pending.get(ref)
+            if future is None:
+                future = self._refresh_pending[ref] = self.loop.create_future()
+            futures[ref] = future
+        if self._refresh_task is None:
+            self._refresh_task = self.loop.create_task(self._flush_refreshes())
+        results = await asyncio.gather(*futures.values())
+        return dict(zip(futures, results))
+
+    async def _flush_refreshes(self):
+        await asyncio.sleep(REFRESH_BATCH_SECONDS)
+        pending, self._refresh_pending = self._refresh_pending, {}
+        self._refresh_task = None
+        by_shard = defaultdict(list)
+        for shard_index, msg_id in pending:
+            by_shard[shard_index].append(msg_id)
+        docs = {}
+        try:
+            for shard_index, ids in by_shard.items():
+                shard = self._shard(shard_index)
+                for i in range(0, len(ids), GET_MESSAGES_BATCH):
+                    batch = ids[i:i + GET_MESSAGES_BATCH]
+                    with RPC_SECONDS.time(method="get_messages"):
+                        msgs = await shard.client.get_messages(shard.channel_entity, ids=batch)
+                    for msg_id, m in zip(batch, msgs):
+                        found = m is not None and m.media is not None
+                        docs[(shard_index, msg_id)] = document_from_message(m, shard_index) if found else None
+            found = [doc for doc in docs.values() if doc is not None]
+            if found:
+                await self.loop.run_in_executor(None, self._remember_documents, found, True)
+        except Exception as exc:
+            for future in pending.values():
+                future.set_exception(exc)
+            return
+        for ref, future in pending.items():
+            future.set_result(docs.get(ref))
+
+    def _iter_messages(self, refs, progress_cb=None, total_size=None, start=0, end=None):
+        agen = self._aiter_documents(self._get_documents(refs), progress_cb, total_size, start, end)
+        try:
+            while True:
+                try:
+                    yield self._run(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            # Runs when the consumer stops early too (e.g. the browser hung up).
+            # Don't wait on it: this can fire from garbage collection on any thread.
+            asyncio.run_coroutine_threadsafe(agen.aclose(), self.loop)
+
+    async def _aiter_documents(self, docs, progress_cb=None, total_size=None, start=0, end=None):
+        started = time.perf_counter()
+        downloaded = 0
+        # (index, offset, stop) of each part overlapping [start, end)
+        spans = []
+        part_start = 0
+        for index, doc in enumerate(docs):
+            part_end = part_start + doc.size
+            if end is not None and part_start >= end:
+                break
+            if part_end > start:
+                stop = doc.size if end is None else min(end - part_start, doc.size)
+                spans.append((index, max(start - part_start, 0), stop))
+            part_start = part_end
+
+        if len({docs[index].shard for index, _, _ in spans}) > 1:
+            chunks = self._aiter_readahead(docs, spans)
+        else:
+            chunks = self._aiter_spans(docs, spans)
+        try:
+            async for chunk in chunks:
+                downloaded += len(chunk)
+                DOWNLOAD_BYTES.inc(len(chunk))
+                if progress_cb:
+                    progress_cb(min(downloaded, total_size) if total_size else downloaded, total_size or 0)
+                yield chunk
+        finally:
+            await chunks.aclose()
+        if downloaded:
+            DOWNLOAD_THROUGHPUT.observe(downloaded / max(time.perf_counter() - started, 1e-6))
+
+    async def _aiter_spans(self, docs, spans):
+        for span in spans:
+            async for chunk in self._aiter_span(docs, *span):
+                yield chunk
+
+    async def _aiter_readahead(self, docs, spans):
+        """
+        Yields the spans in order while the next parts held by other
+        accounts are fetched at the same time, each into its own bounded
+        queue, so every account holding part of the file is busy. Parts on
+        the same account are fetched one after another.
+        """
+        accounts = len({docs[index].shard for index, _, _ in spans})
+        depth = max(1, DOWNLOAD_READAHEAD_BYTES // DOWNLOAD_CHUNK_SIZE // (accounts - 1))
+        queues = []
+        fetching = {} # shard -> (position in spans, task)
+
+        async def fetch(span, queue):
+            try:
+                async for chunk in self._aiter_span(docs, *span):
+                    await queue.put(chunk)
+                await queue.put(None)
+            except Exception as exc:
+                await queue.put(exc)
+
+        def launch(head):
+            while len(queues) < min(len(spans), head + accounts):
+                shard = docs[spans[len(queues)][0]].shard
+                position, task = fetching.get(shard, (None, None))
+                # A part that has been passed on in full is as good as done.
+                if task is not None and not task.done() and position >= head:
+                    return
+                queue = asyncio.Queue(depth)
+                fetching[shard] = (len(queues), asyncio.ensure_future(fetch(spans[len(queues)], queue)))
+                queues.append(queue)
+
+        try:
+            for head in range(len(spans)):
+                launch(head)
+                queue = queues[head]
+                while True:
+                    chunk = await queue.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+                    launch(head)
+        finally:
+            for _, task in fetching.values():
+                task.cancel()
+
+    async def _aiter_span(self, docs, index, offset, stop):
+        """Yields bytes ``[offset, stop)`` of ``docs[index]``, renewing expired file references once."""
+        doc = docs[index]
+        refreshed = False
+        while True:
+            try:
+                async for chunk in self._aiter_part(doc, offset, stop):
+                    offset += len(chunk)
+                    yield chunk
+                return
+            except FILE_REFERENCE_ERRORS:
+                if refreshed:
+                    raise
+                refreshed = True
+                # References of a file's parts age together, so renew
+                # the rest of them in the same call.
+                rest = [(d.shard, d.msg_id) for d in docs[index:]]
+                fresh = await self._refresh_documents(rest)
+                if any(fresh[r] is None for r in rest):
+                    raise FileNotFoundError(f"Telegram message for this file is missing (id {doc.msg_id})")
+                docs[index:] = [fresh[r] for r in rest]
+                doc = docs[index]
+
+    async def _aiter_part(self, doc, offset, stop):
+        """Yields bytes ``[offset, stop)`` of one _partN document."""
+        shard = self._shard(doc.shard)
+        location = document_location(doc)
+        if TRANSFER_CONNECTIONS > 1:
+            pool = self._pool(shard, doc.dc_id)
+            try:
+                async for chunk in iter_blocks(pool, location, offset, stop, DOWNLOAD_CONCURRENCY):
+                    offset += len(chunk)
+                    yield chunk
+                return
+            except CdnRedirectError:
+                pass # CDN-hosted; telethon's iterator knows how to follow the redirect
+
+        # Telegram wants request offsets aligned to the request size, so
+        # start at the aligned offset and trim the head of the first chunk.
+        aligned = offset - offset % DOWNLOAD_CHUNK_SIZE
+        skip = offset - aligned
+        limit = -(-(stop - aligned) // DOWNLOAD_CHUNK_SIZE)
+        pos = aligned
+        async with shard.client.iter_download(
+            location, offset=aligned, limit=limit, request_size=DOWNLOAD_CHUNK_SIZE, file_size=doc.size, dc_id=doc.dc_id
+        ) as chunks:
+            async for chunk in chunks:
+                chunk_end = pos + len(chunk)
+                if skip or chunk_end > stop:
+                    chunk = chunk[skip:stop - pos]
+                    skip = 0
+                pos = chunk_end
+                yield chunk
+
+    def _pool(self, shard, dc_id):
+        # Only touched from the event loop thread, so no lock is needed.
+        pool = shard.pools.get(dc_id)
+        if pool is None:
+            pool = shard.pools[dc_id] = self.pool_factory(shard.client, dc_id, TRANSFER_CONNECTIONS)
+        return pool
+
+    def channels(self):
+        """
+        {channel id: account indexes}: accounts that post to the same
+        channel see the same messages, so its history is read only once.
+        """
+        self.wait_ready()
+        channels = defaultdict(list)
+        for shard in self.shards:
+            channels[utils.get_peer_id(shard.channel_entity)].append(shard.index)
+        return dict(channels)
+
+    def sent_messages(self):
+        """
+        (shard, msg_id) of the _partN messages this process sent, including
+        those of uploads still in progress.
+        """
+        with self._sent_lock:
+            return set(self._sent)
+
+    def channel_messages(self, shard, after_id, limit=SCAN_BATCH):
+        """
+        Reads up to ``limit`` messages posted after ``after_id`` to an
+        account's channel, oldest first. Returns the documents among them
+        as ChannelMessages, and the id of the last message read (``after_id``
+        when there were none).
+        """
+        shard = self._shard(shard)
+        return self._run(self._channel_messages(shard, after_id, limit))
+
+    async def _channel_messages(self, shard, after_id, limit):
+        found = []
+        last_id = after_id
+        with RPC_SECONDS.time(method="iter_messages"):
+            async for message in shard.client.iter_messages(
+                shard.channel_entity, min_id=after_id, reverse=True, limit=limit
+            ):
+                last_id = max(last_id, message.id)
+                if getattr(message.media, "document", None) is None:
+                    continue
+                doc = document_from_message(message, shard.index)
+                found.append(ChannelMessage(doc, message.file.name, message.message, message.date.timestamp()))
+        self._remember_documents([m.document for m in found])
+        return found, last_id
 
-    def get_messages(self, ids):
-        result = self._run(self.client.get_messages(self.channel_entity, ids=ids))
+    def get_messages(self, ids, shard=0):
+        shard = self._shard(shard)
+        with RPC_SECONDS.time(method="get_messages"):
+            result = self._run(shard.client.get_messages(shard.channel_entity, ids=ids))
         return result
 
     def download_message(self, msg, progress_cb=None):
-        result = self._run(msg.download_media(bytes, progress_callback=progress_cb or default_progress_cb))
+        with RPC_SECONDS.time(method="download_media"):
+            result = self._run(msg.download_media(bytes, progress_callback=progress_cb or default_progress_cb))
+        DOWNLOAD_BYTES.inc(len(result or b""))
         return result
     
-    def delete_messages(self, ids):
-        return self._run(self.client.delete_messages(self.channel_entity, message_ids=ids))
+    def delete_messages(self, ids, shards=None):
+        by_shard = defaultdict(list)
+        for shard_index, msg_id in _part_refs(ids, shards):
+            by_shard[shard_index].append(msg_id)
+        for shard_index, msg_ids in by_shard.items():
+            shard = self._shard(shard_index)
+            self._run(shard.client.delete_messages(shard.channel_entity, message_ids=msg_ids))
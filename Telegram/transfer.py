@@ -0,0 +1,153 @@
+import asyncio
+from collections import deque, namedtuple
+
+from telethon.errors import FloodWaitError
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.types import InputDocumentFileLocation
+from telethon.tl.types.upload import FileCdnRedirect
+
+from Telegram.metrics import FLOOD_WAITS, RPC_SECONDS
+
+# upload.getFile requests must not cross a 1MB boundary, so blocks are
+# aligned to a divisor of 1MB.
+BLOCK_SIZE = 512 * 1024
+
+
+class CdnRedirectError(Exception):
+    """The document is served from a CDN DC, which SenderPool can't talk to."""
+
+
+class SenderPool:
+    """
+    A set of extra MTProto connections to one DC. Telegram throttles each
+    connection, so spreading file requests over several of them is what
+    lets a single transfer go faster than one sender allows.
+
+    Modeled on TelegramClient._create_exported_sender: connections to the
+    home DC reuse the session's auth key, connections to other DCs import an
+    exported authorization once and share the resulting key.
+    """
+
+    def __init__(self, client, dc_id, size):
+        self.client = client
+        self.dc_id = dc_id
+        self.size = size
+        self.senders = []
+        self.in_flight = []
+        self.auth_key = client.session.auth_key if dc_id == client.session.dc_id else None
+        self.lock = asyncio.Lock()
+
+    async def _create_sender(self):
+        dc = await self.client._get_dc(self.dc_id)
+        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
+        await sender.connect(self.client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=self.client._log,
+            proxy=self.client._proxy,
+            local_addr=self.client._local_addr,
+        ))
+        if not self.auth_key:
+            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
+            self.client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+            await sender.send(InvokeWithLayerRequest(LAYER, self.client._init_request))
+            self.auth_key = sender.auth_key
+        return sender
+
+    async def _acquire(self):
+        async with self.lock:
+            # Grow lazily: a small download never opens more than it needs.
+            if len(self.senders) < self.size and (not self.senders or min(self.in_flight) > 0):
+                self.senders.append(await self._create_sender())
+                self.in_flight.append(0)
+            idx = min(range(len(self.senders)), key=self.in_flight.__getitem__)
+            self.in_flight[idx] += 1
+            return idx
+
+    async def call(self, request):
+        idx = await self._acquire()
+        try:
+            return await self.client._call(self.senders[idx], request)
+        except FloodWaitError:
+            FLOOD_WAITS.inc()
+            raise
+        finally:
+            self.in_flight[idx] -= 1
+
+    async def close(self):
+        async with self.lock:
+            for sender in self.senders:
+                await sender.disconnect()
+            self.senders = []
+            self.in_flight = []
+
+
+# Where one _partN message's document lives, as stored at upload time so a
+# download doesn't have to fetch the message first. ``file_reference``
+# expires after a while and is refreshed from the message. ``shard`` is the
+# index of the account (and channel) the message was sent with.
+TelegramDocument = namedtuple(
+    "TelegramDocument", "msg_id id access_hash file_reference dc_id size shard", defaults=(0,)
+)
+# A document found while reading a channel's history: its location, the
+# file name it was sent with, the message's caption and its date (epoch).
+ChannelMessage = namedtuple("ChannelMessage", "document name caption date")
+
+
+def document_from_message(message, shard=0):
+    document = message.media.document
+    return TelegramDocument(
+        message.id, document.id, document.access_hash, document.file_reference, document.dc_id, document.size, shard
+    )
+
+
+def document_location(document):
+    return InputDocumentFileLocation(
+        id=document.id,
+        access_hash=document.access_hash,
+        file_reference=document.file_reference,
+        thumb_size="",
+    )
+
+
+async def iter_blocks(pool, location, offset, stop, concurrency):
+    """
+    Yields bytes ``[offset, stop)`` of a document in order, keeping up to
+    ``concurrency`` block requests in flight across the pool's connections.
+    Only that many blocks are ever held in memory at once.
+    """
+    starts = iter(range(offset - offset % BLOCK_SIZE, stop, BLOCK_SIZE))
+    pending = deque()
+
+    async def fetch(block_start):
+        with RPC_SECONDS.time(method="get_file"):
+            result = await pool.call(GetFileRequest(location, offset=block_start, limit=BLOCK_SIZE))
+        if isinstance(result, FileCdnRedirect):
+            raise CdnRedirectError()
+        return block_start, result.bytes
+
+    def schedule():
+        for block_start in starts:
+            pending.append(asyncio.ensure_future(fetch(block_start)))
+            return
+
+    try:
+        for _ in range(max(1, concurrency)):
+            schedule()
+        while pending:
+            block_start, data = await pending.popleft()
+            schedule()
+            head = max(offset - block_start, 0)
+            tail = min(stop - block_start, len(data))
+            if head or tail < len(data):
+                data = data[head:tail]
+            if data:
+                yield data
+    finally:
+        for task in pending:
+            task.cancel()
@@ -1,19 +1,41 @@
 ﻿import os
 import time
-import uuid
 import threading
 import secrets
 import base64
 import hashlib
+import json
+import logging
+import re
 from pathlib import Path
-from io import BytesIO
 
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, send_file, send_from_directory, session, redirect
+from flask import Flask, Response, jsonify, request, send_file, send_from_directory, session, redirect
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 from werkzeug.utils import secure_filename
 
-from Telegram.teleBot import TelegramFileClient
-from Telegram.web.storage import WebStore
+from Telegram.metrics import REGISTRY, Gauge
+from Telegram.teleBot import TelegramFileClient, TelegramNotReady
+from Telegram.web.archive import iter_zip
+from Telegram.web.events import EventHub
+from Telegram.web.jobs import UploadAborted, UploadScheduler
+from Telegram.web.prefetch import Prefetcher
+from Telegram.web.storage import SORT_COLUMNS, WebStore
+from Telegram.web.sync import ChannelSync
+
+# Upload request bodies are read and parsed this much at a time.
+REQUEST_READ_BYTES = 256 * 1024
+# Chunk size handed out to resumable uploads, capped by WEB_MAX_UPLOAD_BYTES.
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+SHA256_HEX = re.compile(r"[0-9a-f]{64}")
+FILES_PAGE_MAX = 200
+
+THREADS = Gauge("telearchive_threads", "Live Python threads")
+UPLOAD_JOBS = Gauge("telearchive_upload_jobs", "Upload queue depth by job status", ["status"])
+ACTIVE_DOWNLOADS = Gauge("telearchive_active_downloads", "Background downloads into the cache in progress")
+EVENT_STREAMS = Gauge("telearchive_event_streams", "Open /api/events connections")
 
 
 def _format_bytes(value):
@@ -28,8 +50,15 @@ def _format_time(ts):
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
 
 
-def _escape_like(value):
-    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+def _encode_cursor(sort_value, file_id):
+    return _b64e(json.dumps([sort_value, file_id]).encode("utf-8")).rstrip("=")
+
+
+def _decode_cursor(cursor):
+    value, file_id = json.loads(_b64d(cursor + "=" * (-len(cursor) % 4)))
+    if not isinstance(file_id, int) or not isinstance(value, (int, str)):
+        raise ValueError("bad cursor")
+    return value, file_id
 
 
 def _b64e(data):
@@ -44,45 +73,208 @@ def _hash_passkey(passkey, salt):
     return hashlib.pbkdf2_hmac("sha256", passkey.encode("utf-8"), salt, 200_000)
 
 
-def create_app():
+def _multipart_events(stream, boundary, max_parts=None):
+    """
+    Parses a multipart/form-data body as it is read, yielding werkzeug's
+    Field, File and Data events; file contents are never held in full.
+    """
+    decoder = MultipartDecoder(boundary.encode("latin-1"), max_parts=max_parts)
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            decoder.receive_data(stream.read(REQUEST_READ_BYTES) or None)
+        elif isinstance(event, Epilogue):
+            return
+        elif isinstance(event, (Field, File, Data)):
+            yield event
+
+
+def _file_ids(values):
+    """Ids from a JSON list or a comma-separated string; ValueError if one isn't a number."""
+    if isinstance(values, str):
+        values = [v for v in values.split(",") if v.strip()]
+    if not isinstance(values, list):
+        raise ValueError("ids must be a list")
+    return [int(v) for v in values]
+
+
+def _send_download(client, file_id, row):
+    size = row["size_bytes"]
+    etag = f"{file_id}-{row['uploaded_at']}"
+
+    # Cached files go out straight from the disk tier; werkzeug handles
+    # Range/If-Range itself and can hand the file to the server's sendfile.
+    path = client.cached_path(file_id)
+    if path is not None:
+        try:
+            resp = send_file(
+                path,
+                as_attachment=True,
+                download_name=row["file_name"],
+                mimetype="application/octet-stream",
+                max_age=0,
+                conditional=True,
+                etag=etag,
+                last_modified=row["uploaded_at"],
+            )
+            resp.headers["Cache-Control"] = "no-store"
+            return resp
+        except FileNotFoundError:
+            pass  # evicted between lookup and open; fetch it again below
+
+    status = 200
+    start, stop = 0, size
+
+    # Resuming clients send If-Range; a stale validator means "send it all".
+    rng = request.range
+    if rng is not None and rng.units == "bytes" and len(rng.ranges) == 1:
+        if_range = request.if_range
+        fresh = (
+            (if_range.etag is None and if_range.date is None)
+            or if_range.etag == etag
+            or (if_range.date is not None and int(if_range.date.timestamp()) >= row["uploaded_at"])
+        )
+        if fresh:
+            span = rng.range_for_length(size)
+            if span is None:
+                resp = Response("Requested range not satisfiable", status=416)
+                resp.headers["Content-Range"] = f"bytes */{size}"
+                return resp
+            start, stop = span
+            status = 206
+
+    # Check before the headers go out; a failure inside the body can only
+    # cut the download short.
+    client.wait_ready()
+    chunks = client.iter_file(
+        file_id,
+        row["msg_ids"],
+        total_size=size,
+        start=start,
+        end=stop,
+        cipher=row["cipher"],
+        codec=row["codec"],
+        shards=row["shards"],
+    )
+    resp = Response(chunks, status=status, mimetype="application/octet-stream")
+    resp.headers.set("Content-Disposition", "attachment", filename=row["file_name"])
+    resp.headers["Content-Length"] = str(stop - start)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers["Cache-Control"] = "no-store"
+    if status == 206:
+        resp.content_range = ContentRange("bytes", start, stop, size)
+    resp.set_etag(etag)
+    resp.last_modified = row["uploaded_at"]
+    return resp
+
+
+def create_app(client=None):
     load_dotenv()
 
-    api_id_raw = os.getenv("APP_ID")
-    api_id = int(api_id_raw) if api_id_raw else None
-    api_hash = os.getenv("APP_HASH")
-    channel_link = os.getenv("CHANNEL_LINK")
-    session_string = os.getenv("SESSION_STRING")
-
-    if not all([api_id, api_hash, channel_link, session_string]):
-        raise RuntimeError("Missing Telegram credentials. Check .env values.")
-
-    client = TelegramFileClient(session_string, api_id, api_hash, channel_link)
     store = WebStore(os.getenv("WEB_DB_PATH", "telegram_web.db"))
+    if client is None:
+        api_id_raw = os.getenv("APP_ID")
+        api_id = int(api_id_raw) if api_id_raw else None
+        api_hash = os.getenv("APP_HASH")
+        # Comma-separated to spread transfers over several accounts. Keep
+        # the order: stored files remember which account holds each part.
+        channel_links = [s.strip() for s in os.getenv("CHANNEL_LINK", "").split(",") if s.strip()]
+        session_strings = [s.strip() for s in os.getenv("SESSION_STRING", "").split(",") if s.strip()]
+
+        if not all([api_id, api_hash, channel_links, session_strings]):
+            raise RuntimeError("Missing Telegram credentials. Check .env values.")
+
+        # Returns right away; Telegram connects in the background while the
+        # file list, cached downloads and upload spooling already work.
+        client = TelegramFileClient(session_strings, api_id, api_hash, channel_links, store=store)
+    # Downloads find document locations here instead of fetching messages.
+    client.document_store = store
 
     env_passkey = os.getenv("PASSKEY")
     if not env_passkey:
         raise RuntimeError("PASSKEY is not set. Add PASSKEY to your .env and restart.")
-    salt = secrets.token_bytes(16)
-    h = _hash_passkey(env_passkey, salt)
-    store.set_config("passkey_salt", _b64e(salt))
-    store.set_config("passkey_hash", _b64e(h))
-    salt_b64 = _b64e(salt)
-    hash_b64 = _b64e(h)
+    # PBKDF2 is slow on purpose, so a restart reuses the stored salt and
+    # hash and checks them against PASSKEY once the server is up; logins
+    # wait for that check.
+    auth = {}
+    auth_checked = threading.Event()
+
+    def save_passkey():
+        salt = secrets.token_bytes(16)
+        h = _hash_passkey(env_passkey, salt)
+        with store.transaction():
+            store.set_config("passkey_salt", _b64e(salt))
+            store.set_config("passkey_hash", _b64e(h))
+        auth.update(salt=salt, hash=h)
+
+    def check_passkey():
+        try:
+            if _hash_passkey(env_passkey, auth["salt"]) != auth["hash"]:
+                save_passkey()
+                if not os.getenv("WEB_SECRET"):
+                    # Sessions from before the passkey changed end here.
+                    app.secret_key = _b64e(auth["hash"])
+        finally:
+            auth_checked.set()
+
+    stored_salt, stored_hash = store.get_config("passkey_salt"), store.get_config("passkey_hash")
+    if stored_salt and stored_hash:
+        auth.update(salt=_b64d(stored_salt), hash=_b64d(stored_hash))
+    else:
+        save_passkey()
+        auth_checked.set()
 
     app = Flask(__name__)
-    app.secret_key = os.getenv("WEB_SECRET") or hash_b64
+    app.secret_key = os.getenv("WEB_SECRET") or _b64e(auth["hash"])
     frontend_root = Path(__file__).resolve().parents[2] / "frontend"
     home_dir = frontend_root / "home"
     login_dir = frontend_root / "login"
+    if not auth_checked.is_set():
+        threading.Thread(target=check_passkey, name="passkey-check", daemon=True).start()
 
     max_upload = os.getenv("WEB_MAX_UPLOAD_BYTES")
     if max_upload:
         app.config["MAX_CONTENT_LENGTH"] = int(max_upload)
 
-    upload_progress = {}
     download_progress = {}
-    store_lock = threading.Lock()
     download_lock = threading.Lock()
+    events = EventHub()
+
+    prefetcher = Prefetcher(
+        client,
+        store,
+        max_bytes=int(os.getenv("PREFETCH_MAX_BYTES", str(1024 * 1024 * 1024))),
+        recent_files=int(os.getenv("PREFETCH_RECENT_FILES", "10")),
+    )
+    prefetcher.start()
+
+    uploads = UploadScheduler(
+        client,
+        store,
+        os.getenv("UPLOAD_SPOOL_DIR", "upload_spool"),
+        workers=int(os.getenv("UPLOAD_WORKERS", "2")),
+        max_attempts=int(os.getenv("UPLOAD_MAX_ATTEMPTS", "5")),
+        events=events,
+        prefetcher=prefetcher,
+    )
+    uploads.start()
+
+    # Lists files found in the channel that have no row, e.g. after losing
+    # the database; 0 only syncs on POST /api/sync.
+    channel_sync = ChannelSync(client, store, interval=int(os.getenv("SYNC_INTERVAL_SECONDS", "3600")))
+    channel_sync.start()
+
+    def collect_metrics():
+        THREADS.set(threading.active_count())
+        counts = store.count_upload_jobs()
+        for status in ("queued", "running", "done", "failed"):
+            UPLOAD_JOBS.set(counts.get(status, 0), status=status)
+        with download_lock:
+            ACTIVE_DOWNLOADS.set(sum(1 for info in download_progress.values() if not info.get("done")))
+        EVENT_STREAMS.set(len(events.subscribers))
+
+    REGISTRY.add_collector(collect_metrics)
+    metrics_token = os.getenv("METRICS_TOKEN")
 
     def is_authed():
         return session.get("authed") is True
@@ -94,10 +286,20 @@ def create_app():
             return None
         if path.startswith("/login") or path.startswith("/logout"):
             return None
+        if path == "/healthz":
+            return None
         if path.startswith("/frontend/"):
             return None
         if path.startswith("/static/"):
             return None
+        if path == "/metrics":
+            # Scrapers can't log in; they send METRICS_TOKEN as a bearer token.
+            auth = request.headers.get("Authorization", "")
+            if metrics_token and secrets.compare_digest(auth, f"Bearer {metrics_token}"):
+                return None
+            if not is_authed():
+                return Response("Unauthorized\n", status=401, mimetype="text/plain")
+            return None
         if path.startswith("/api/"):
             if not is_authed():
                 return jsonify(ok=False, error="Unauthorized"), 401
@@ -113,9 +315,8 @@ def create_app():
     @app.post("/login")
     def login_submit():
         passkey = (request.form.get("passkey") or "").strip()
-        salt = _b64d(salt_b64)
-        expected = _b64d(hash_b64)
-        if passkey and _hash_passkey(passkey, salt) == expected:
+        auth_checked.wait()
+        if passkey and secrets.compare_digest(_hash_passkey(passkey, auth["salt"]), auth["hash"]):
             session.clear()
             session["authed"] = True
             return redirect("/")
@@ -126,6 +327,22 @@ def create_app():
         session.clear()
         return redirect("/login")
 
+    @app.get("/healthz")
+    def healthz():
+        # 200 once Telegram is connected; until then the server is up but
+        # only answers what it can from the database and the cache.
+        if client.is_ready():
+            return jsonify(ok=True, telegram="ready")
+        error = client.connect_error
+        return jsonify(ok=False, telegram="connecting", error=str(error) if error else None), 503
+
+    @app.errorhandler(TelegramNotReady)
+    def telegram_not_ready(exc):
+        resp = jsonify(ok=False, error=str(exc))
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "5"
+        return resp
+
     @app.get("/")
     def index():
         return send_from_directory(home_dir, "index.html")
@@ -136,18 +353,21 @@ def create_app():
 
     @app.get("/api/files")
     def list_files():
-        limit = int(request.args.get("limit", "50"))
+        limit = max(1, min(int(request.args.get("limit", "50")), FILES_PAGE_MAX))
         sort = request.args.get("sort", "date")
         direction = request.args.get("dir", "desc")
-        query = request.args.get("q")
+        query = (request.args.get("q") or "").strip()
         if sort not in ("date", "size", "name"):
             sort = "date"
         if direction not in ("asc", "desc"):
             direction = "desc"
-        if query:
-            query = _escape_like(query.strip())
-        with store_lock:
-            rows = store.list_files(limit, sort, direction, query=query)
+        after = None
+        if request.args.get("cursor"):
+            try:
+                after = _decode_cursor(request.args["cursor"])
+            except (ValueError, TypeError):
+                return jsonify(ok=False, error="Invalid cursor"), 400
+        rows = store.list_files(limit, sort, direction, query=query or None, after=after)
         files = [
             {
                 "id": row[0],
@@ -159,29 +379,95 @@ def create_app():
             }
             for row in rows
         ]
-        return jsonify(ok=True, files=files)
+        # A full page means there may be more; the client passes this back as ?cursor=.
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = _encode_cursor(last[SORT_COLUMNS[sort][1]], last[0])
+        return jsonify(ok=True, files=files, next_cursor=next_cursor)
 
     @app.post("/api/share/<int:file_id>")
     def create_share(file_id):
-        with store_lock:
-            row = store.get_file(file_id)
+        row = store.get_file(file_id)
         if not row:
             return jsonify(ok=False, error="File not found"), 404
         token = secrets.token_urlsafe(32)
-        with store_lock:
+        with store.transaction():
             store.revoke_share_token(file_id)
             store.create_share_token(file_id, token, int(time.time()))
+        prefetcher.shared(file_id)
         link = request.host_url.rstrip("/") + "/share/" + token
         return jsonify(ok=True, link=link, token=token)
 
+    @app.post("/api/files/share")
+    def bulk_share():
+        try:
+            file_ids = _file_ids((request.get_json(silent=True) or {}).get("ids", []))
+        except (TypeError, ValueError):
+            return jsonify(ok=False, error="Invalid ids"), 400
+        rows = store.get_files(file_ids)
+        now = int(time.time())
+        host = request.host_url.rstrip("/")
+        links = []
+        with store.transaction():
+            for row in rows:
+                token = secrets.token_urlsafe(32)
+                store.revoke_share_token(row["id"])
+                store.create_share_token(row["id"], token, now)
+                links.append({"id": row["id"], "link": host + "/share/" + token, "token": token})
+        for row in rows:
+            prefetcher.shared(row["id"])
+        found = {row["id"] for row in rows}
+        return jsonify(ok=True, links=links, missing=[i for i in file_ids if i not in found])
+
+    @app.post("/api/files/delete")
+    def bulk_delete():
+        try:
+            file_ids = _file_ids((request.get_json(silent=True) or {}).get("ids", []))
+        except (TypeError, ValueError):
+            return jsonify(ok=False, error="Invalid ids"), 400
+        # Before the rows go, or their messages would be left in the channel.
+        client.wait_ready()
+        removed = store.delete_files(file_ids)
+        msg_ids, shards = [], []
+        for file_id, (ids, file_shards) in removed.items():
+            client.cached_files.pop(file_id)
+            msg_ids.extend(ids)
+            shards.extend(file_shards or [0] * len(ids))
+        if msg_ids:
+            client.delete_messages(msg_ids, shards)
+        return jsonify(ok=True, deleted=list(removed), missing=[i for i in file_ids if i not in removed])
+
+    @app.route("/api/export", methods=["GET", "POST"])
+    def export_zip():
+        # A selection (?ids=1,2,3, or a form field for long ones), or else
+        # everything matching the search, in the list's order.
+        try:
+            if request.values.get("ids"):
+                file_ids = _file_ids(request.values["ids"])
+            else:
+                query = (request.values.get("q") or "").strip()
+                sort = request.values.get("sort", "date")
+                direction = "asc" if request.values.get("dir") == "asc" else "desc"
+                file_ids = store.search_file_ids(sort if sort in SORT_COLUMNS else "date", direction, query or None)
+        except (TypeError, ValueError):
+            return jsonify(ok=False, error="Invalid ids"), 400
+        rows = store.get_files(file_ids)
+        if not rows:
+            return jsonify(ok=False, error="No files to export"), 404
+        if not all(row["id"] in client.cached_files for row in rows):
+            client.wait_ready()
+        resp = Response(iter_zip(client, rows), mimetype="application/zip")
+        resp.headers.set("Content-Disposition", "attachment", filename=time.strftime("telearchive-%Y%m%d-%H%M%S.zip"))
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+
     @app.post("/api/share/<int:file_id>/revoke")
     def revoke_share(file_id):
-        with store_lock:
-            row = store.get_file(file_id)
+        row = store.get_file(file_id)
         if not row:
             return jsonify(ok=False, error="File not found"), 404
-        with store_lock:
-            store.revoke_share_token(file_id)
+        store.revoke_share_token(file_id)
         return jsonify(ok=True)
 
     @app.get("/share/<token>")
@@ -189,89 +475,191 @@ def create_app():
         row = store.get_file_by_token(token)
         if not row:
             return "Invalid or expired link", 404
-        payload = client.download_file(row["id"], row["msg_ids"])
-        if isinstance(payload, bytearray):
-            payload = bytes(payload)
-        resp = send_file(
-            BytesIO(payload),
-            as_attachment=True,
-            download_name=row["file_name"],
-            mimetype="application/octet-stream",
-            max_age=0,
-            conditional=False,
-        )
-        resp.headers["Content-Length"] = str(len(payload))
+        return _send_download(client, row["id"], row)
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.get("/api/events")
+    def event_stream():
+        # One stream per browser tab carries every upload and download.
+        resp = Response(events.stream(), mimetype="text/event-stream")
         resp.headers["Cache-Control"] = "no-store"
+        resp.headers["X-Accel-Buffering"] = "no"
         return resp
 
     @app.get("/api/progress/<task_id>")
     def get_progress(task_id):
-        info = upload_progress.get(task_id)
+        info = uploads.status(task_id)
         if not info:
             return jsonify(ok=False, error="Task not found"), 404
-        return jsonify(
-            ok=True,
-            percent=info["percent"],
-            done=info["done"],
-            error=info.get("error"),
-        )
+        return jsonify(ok=True, **info)
 
     @app.post("/upload")
     def upload():
-        files = request.files.getlist("files")
-        if not files:
-            return jsonify(ok=False, error="No files provided"), 400
-        client_id = request.form.get("client_id")
-
-        def upload_worker(raw, safe_name, fh, task_id):
-            try:
-                def progress_cb(sent, total, tid=task_id):
-                    if total:
-                        upload_progress[tid]["percent"] = int((sent / total) * 100)
-
-                telegram_msgs = client.upload_file(
-                    BytesIO(raw),
-                    fh,
-                    safe_name,
-                    progress_cb=progress_cb,
-                )
-                msg_ids = [msg.id for msg in telegram_msgs]
-                with store_lock:
-                    store.add_file(safe_name, msg_ids, len(raw))
-                upload_progress[task_id]["percent"] = 100
-                upload_progress[task_id]["done"] = True
-            except Exception as exc:
-                upload_progress[task_id]["error"] = str(exc)
-                upload_progress[task_id]["done"] = True
-
+        boundary = request.mimetype_params.get("boundary")
+        if request.mimetype != "multipart/form-data" or not boundary:
+            return jsonify(ok=False, error="Expected a multipart/form-data body"), 400
+
+        # The body is parsed as it arrives. Each file is queued on its first
+        # bytes and written to a spool that its upload worker follows, so
+        # the file goes on to Telegram while the browser is still sending it.
+        # Fields only apply to files that come after them in the form.
+        form = {}
         tasks = []
-        for idx, file in enumerate(files):
-            raw = file.read()
-            if not raw:
-                continue
-            safe_name = secure_filename(file.filename) or f"upload_{int(time.time())}.bin"
-            fh = int(time.time() * 1000) + idx
-            task_id = uuid.uuid4().hex
-            upload_progress[task_id] = {"percent": 0, "done": False}
-            threading.Thread(
-                target=upload_worker,
-                args=(raw, safe_name, fh, task_id),
-                daemon=True,
-            ).start()
-            task = {"task_id": task_id, "name": safe_name}
-            if client_id:
-                task["client_id"] = client_id
-            tasks.append(task)
-
+        field = None
+        file_name = None
+        receiving = None
+        seen_files = False
+        try:
+            for event in _multipart_events(request.stream, boundary, request.max_form_parts):
+                if isinstance(event, Field):
+                    field = (event.name, bytearray())
+                    file_name = None
+                elif isinstance(event, File):
+                    field = None
+                    file_name = None
+                    if event.name == "files":
+                        seen_files = True
+                        file_name = secure_filename(event.filename) or f"upload_{int(time.time())}.bin"
+                elif field is not None:
+                    field[1].extend(event.data)
+                    limit = request.max_form_memory_size
+                    if limit is not None and len(field[1]) > limit:
+                        raise RequestEntityTooLarge()
+                    if not event.more_data:
+                        form[field[0]] = field[1].decode("utf-8", "replace")
+                        field = None
+                elif file_name is not None:
+                    if event.data and receiving is None:
+                        try:
+                            priority = int(form.get("priority", "0"))
+                        except ValueError:
+                            priority = 0
+                        task_id, spool = uploads.open_spool()
+                        uploads.submit(task_id, spool.path, file_name, 0, priority, receiving=True)
+                        receiving = task_id, spool
+                    if event.data:
+                        receiving[1].write(event.data)
+                    if not event.more_data:
+                        # Empty files never get a job.
+                        if receiving is not None:
+                            uploads.finish_receiving(*receiving)
+                            tasks.append({"task_id": receiving[0], "name": file_name})
+                        receiving = None
+                        file_name = None
+        except Exception as exc:
+            if receiving is not None:
+                receiving[1].abort("Upload request ended before the file was received")
+            if isinstance(exc, ValueError):
+                return jsonify(ok=False, error=f"Malformed upload: {exc}"), 400
+            raise
+
+        if not seen_files:
+            return jsonify(ok=False, error="No files provided"), 400
         if not tasks:
             return jsonify(ok=False, error="All provided files were empty"), 400
 
+        client_id = form.get("client_id")
+        if client_id:
+            for task in tasks:
+                task["client_id"] = client_id
         return jsonify(ok=True, count=len(tasks), tasks=tasks)
 
+    # Resumable uploads: the browser opens a session with the file's size,
+    # PUTs fixed-size chunks at their offsets (in any order, retrying or
+    # resuming from the session's received list as needed) and finishes it.
+    # Chunks are passed on to Telegram as soon as they join up with the
+    # start of the file.
+    def _upload_session(upload_id):
+        session = store.get_upload_session(upload_id)
+        spool = uploads.live.get(upload_id)
+        if not session or spool is None:
+            return None, None
+        return session, spool
+
+    @app.post("/api/uploads")
+    def create_upload():
+        body = request.get_json(silent=True) or {}
+        size = body.get("size")
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            return jsonify(ok=False, error="size must be a positive number of bytes"), 400
+        try:
+            priority = int(body.get("priority", 0))
+        except (TypeError, ValueError):
+            priority = 0
+        name = secure_filename(str(body.get("name") or "")) or f"upload_{int(time.time())}.bin"
+        # A client that hashed the file first needn't send content that is
+        # stored already. The hash is only the client's word, so it is never
+        # recorded for bytes the server receives; those are hashed as they
+        # arrive.
+        content_hash = body.get("sha256")
+        if content_hash is not None:
+            if not isinstance(content_hash, str) or not SHA256_HEX.fullmatch(content_hash):
+                return jsonify(ok=False, error="sha256 must be 64 lowercase hex digits"), 400
+            file_id = uploads.add_copy(name, size, content_hash)
+            if file_id is not None:
+                return jsonify(ok=True, deduplicated=True, file_id=file_id, name=name, size=size), 201
+        chunk_size = min(UPLOAD_CHUNK_BYTES, app.config.get("MAX_CONTENT_LENGTH") or UPLOAD_CHUNK_BYTES)
+        upload_id = uploads.open_session(name, size, chunk_size, priority)
+        return jsonify(ok=True, upload_id=upload_id, name=name, size=size, chunk_size=chunk_size, received=[]), 201
+
+    @app.get("/api/uploads/<upload_id>")
+    def get_upload(upload_id):
+        session, spool = _upload_session(upload_id)
+        if session is None:
+            return jsonify(ok=False, error="Upload not found"), 404
+        return jsonify(
+            ok=True,
+            upload_id=upload_id,
+            size=session["size_bytes"],
+            chunk_size=session["chunk_size"],
+            received=session["received"],
+            offset=spool.size,
+        )
+
+    @app.put("/api/uploads/<upload_id>")
+    def put_upload_chunk(upload_id):
+        session, spool = _upload_session(upload_id)
+        if session is None:
+            return jsonify(ok=False, error="Upload not found"), 404
+        size, chunk_size = session["size_bytes"], session["chunk_size"]
+        offset = request.args.get("offset", type=int)
+        if offset is None or offset < 0 or offset >= size or offset % chunk_size:
+            return jsonify(ok=False, error=f"offset must be a multiple of {chunk_size} below {size}"), 400
+        length = min(chunk_size, size - offset)
+        if request.content_length is None:
+            return jsonify(ok=False, error="Content-Length is required"), 411
+        if request.content_length != length:
+            return jsonify(ok=False, error=f"The chunk at {offset} is {length} bytes"), 400
+
+        pos = offset
+        try:
+            while pos < offset + length:
+                buf = request.stream.read(min(REQUEST_READ_BYTES, offset + length - pos))
+                if not buf:
+                    return jsonify(ok=False, error="Chunk ended early"), 400
+                spool.write_at(pos, buf)
+                pos += len(buf)
+        except UploadAborted as exc:
+            return jsonify(ok=False, error=str(exc)), 410
+        uploads.chunk_received(upload_id, offset // chunk_size)
+        return jsonify(ok=True, offset=spool.size)
+
+    @app.post("/api/uploads/<upload_id>/finish")
+    def finish_upload(upload_id):
+        session, spool = _upload_session(upload_id)
+        if session is None:
+            return jsonify(ok=False, error="Upload not found"), 404
+        if spool.size != session["size_bytes"]:
+            return jsonify(ok=False, error="Upload is missing chunks", received=session["received"]), 409
+        uploads.finish_receiving(upload_id, spool)
+        return jsonify(ok=True, task_id=upload_id)
+
     @app.post("/api/download/<int:file_id>/start")
     def start_download(file_id):
-        with store_lock:
-            row = store.get_file(file_id)
+        row = store.get_file(file_id)
         if not row:
             return jsonify(ok=False, error="File not found"), 404
 
@@ -292,24 +680,39 @@ def create_app():
                         percent = int((done_bytes / total_bytes) * 100)
                         with download_lock:
                             download_progress[file_id]["percent"] = max(0, min(100, percent))
+                    events.progress("download", file_id, done_bytes, total_bytes)
 
                 client.download_file(
                     file_id,
                     row["msg_ids"],
                     progress_cb=progress_cb,
                     total_size=row["size_bytes"],
+                    cipher=row["cipher"],
+                    codec=row["codec"],
+                    shards=row["shards"],
                 )
                 with download_lock:
                     download_progress[file_id]["percent"] = 100
                     download_progress[file_id]["done"] = True
+                events.publish("download", file_id, {"percent": 100}, done=True)
             except Exception as exc:
                 with download_lock:
                     download_progress[file_id]["error"] = str(exc)
                     download_progress[file_id]["done"] = True
+                events.publish("download", file_id, {"error": str(exc)}, done=True)
 
         threading.Thread(target=worker, daemon=True).start()
         return jsonify(ok=True, status="started")
 
+    @app.get("/api/sync")
+    def sync_status():
+        return jsonify(ok=True, running=channel_sync.running, last=channel_sync.last_result)
+
+    @app.post("/api/sync")
+    def start_sync():
+        channel_sync.trigger()
+        return jsonify(ok=True, status="started")
+
     @app.get("/api/download/<int:file_id>/status")
     def download_status(file_id):
         with download_lock:
@@ -320,38 +723,35 @@ def create_app():
 
     @app.get("/download/<int:file_id>")
     def download(file_id):
-        with store_lock:
-            row = store.get_file(file_id)
+        row = store.get_file(file_id)
         if not row:
             return "File not found", 404
-        payload = client.download_file(file_id, row["msg_ids"])
-        if isinstance(payload, bytearray):
-            payload = bytes(payload)
-        resp = send_file(
-            BytesIO(payload),
-            as_attachment=True,
-            download_name=row["file_name"],
-            mimetype="application/octet-stream",
-            max_age=0,
-            conditional=False,
-        )
-        resp.headers["Content-Length"] = str(len(payload))
-        resp.headers["Cache-Control"] = "no-store"
-        return resp
+        return _send_download(client, file_id, row)
 
     @app.post("/delete/<int:file_id>")
     def delete(file_id):
-        with store_lock:
-            msg_ids = store.delete_file(file_id)
-        if msg_ids is None:
+        # Before the row goes, or its messages would be left in the channel.
+        client.wait_ready()
+        removed = store.delete_file(file_id)
+        if removed is None:
             return jsonify(ok=False, error="File not found"), 404
-        client.delete_messages(msg_ids)
+        # Cached files are kept decrypted; none may outlive the file.
+        client.cached_files.pop(file_id)
+        msg_ids, shards = removed
+        if msg_ids:
+            client.delete_messages(msg_ids, shards)
         return jsonify(ok=True)
 
     return app
 
 
 def run_web():
+    # Telethon logs every packet at DEBUG, so keep it quiet unless asked.
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+        filename=os.getenv("LOG_FILE") or None,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
     app = create_app()
     host = os.getenv("WEB_HOST", "0.0.0.0")
     port = int(os.getenv("WEB_PORT", "5000"))
@@ -0,0 +1,67 @@
+import os
+import time
+import zipfile
+
+
+class _ZipSink:
+    """
+    Write-only file object zipfile writes the archive into. It has no
+    tell/seek, so zipfile streams: sizes and CRCs go in a data descriptor
+    after each member instead of being patched into its header.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _unique_name(name, used):
+    # Not a path inside the archive, and no two members with the same name.
+    name = name.replace("/", "_").replace("\\", "_").lstrip(".") or "file"
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate.lower() in used:
+        candidate = f"{stem} ({n}){ext}"
+        n += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def iter_zip(client, rows):
+    """
+    Yields a ZIP archive (stored, not compressed) of the files in ``rows``
+    (dicts as returned by WebStore.get_files). Each file is pulled from
+    Telegram or the cache while it is written, so nothing is held in memory
+    beyond the chunk in flight.
+    """
+    sink = _ZipSink()
+    used = set()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for row in rows:
+            info = zipfile.ZipInfo(_unique_name(row["file_name"], used), time.localtime(row["uploaded_at"])[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, "w", force_zip64=row["size_bytes"] >= zipfile.ZIP64_LIMIT) as member:
+                yield from sink.drain()
+                chunks = client.iter_file(
+                    row["id"],
+                    row["msg_ids"],
+                    total_size=row["size_bytes"],
+                    cipher=row["cipher"],
+                    codec=row["codec"],
+                    shards=row["shards"],
+                )
+                for chunk in chunks:
+                    member.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
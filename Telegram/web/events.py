@@ -0,0 +1,120 @@
+import json
+import queue
+import threading
+import time
+
+# Progress for one transfer is pushed at most this often; start and
+# completion events always go out.
+PROGRESS_INTERVAL_SECONDS = 0.25
+# Finished transfers stay in the snapshot sent to new subscribers this long.
+FINISHED_TTL_SECONDS = 60
+# Events a subscriber may fall behind by before it is dropped; the browser
+# reconnects and catches up from the snapshot.
+SUBSCRIBER_QUEUE_SIZE = 1000
+HEARTBEAT_SECONDS = 15
+
+
+class EventHub:
+    """
+    Fans progress events out to every open /api/events stream. Each
+    transfer is keyed by (kind, id); the hub keeps its latest state so a
+    stream that (re)connects starts with the current picture.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.latest = {}
+        self.last_emit = {}
+        self.last_prune = 0
+
+    def subscribe(self):
+        q = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        now = time.time()
+        with self.lock:
+            self._prune(now)
+            for event, data, _ in self.latest.values():
+                q.put_nowait((event, data))
+            self.subscribers.add(q)
+        return q
+
+    def _prune(self, now):
+        # Called with self.lock held.
+        self.last_prune = now
+        for key, (_, _, finished_at) in list(self.latest.items()):
+            if finished_at and now - finished_at > FINISHED_TTL_SECONDS:
+                del self.latest[key]
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, kind, key, data, done=False):
+        data = {**data, "id": key, "done": done}
+        now = time.time()
+        with self.lock:
+            # Without subscribers nothing else would ever drop finished
+            # transfers; a pass at most every TTL keeps publish cheap.
+            if now - self.last_prune > FINISHED_TTL_SECONDS:
+                self._prune(now)
+            self.latest[(kind, key)] = (kind, data, now if done else None)
+            if done:
+                self.last_emit.pop((kind, key), None)
+            for q in list(self.subscribers):
+                try:
+                    q.put_nowait((kind, data))
+                except queue.Full:
+                    self.subscribers.discard(q)
+                    _close(q)
+
+    def progress(self, kind, key, done_bytes, total_bytes, **extra):
+        """
+        Called from transfer progress callbacks; publishes percent, bytes
+        and a byte rate no more than every PROGRESS_INTERVAL_SECONDS.
+        """
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_emit.get((kind, key))
+            if last and now - last[0] < PROGRESS_INTERVAL_SECONDS:
+                return
+            self.last_emit[(kind, key)] = (now, done_bytes)
+        rate = 0
+        if last and now > last[0]:
+            rate = max(0, (done_bytes - last[1]) / (now - last[0]))
+        percent = int(done_bytes / total_bytes * 100) if total_bytes else 0
+        self.publish(kind, key, {
+            "percent": max(0, min(100, percent)),
+            "bytes": done_bytes,
+            "total": total_bytes,
+            "rate": int(rate),
+            **extra,
+        })
+
+    def stream(self):
+        """Yields a text/event-stream body until the client goes away."""
+        q = self.subscribe()
+        try:
+            yield "retry: 2000\n\n"
+            while True:
+                try:
+                    event, data = q.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Comments keep proxies from timing the stream out, and
+                    # writing is how a hung-up client gets noticed.
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    return
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(q)
+
+
+def _close(q):
+    # Make room for the sentinel that ends the subscriber's stream.
+    try:
+        while True:
+            q.get_nowait()
+    except queue.Empty:
+        pass
+    q.put_nowait((None, None))
@@ -0,0 +1,503 @@
+import hashlib
+import os
+import random
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from telethon.errors import FloodWaitError
+
+from Telegram.compression import SAMPLE_BYTES
+
+# Retry delays grow 5s, 10s, 20s, ... up to this cap.
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 10 * 60
+# How long finished jobs stay queryable through /api/progress.
+FINISHED_JOB_TTL_SECONDS = 60 * 60
+# A job following a file that is still arriving gives up its worker after
+# this long without new bytes, and is tried again later or on the next chunk.
+STALL_SECONDS = 60
+STALL_RETRY_SECONDS = 30
+# Resumable upload sessions with no new chunk for this long are dropped.
+SESSION_TTL_SECONDS = 24 * 60 * 60
+
+
+class UploadAborted(Exception):
+    """The request carrying a file ended before all of it arrived."""
+
+
+class UploadStalled(Exception):
+    """No new bytes of a file that is still arriving for STALL_SECONDS."""
+
+
+class LiveSpool:
+    """
+    A spool file still being written, either in order by the request that
+    carries it or chunk by chunk through the resumable upload API. Readers
+    follow the part written without gaps from the start, so the upload to
+    Telegram can start before the browser has sent the whole file; what
+    hasn't been sent on yet waits on disk, not in memory.
+    """
+
+    def __init__(self, path, expected_size=None, resume=False):
+        self.path = path
+        self.expected_size = expected_size
+        flags = os.O_RDWR if resume else os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(path, flags, 0o600)
+        self.writers = 0
+        self.closed = False
+        self.digest = hashlib.sha256()
+        # Bytes on disk from offset 0 with no gaps, and start -> end of the
+        # pieces written past the first gap.
+        self.size = 0
+        self.ranges = {}
+        self.complete = False
+        self.error = None
+        self.content_hash = None
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        """Appends ``data`` to what has been written in order so far."""
+        self.write_at(self.size, data)
+
+    def write_at(self, offset, data):
+        with self.cond:
+            if self.closed:
+                raise UploadAborted(self.error or "Upload is already complete")
+            self.writers += 1
+        try:
+            view = memoryview(data)
+            pos = offset
+            while view:
+                written = os.pwrite(self.fd, view, pos)
+                view = view[written:]
+                pos += written
+            self._written(offset, offset + len(data), data)
+        finally:
+            with self.cond:
+                self.writers -= 1
+                self._maybe_close()
+
+    def restore(self, ranges):
+        """Marks (start, end) ranges already on disk, after a restart."""
+        for start, end in ranges:
+            self._written(start, end)
+
+    def _written(self, start, end, data=None):
+        with self.cond:
+            if start > self.size:
+                self.ranges[start] = max(end, self.ranges.get(start, end))
+                return
+            if end > self.size:
+                if data is not None:
+                    self.digest.update(memoryview(data)[self.size - start:])
+                else:
+                    self._hash(self.size, end)
+                self.size = end
+            # Pull in the pieces that now join up with the prefix.
+            merged = True
+            while merged:
+                merged = False
+                for piece_start, piece_end in list(self.ranges.items()):
+                    if piece_start <= self.size:
+                        del self.ranges[piece_start]
+                        if piece_end > self.size:
+                            self._hash(self.size, piece_end)
+                            self.size = piece_end
+                            merged = True
+            self.cond.notify_all()
+
+    def _hash(self, start, end):
+        while start < end:
+            buf = os.pread(self.fd, min(end - start, 1024 * 1024), start)
+            if not buf:
+                raise UploadAborted("Spool file is shorter than what was received")
+            self.digest.update(buf)
+            start += len(buf)
+
+    def _maybe_close(self):
+        # The fd stays open while a write is in progress, so the number
+        # can't be reused under it.
+        if self.closed and not self.writers and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def finish(self):
+        with self.cond:
+            self.content_hash = self.digest.hexdigest()
+            self.complete = True
+            self.closed = True
+            self._maybe_close()
+            self.cond.notify_all()
+
+    def abort(self, error):
+        with self.cond:
+            self.error = error
+            self.closed = True
+            self._maybe_close()
+            self.cond.notify_all()
+
+    def wait_for(self, size, timeout=None):
+        """
+        Blocks until ``size`` bytes are on disk or the file is complete;
+        returns the size so far. Raises UploadStalled if nothing arrives
+        for ``timeout`` seconds.
+        """
+        with self.cond:
+            while not (self.size >= size or self.complete or self.error):
+                # Any write wakes us, in order or not, so a timeout means
+                # nothing at all arrived.
+                if not self.cond.wait(timeout):
+                    raise UploadStalled(f"No data received for {timeout:.0f}s")
+            if self.error:
+                raise UploadAborted(self.error)
+            return self.size
+
+    def reader(self):
+        return _SpoolReader(self)
+
+
+class _SpoolReader:
+    def __init__(self, spool):
+        self.spool = spool
+        self.file = open(spool.path, "rb")
+        self.pos = 0
+
+    def seekable(self):
+        return False
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            self.spool.wait_for(float("inf"), STALL_SECONDS)
+            data = self.file.read()
+        else:
+            available = self.spool.wait_for(self.pos + n, STALL_SECONDS) - self.pos
+            data = self.file.read(min(n, available))
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UploadScheduler:
+    """
+    Runs uploads from a queue stored in WebStore on a fixed pool of worker
+    threads. Each job's bytes are spooled to disk, so queued and interrupted
+    jobs survive a restart and failed ones can be retried. A job can start
+    while its spool is still being written (see LiveSpool).
+    """
+
+    def __init__(self, client, store, spool_dir, workers, max_attempts, events=None, prefetcher=None):
+        self.client = client
+        self.store = store
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.progress = {}
+        self.events = events
+        self.prefetcher = prefetcher
+        # LiveSpools of jobs whose file is still arriving, by job id, and
+        # the ones among them waiting for more bytes.
+        self.live = {}
+        self.stalled = set()
+        self.wakeup = threading.Condition()
+        # Bumped on every notify, so a worker that was between its claim and
+        # its wait when a job came in doesn't sleep through it.
+        self.wakeups = 0
+
+    def start(self):
+        for session in self.store.list_upload_sessions():
+            self._resume_session(session)
+        for path in self.store.fail_receiving_upload_jobs("Upload interrupted before the file was received"):
+            self._drop_spool({"spool_path": path})
+        self.store.requeue_running_upload_jobs()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"upload-worker-{i}", daemon=True).start()
+
+    def new_spool(self):
+        """Returns (job_id, path) for a caller to write the upload's bytes to."""
+        job_id = uuid.uuid4().hex
+        return job_id, self.spool_dir / f"{job_id}.upload"
+
+    def open_spool(self):
+        """
+        Returns (job_id, LiveSpool) for a file that is still arriving; it can
+        be submitted straight away with receiving=True.
+        """
+        job_id, path = self.new_spool()
+        spool = self.live[job_id] = LiveSpool(path)
+        return job_id, spool
+
+    def submit(self, job_id, spool_path, file_name, size_bytes, priority=0, content_hash=None, receiving=False):
+        self.store.add_upload_job(job_id, file_name, str(spool_path), size_bytes, priority, content_hash, receiving)
+        self._queued(job_id, None if receiving else size_bytes)
+
+    def _queued(self, job_id, size_bytes):
+        self.progress[job_id] = 0
+        self._emit(job_id, status="queued", percent=0, total=size_bytes)
+        with self.wakeup:
+            self.wakeups += 1
+            self.wakeup.notify()
+
+    def finish_receiving(self, job_id, spool):
+        spool.finish()
+        with self.store.transaction():
+            self.store.finish_receiving_upload_job(job_id, spool.size, spool.content_hash)
+            self.store.delete_upload_session(job_id)
+        self._wake(job_id)
+
+    def open_session(self, file_name, size_bytes, chunk_size, priority=0):
+        """
+        Starts a resumable upload of ``size_bytes`` that arrives in
+        ``chunk_size`` chunks, in any order; returns its job id. The job
+        starts sending to Telegram as soon as the first chunk is in.
+        """
+        job_id, path = self.new_spool()
+        # In place before the row is, or a worker claiming the job right
+        # away would read it as a finished spool (see open_spool).
+        self.live[job_id] = LiveSpool(path, expected_size=size_bytes)
+        with self.store.transaction():
+            self.store.add_upload_job(job_id, file_name, str(path), size_bytes, priority, receiving=True)
+            self.store.add_upload_session(job_id, size_bytes, chunk_size)
+        self._queued(job_id, size_bytes)
+        return job_id
+
+    def chunk_received(self, job_id, chunk_index):
+        self.store.add_upload_session_chunk(job_id, chunk_index)
+        self._wake(job_id)
+
+    def _wake(self, job_id):
+        if job_id in self.stalled:
+            self.stalled.discard(job_id)
+            self.store.wake_upload_job(job_id, time.time())
+            with self.wakeup:
+                self.wakeups += 1
+                self.wakeup.notify()
+
+    def _resume_session(self, session):
+        job_id, size, chunk_size = session["job_id"], session["size_bytes"], session["chunk_size"]
+        try:
+            spool = LiveSpool(session["spool_path"], expected_size=size, resume=True)
+            spool.restore((i * chunk_size, min(size, (i + 1) * chunk_size)) for i in session["received"])
+        except (OSError, UploadAborted) as exc:
+            print(f"UPLOAD SESSION LOST {job_id}: {exc}")
+            # Without its session the job is failed like any half-received one.
+            self.store.delete_upload_session(job_id)
+            return
+        self.live[job_id] = spool
+
+    def _emit(self, job_id, done=False, **data):
+        if self.events:
+            self.events.publish("upload", job_id, data, done=done)
+
+    def status(self, job_id):
+        job = self.store.get_upload_job(job_id)
+        if not job:
+            return None
+        done = job["status"] in ("done", "failed")
+        return {
+            "percent": 100 if job["status"] == "done" else self.progress.get(job_id, 0),
+            "done": done,
+            "status": job["status"],
+            "attempts": job["attempts"],
+            # Errors from attempts that will be retried aren't final.
+            "error": job["error"] if job["status"] == "failed" else None,
+            "file_id": job["file_id"],
+        }
+
+    def _worker(self):
+        # Jobs are accepted and spooled while Telegram connects; they are
+        # only picked up once it's there, so the wait isn't a failed attempt.
+        self.client.wait_ready(None)
+        last_purge = 0
+        while True:
+            now = time.time()
+            if now - last_purge > 60:
+                self._purge(now)
+                last_purge = now
+            with self.wakeup:
+                seen = self.wakeups
+            job = self.store.claim_upload_job(now)
+            next_at = None if job else self.store.next_upload_attempt_at()
+            if job is None:
+                timeout = 30 if next_at is None else min(30, max(0.1, next_at - now))
+                with self.wakeup:
+                    self.wakeup.wait_for(lambda: self.wakeups != seen, timeout)
+                continue
+            self._run_job(job)
+
+    def _run_job(self, job):
+        job_id = job["id"]
+        live = self.live.get(job_id)
+        size, content_hash = job["size_bytes"], job["content_hash"]
+        if live is not None and live.complete:
+            size, content_hash = live.size, live.content_hash
+
+        def progress_cb(sent, total):
+            if not total and live is not None and live.complete:
+                total = live.size
+            if total:
+                self.progress[job_id] = int((sent / total) * 100)
+            if self.events:
+                self.events.progress("upload", job_id, sent, total, status="running")
+
+        try:
+            # Same bytes already in the channel: point at those messages.
+            file_id, _ = self._add_file(job["file_name"], job_id, size, content_hash)
+            if file_id is None:
+                if live is not None:
+                    live.wait_for(min(SAMPLE_BYTES, live.expected_size or SAMPLE_BYTES), STALL_SECONDS)
+                with open(job["spool_path"], "rb") as head:
+                    codec = self.client.probe_codec(head)
+                if live is not None and not live.complete:
+                    # Still arriving: follow the spool as it is written. The
+                    # size stays open so the last part waits for the file
+                    # to be complete, even if the size was announced.
+                    spool, file_size = live.reader(), None
+                else:
+                    # The file may have been completed while we waited above.
+                    file_size = live.size if live is not None else size
+                    spool = open(job["spool_path"], "rb")
+                with spool:
+                    docs = self.client.upload_file(
+                        spool,
+                        job["file_name"],
+                        progress_cb=progress_cb,
+                        file_size=file_size,
+                        codec=codec,
+                    )
+                sent = {
+                    "msg_ids": [doc.msg_id for doc in docs],
+                    "cipher": self.client.upload_cipher,
+                    "codec": codec,
+                    "shards": [doc.shard for doc in docs],
+                }
+                if live is not None:
+                    size, content_hash = live.size, live.content_hash
+                # Streamed files are only hashed once they are all in, so the
+                # content may turn out to be stored already; then the copy
+                # just sent is removed again.
+                file_id, duplicate = self._add_file(job["file_name"], job_id, size, content_hash, sent)
+                if duplicate:
+                    self._delete_sent(job_id, sent)
+            self.progress.pop(job_id, None)
+            self.live.pop(job_id, None)
+            if self.prefetcher is not None:
+                # The spool is the plaintext of what was just stored, so it
+                # can go straight into the cache before it is dropped.
+                try:
+                    self.prefetcher.uploaded(file_id, job["spool_path"], size)
+                except Exception as exc:
+                    print(f"PREFETCH: upload {job_id} not cached: {exc}")
+            self._drop_spool(job)
+            self._emit(job_id, done=True, status="done", percent=100, file_id=file_id)
+        except FloodWaitError as exc:
+            # Telegram told us exactly how long to back off; not the job's fault.
+            print(f"FLOOD WAIT {exc.seconds}s on upload {job_id}")
+            self.progress[job_id] = 0
+            self.store.retry_upload_job(job_id, job["attempts"], time.time() + exc.seconds, str(exc))
+            self._emit(job_id, status="queued", percent=0, attempts=job["attempts"])
+        except UploadStalled as exc:
+            # The sender went quiet; free the worker until more bytes arrive.
+            print(f"UPLOAD WAITING {job_id}: {exc}")
+            self.progress[job_id] = 0
+            self.stalled.add(job_id)
+            self.store.retry_upload_job(job_id, job["attempts"], time.time() + STALL_RETRY_SECONDS, str(exc))
+            self._emit(job_id, status="queued", percent=0, attempts=job["attempts"])
+        except Exception as exc:
+            attempts = job["attempts"] + 1
+            self.progress[job_id] = 0
+            if attempts >= self.max_attempts or isinstance(exc, (FileNotFoundError, UploadAborted)):
+                print(f"UPLOAD FAILED {job_id}: {exc}")
+                self.store.finish_upload_job(job_id, "failed", error=str(exc))
+                self.progress.pop(job_id, None)
+                live = self.live.pop(job_id, None)
+                if live is not None and not live.complete:
+                    live.abort(str(exc))
+                    self.store.delete_upload_session(job_id)
+                self._drop_spool(job)
+                self._emit(job_id, done=True, status="failed", error=str(exc), attempts=attempts)
+                return
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            delay *= random.uniform(0.8, 1.2)
+            print(f"UPLOAD RETRY {job_id} in {delay:.0f}s ({attempts}/{self.max_attempts}): {exc}")
+            self.store.retry_upload_job(job_id, attempts, time.time() + delay, str(exc))
+            self._emit(job_id, status="queued", percent=0, attempts=attempts)
+
+    def add_copy(self, file_name, size_bytes, content_hash):
+        """
+        Adds ``file_name`` as a copy of a file already stored with this
+        content, for a client that hashed the file before sending it.
+        Returns the new file id, or None when there is no such file.
+        """
+        file_id, _ = self._add_file(file_name, None, size_bytes, content_hash)
+        return file_id
+
+    def _add_file(self, file_name, job_id, size, content_hash, sent=None):
+        """
+        Adds the file row, and finishes job ``job_id`` if there is one. A
+        file already stored with the same content is pointed at instead of
+        ``sent`` (what the job stored, as find_file_by_hash returns it); with
+        neither, nothing is added. The lookup and the insert share a
+        transaction, so a concurrent delete can't remove the matched
+        messages in between. Returns (file_id or None, whether an existing
+        copy was used).
+        """
+        with self.store.transaction():
+            existing = None
+            if content_hash:
+                existing = self.store.find_file_by_hash(content_hash, size, self.client.upload_cipher)
+            stored = existing or sent
+            if stored is None:
+                return None, False
+            file_id = self.store.add_file(
+                file_name,
+                stored["msg_ids"],
+                size,
+                cipher=stored["cipher"],
+                content_hash=content_hash,
+                codec=stored["codec"],
+                shards=stored["shards"],
+            )
+            if job_id is not None:
+                self.store.finish_upload_job(job_id, "done", file_id=file_id)
+        if existing is not None:
+            print(f"DEDUPLICATED {file_name}")
+        return file_id, existing is not None
+
+    def _delete_sent(self, job_id, sent):
+        # The row already points at the existing copy; a failure here only
+        # leaves unused messages in the channel.
+        try:
+            self.client.delete_messages(sent["msg_ids"], sent["shards"])
+        except Exception as exc:
+            print(f"UPLOAD {job_id}: could not delete duplicate messages {sent['msg_ids']}: {exc}")
+
+    def _drop_spool(self, job):
+        try:
+            os.remove(job["spool_path"])
+        except FileNotFoundError:
+            pass
+
+    def _purge(self, now):
+        purged = self.store.purge_upload_jobs(now - FINISHED_JOB_TTL_SECONDS)
+        for job_id in purged:
+            self.progress.pop(job_id, None)
+        error = "Upload session expired before the file was received"
+        for job_id, spool_path in self.store.expire_upload_sessions(now - SESSION_TTL_SECONDS, error):
+            print(f"UPLOAD SESSION EXPIRED {job_id}")
+            live = self.live.pop(job_id, None)
+            if live is not None:
+                live.abort(error)
+            self.progress.pop(job_id, None)
+            self._drop_spool({"spool_path": spool_path})
+            self._emit(job_id, done=True, status="failed", error=error)
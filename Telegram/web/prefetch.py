@@ -0,0 +1,95 @@
+import queue
+import threading
+
+from Telegram.metrics import Counter
+
+PREFETCH_BYTES = Counter("telearchive_prefetch_bytes_total", "Bytes put in the download cache ahead of a request", ["source"])
+
+
+class Prefetcher:
+    """
+    Warms the download cache before anyone asks for a file. Uploads are
+    written through from their spool as they finish; files that get a share
+    link, and the ``recent_files`` newest uploads, are fetched from Telegram
+    by one background thread, so prefetching never takes more than one
+    transfer's worth of bandwidth from real downloads. No file larger than
+    ``max_bytes`` is cached this way, and recent files that would take the
+    total of the ones warmed past it are skipped.
+    """
+
+    def __init__(self, client, store, max_bytes, recent_files):
+        self.client = client
+        self.store = store
+        # Prefetching more than the cache holds would only evict itself.
+        self.max_bytes = min(max_bytes, client.cached_files.maxsize)
+        self.recent_files = recent_files
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = set()
+
+    def start(self):
+        if self.max_bytes <= 0:
+            return
+        threading.Thread(target=self._worker, name="prefetch", daemon=True).start()
+        self.warm_recent()
+
+    def uploaded(self, file_id, path, size):
+        """Called with the plaintext spool of an upload that just finished."""
+        if 0 < size <= self.max_bytes:
+            try:
+                self.client.cache_upload(file_id, path)
+                PREFETCH_BYTES.inc(size, source="upload")
+            except OSError as exc:
+                print(f"PREFETCH: could not cache upload {file_id}: {exc}")
+        self.warm_recent()
+
+    def shared(self, file_id):
+        self._enqueue(file_id)
+
+    def warm_recent(self):
+        if self.max_bytes <= 0 or self.recent_files <= 0:
+            return
+        total = 0
+        for file_id, _, size, _, _ in self.store.list_files(self.recent_files, "date", "desc"):
+            if total + size > self.max_bytes:
+                continue
+            total += size
+            self._enqueue(file_id)
+
+    def _enqueue(self, file_id):
+        if self.max_bytes <= 0:
+            return
+        with self.lock:
+            if file_id in self.queued:
+                return
+            self.queued.add(file_id)
+        self.queue.put(file_id)
+
+    def _worker(self):
+        self.client.wait_ready(None)
+        while True:
+            file_id = self.queue.get()
+            try:
+                self._prefetch(file_id)
+            except Exception as exc:
+                print(f"PREFETCH FAILED {file_id}: {exc}")
+            finally:
+                with self.lock:
+                    self.queued.discard(file_id)
+
+    def _prefetch(self, file_id):
+        if file_id in self.client.cached_files:
+            return
+        row = self.store.get_file(file_id)
+        if not row or not 0 < row["size_bytes"] <= self.max_bytes:
+            return
+        self.client.download_file(
+            file_id,
+            row["msg_ids"],
+            progress_cb=lambda done, total: None,
+            total_size=row["size_bytes"],
+            cipher=row["cipher"],
+            codec=row["codec"],
+            shards=row["shards"],
+        )
+        PREFETCH_BYTES.inc(row["size_bytes"], source="telegram")
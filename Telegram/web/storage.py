@@ -1,13 +1,53 @@
 ﻿import json
 import sqlite3
+import threading
 import time
+from contextlib import contextmanager
+
+from Telegram.metrics import Histogram
+from Telegram.transfer import TelegramDocument
+
+# list_files sort keys: column expression and its index in the returned rows
+SORT_COLUMNS = {
+    "date": ("w.uploaded_at", 3),
+    "size": ("w.size_bytes", 2),
+    "name": ("w.file_name COLLATE NOCASE", 1),
+}
+# The trigram tokenizer can only match queries of at least 3 characters.
+FTS_MIN_QUERY = 3
+# Ids per "IN (...)" query, well under SQLite's bound parameter limit.
+IN_BATCH = 500
+
+SQLITE_SECONDS = Histogram(
+    "telearchive_sqlite_seconds",
+    "Time WebStore calls hold a database connection, transactions included",
+)
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
 
 
 class WebStore:
-    def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute(
+    """
+    SQLite catalog for the web UI. Connections come from a small pool and
+    the database runs in WAL mode, so listing files never waits on a writer
+    and writers only wait on each other. Writes that belong together go
+    through ``transaction()`` and are committed once.
+    """
+
+    def __init__(self, db_path, pool_size=8):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._local = threading.local()
+        self.fts = True
+        with self.transaction() as conn:
+            self._create_schema(conn)
+
+    def _create_schema(self, conn):
+        conn.execute(
             """
             CREATE TABLE IF NOT EXISTS web_files (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -18,7 +58,7 @@ class WebStore:
             )
             """
         )
-        self.cursor.execute(
+        conn.execute(
             """
             CREATE TABLE IF NOT EXISTS share_tokens (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -28,7 +68,7 @@ class WebStore:
             )
             """
         )
-        self.cursor.execute(
+        conn.execute(
             """
             CREATE TABLE IF NOT EXISTS auth_config (
                 key TEXT PRIMARY KEY,
@@ -36,48 +76,263 @@ class WebStore:
             )
             """
         )
-        self.conn.commit()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                id TEXT PRIMARY KEY,
+                file_name TEXT NOT NULL,
+                spool_path TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                error TEXT,
+                file_id INTEGER,
+                created_at REAL NOT NULL,
+                finished_at REAL
+            )
+            """
+        )
+        # Resumable uploads: one row per upload job whose chunks are still
+        # arriving, plus the chunks received so far.
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                job_id TEXT PRIMARY KEY,
+                size_bytes INTEGER NOT NULL,
+                chunk_size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upload_session_chunks (
+                job_id TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                PRIMARY KEY (job_id, chunk_index)
+            ) WITHOUT ROWID
+            """
+        )
+        # Document locations of the _partN messages, so downloads can skip
+        # fetching the messages; filled at upload or on first download.
+        # Message ids are per channel, so the key includes the account
+        # (shard) that sent the message. Tables from before that are only a
+        # cache, and are dropped rather than migrated.
+        documents = [row[1] for row in conn.execute("PRAGMA table_info(telegram_documents)")]
+        if documents and "shard" not in documents:
+            conn.execute("DROP TABLE telegram_documents")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS telegram_documents (
+                shard INTEGER NOT NULL,
+                msg_id INTEGER NOT NULL,
+                document_id INTEGER NOT NULL,
+                access_hash INTEGER NOT NULL,
+                file_reference BLOB NOT NULL,
+                dc_id INTEGER NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                PRIMARY KEY (shard, msg_id)
+            ) WITHOUT ROWID
+            """
+        )
+        # NULL cipher marks rows from before this column: Fernet if ENCRYPTION_KEY is set.
+        self._add_column(conn, "web_files", "cipher", "TEXT")
+        self._add_column(conn, "web_files", "content_hash", "TEXT")
+        self._add_column(conn, "upload_jobs", "content_hash", "TEXT")
+        # 1 while the request carrying the file is still writing its spool.
+        self._add_column(conn, "upload_jobs", "receiving", "INTEGER NOT NULL DEFAULT 0")
+        # NULL codec means the stored bytes aren't compressed.
+        self._add_column(conn, "web_files", "codec", "TEXT")
+        # JSON list of the account each msg_ids entry was sent with; NULL
+        # when they are all on the first one.
+        self._add_column(conn, "web_files", "shards", "TEXT")
+        for name, table, columns in (
+            ("idx_web_files_content_hash", "web_files", "content_hash"),
+            ("idx_web_files_uploaded_at", "web_files", "uploaded_at"),
+            ("idx_web_files_size_bytes", "web_files", "size_bytes"),
+            ("idx_web_files_file_name", "web_files", "file_name COLLATE NOCASE"),
+            ("idx_web_files_msg_ids", "web_files", "msg_ids"),
+            ("idx_share_tokens_file_id", "share_tokens", "file_id"),
+            ("idx_upload_jobs_runnable", "upload_jobs", "status, priority DESC, created_at"),
+        ):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+        self._create_search_index(conn)
 
-    def list_files(self, limit, sort_key, sort_dir, query=None):
-        if sort_key == "size":
-            order_by = "w.size_bytes"
-        elif sort_key == "name":
-            order_by = "w.file_name COLLATE NOCASE"
-        else:
-            order_by = "w.uploaded_at"
+    def _create_search_index(self, conn):
+        # Substring search over file names. Kept in sync by triggers; SQLite
+        # builds without FTS5 or the trigram tokenizer fall back to LIKE.
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='web_files_fts'"
+        ).fetchone()
+        try:
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS web_files_fts USING fts5(
+                    file_name, content='web_files', content_rowid='id', tokenize='trigram'
+                )
+                """
+            )
+        except sqlite3.OperationalError as exc:
+            print(f"Filename search index unavailable ({exc}); using LIKE")
+            self.fts = False
+            return
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS web_files_fts_insert AFTER INSERT ON web_files BEGIN
+                INSERT INTO web_files_fts (rowid, file_name) VALUES (new.id, new.file_name);
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS web_files_fts_delete AFTER DELETE ON web_files BEGIN
+                INSERT INTO web_files_fts (web_files_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name);
+            END
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS web_files_fts_update AFTER UPDATE OF file_name ON web_files BEGIN
+                INSERT INTO web_files_fts (web_files_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name);
+                INSERT INTO web_files_fts (rowid, file_name) VALUES (new.id, new.file_name);
+            END
+            """
+        )
+        if not exists:
+            conn.execute("INSERT INTO web_files_fts (web_files_fts) VALUES ('rebuild')")
+
+    def _add_column(self, conn, table, column, decl):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+    def _open(self):
+        # Autocommit mode: single statements commit on their own, and
+        # transaction() issues BEGIN/COMMIT explicitly.
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=30,
+            cached_statements=256,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            # Inside transaction() on this thread: use its connection.
+            yield conn
+            return
+        with self._idle_lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        started = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            SQLITE_SECONDS.observe(time.perf_counter() - started)
+            with self._idle_lock:
+                if len(self._idle) < self.pool_size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the enclosed store calls as one write transaction with a single
+        commit. Nested use joins the outer transaction.
+        """
+        if getattr(self._local, "conn", None) is not None:
+            yield self._local.conn
+            return
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self._local.conn = None
+
+    def list_files(self, limit, sort_key, sort_dir, query=None, after=None):
+        """
+        Returns up to ``limit`` rows of (id, file_name, size_bytes,
+        uploaded_at, share token). ``after`` is the (sort value, id) of the
+        last row of the previous page; pages are found by seeking the sort
+        index rather than with OFFSET, so deep pages cost the same as the
+        first one.
+        """
+        order_by, _ = SORT_COLUMNS.get(sort_key, SORT_COLUMNS["date"])
         direction = "ASC" if sort_dir == "asc" else "DESC"
 
-        where = ""
+        conditions = []
         params = []
         if query:
-            where = "WHERE w.file_name LIKE ? ESCAPE '\\'"
-            params.append(f"%{query}%")
+            if self.fts and len(query) >= FTS_MIN_QUERY:
+                conditions.append("w.id IN (SELECT rowid FROM web_files_fts WHERE web_files_fts MATCH ?)")
+                params.append('"' + query.replace('"', '""') + '"')
+            else:
+                conditions.append("w.file_name LIKE ? ESCAPE '\\'")
+                params.append(f"%{_escape_like(query)}%")
+        if after is not None:
+            conditions.append(f"({order_by}, w.id) {'>' if direction == 'ASC' else '<'} (?, ?)")
+            params.extend(after)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
 
         sql = f"""
             SELECT w.id, w.file_name, w.size_bytes, w.uploaded_at, s.token
             FROM web_files w
             LEFT JOIN share_tokens s ON s.file_id = w.id
             {where}
-            ORDER BY {order_by} {direction}
+            ORDER BY {order_by} {direction}, w.id {direction}
             LIMIT ?
         """
         params.append(limit)
-        rows = self.cursor.execute(sql, tuple(params)).fetchall()
-        return rows
+        with self._connection() as conn:
+            return conn.execute(sql, tuple(params)).fetchall()
 
-    def add_file(self, file_name, msg_ids, size_bytes):
-        self.cursor.execute(
-            "INSERT INTO web_files (file_name, msg_ids, size_bytes, uploaded_at) VALUES (?, ?, ?, ?)",
-            (file_name, json.dumps(msg_ids), size_bytes, int(time.time())),
-        )
-        self.conn.commit()
+    def add_file(
+        self, file_name, msg_ids, size_bytes, cipher=None, content_hash=None, codec=None, shards=None, uploaded_at=None
+    ):
+        with self._connection() as conn:
+            cur = conn.execute(
+                """
+                INSERT INTO web_files (file_name, msg_ids, size_bytes, uploaded_at, cipher, content_hash, codec, shards)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    file_name,
+                    json.dumps(msg_ids),
+                    size_bytes,
+                    int(time.time()) if uploaded_at is None else uploaded_at,
+                    cipher,
+                    content_hash,
+                    codec,
+                    json.dumps(shards) if shards and any(shards) else None,
+                ),
+            )
+            return cur.lastrowid
 
     def get_file(self, file_id):
-        row = self.cursor.execute(
-            "SELECT file_name, msg_ids, size_bytes, uploaded_at FROM web_files WHERE id=?",
-            (file_id,),
-        ).fetchone()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT file_name, msg_ids, size_bytes, uploaded_at, cipher, codec, shards FROM web_files WHERE id=?",
+                (file_id,),
+            ).fetchone()
         if not row:
             return None
         return {
@@ -85,41 +340,202 @@ class WebStore:
             "msg_ids": json.loads(row[1]),
             "size_bytes": row[2],
             "uploaded_at": row[3],
+            "cipher": row[4],
+            "codec": row[5],
+            "shards": json.loads(row[6]) if row[6] else None,
         }
 
-    def delete_file(self, file_id):
-        row = self.cursor.execute(
-            "SELECT msg_ids FROM web_files WHERE id=?",
-            (file_id,),
-        ).fetchone()
+    def get_files(self, file_ids):
+        """
+        Like get_file for many files at once: a list of dicts, which also
+        carry the "id", in the order of ``file_ids``. Missing files are left
+        out.
+        """
+        file_ids = list(dict.fromkeys(file_ids))
+        found = {}
+        with self._connection() as conn:
+            for i in range(0, len(file_ids), IN_BATCH):
+                batch = file_ids[i:i + IN_BATCH]
+                rows = conn.execute(
+                    f"""
+                    SELECT id, file_name, msg_ids, size_bytes, uploaded_at, cipher, codec, shards
+                    FROM web_files WHERE id IN ({",".join("?" * len(batch))})
+                    """,
+                    batch,
+                ).fetchall()
+                for row in rows:
+                    found[row[0]] = {
+                        "id": row[0],
+                        "file_name": row[1],
+                        "msg_ids": json.loads(row[2]),
+                        "size_bytes": row[3],
+                        "uploaded_at": row[4],
+                        "cipher": row[5],
+                        "codec": row[6],
+                        "shards": json.loads(row[7]) if row[7] else None,
+                    }
+        return [found[file_id] for file_id in file_ids if file_id in found]
+
+    def search_file_ids(self, sort_key, sort_dir, query=None):
+        """Ids of every file list_files would return for ``query``, in the same order."""
+        file_ids = []
+        after = None
+        while True:
+            rows = self.list_files(IN_BATCH, sort_key, sort_dir, query=query, after=after)
+            file_ids.extend(row[0] for row in rows)
+            if len(rows) < IN_BATCH:
+                return file_ids
+            after = (rows[-1][SORT_COLUMNS.get(sort_key, SORT_COLUMNS["date"])[1]], rows[-1][0])
+
+    def file_parts(self):
+        """(shard, msg_id) of every _partN message a file points at."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT COALESCE(json_extract(w.shards, '$[' || m.key || ']'), 0), m.value
+                FROM web_files w, json_each(w.msg_ids) m
+                """
+            ).fetchall()
+        return set(rows)
+
+    def find_file_by_hash(self, content_hash, size_bytes, cipher):
+        """
+        The first file stored with this content and ``cipher``, or None. The
+        cipher has to match, so an upload made with ENCRYPTION_KEY set never
+        ends up pointing at plaintext messages, nor the other way round.
+        """
+        with self._connection() as conn:
+            row = conn.execute(
+                """
+                SELECT msg_ids, cipher, codec, shards FROM web_files
+                WHERE content_hash=? AND size_bytes=? AND cipher=?
+                ORDER BY id ASC
+                LIMIT 1
+                """,
+                (content_hash, size_bytes, cipher),
+            ).fetchone()
         if not row:
             return None
-        msg_ids = json.loads(row[0])
-        self.cursor.execute("DELETE FROM web_files WHERE id=?", (file_id,))
-        self.conn.commit()
-        return msg_ids
+        return {
+            "msg_ids": json.loads(row[0]),
+            "cipher": row[1],
+            "codec": row[2],
+            "shards": json.loads(row[3]) if row[3] else None,
+        }
+
+    def delete_file(self, file_id):
+        """
+        Removes the row and returns (msg_ids, shards) of the Telegram
+        messages no longer referenced by any file: no ids while
+        deduplicated copies of the same content remain, None if the file
+        doesn't exist.
+        """
+        return self.delete_files([file_id]).get(file_id)
+
+    def delete_files(self, file_ids):
+        """
+        delete_file for many files in one transaction: returns
+        {file_id: (msg_ids, shards)} for the files that existed. A message
+        is only returned once no remaining file points at it, whether that
+        file is a deduplicated copy or shares just some of its messages.
+        """
+        freed = {}
+        with self.transaction() as conn:
+            for file_id in dict.fromkeys(file_ids):
+                row = conn.execute(
+                    "SELECT msg_ids, shards FROM web_files WHERE id=?",
+                    (file_id,),
+                ).fetchone()
+                if not row:
+                    continue
+                msg_ids = json.loads(row[0])
+                shards = json.loads(row[1]) if row[1] else None
+                conn.execute("DELETE FROM web_files WHERE id=?", (file_id,))
+                freed[file_id] = (list(zip(shards or [0] * len(msg_ids), msg_ids)), shards is not None)
+
+            still_used = self._referenced_parts(conn, {ref for refs, _ in freed.values() for ref in refs})
+            removed = {}
+            for file_id, (refs, sharded) in freed.items():
+                # Two of the deleted files may share messages; each goes once.
+                refs = [ref for ref in refs if ref not in still_used]
+                still_used.update(refs)
+                conn.executemany("DELETE FROM telegram_documents WHERE shard=? AND msg_id=?", refs)
+                removed[file_id] = ([msg_id for _, msg_id in refs], [shard for shard, _ in refs] if sharded else None)
+        return removed
+
+    def _referenced_parts(self, conn, refs):
+        """The (shard, msg_id) pairs among ``refs`` some file still points at."""
+        msg_ids = sorted({msg_id for _, msg_id in refs})
+        found = set()
+        for i in range(0, len(msg_ids), IN_BATCH):
+            batch = msg_ids[i:i + IN_BATCH]
+            found.update(
+                conn.execute(
+                    f"""
+                    SELECT COALESCE(json_extract(w.shards, '$[' || m.key || ']'), 0), m.value
+                    FROM web_files w, json_each(w.msg_ids) m
+                    WHERE m.value IN ({",".join("?" * len(batch))})
+                    """,
+                    batch,
+                ).fetchall()
+            )
+        return found & set(refs)
+
+    def get_documents(self, refs):
+        """
+        Returns {(shard, msg_id): TelegramDocument} for the messages whose
+        location is known.
+        """
+        refs = list(refs)
+        if not refs:
+            return {}
+        with self._connection() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT msg_id, document_id, access_hash, file_reference, dc_id, size_bytes, shard
+                FROM telegram_documents
+                WHERE (shard, msg_id) IN (VALUES {",".join(["(?, ?)"] * len(refs))})
+                """,
+                [value for ref in refs for value in ref],
+            ).fetchall()
+        return {
+            (row[6], row[0]): TelegramDocument(row[0], row[1], row[2], bytes(row[3]), row[4], row[5], row[6])
+            for row in rows
+        }
+
+    def save_documents(self, documents):
+        with self._connection() as conn:
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO telegram_documents
+                    (shard, msg_id, document_id, access_hash, file_reference, dc_id, size_bytes)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [(d.shard, d.msg_id, d.id, d.access_hash, d.file_reference, d.dc_id, d.size) for d in documents],
+            )
 
     def revoke_share_token(self, file_id):
-        self.cursor.execute("DELETE FROM share_tokens WHERE file_id=?", (file_id,))
-        self.conn.commit()
+        with self._connection() as conn:
+            conn.execute("DELETE FROM share_tokens WHERE file_id=?", (file_id,))
 
     def create_share_token(self, file_id, token, created_at):
-        self.cursor.execute(
-            "INSERT INTO share_tokens (file_id, token, created_at) VALUES (?, ?, ?)",
-            (file_id, token, created_at),
-        )
-        self.conn.commit()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO share_tokens (file_id, token, created_at) VALUES (?, ?, ?)",
+                (file_id, token, created_at),
+            )
 
     def get_file_by_token(self, token):
-        row = self.cursor.execute(
-            """
-            SELECT w.id, w.file_name, w.msg_ids, w.size_bytes, w.uploaded_at
-            FROM share_tokens s
-            JOIN web_files w ON w.id = s.file_id
-            WHERE s.token = ?
-            """,
-            (token,),
-        ).fetchone()
+        with self._connection() as conn:
+            row = conn.execute(
+                """
+                SELECT w.id, w.file_name, w.msg_ids, w.size_bytes, w.uploaded_at, w.cipher, w.codec, w.shards
+                FROM share_tokens s
+                JOIN web_files w ON w.id = s.file_id
+                WHERE s.token = ?
+                """,
+                (token,),
+            ).fetchone()
         if not row:
             return None
         return {
@@ -128,20 +544,244 @@ class WebStore:
             "msg_ids": json.loads(row[2]),
             "size_bytes": row[3],
             "uploaded_at": row[4],
+            "cipher": row[5],
+            "codec": row[6],
+            "shards": json.loads(row[7]) if row[7] else None,
         }
 
     def get_config(self, key):
-        row = self.cursor.execute(
-            "SELECT value FROM auth_config WHERE key=?",
-            (key,),
-        ).fetchone()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM auth_config WHERE key=?",
+                (key,),
+            ).fetchone()
         if not row:
             return None
         return row[0]
 
     def set_config(self, key, value):
-        self.cursor.execute(
-            "INSERT OR REPLACE INTO auth_config (key, value) VALUES (?, ?)",
-            (key, value),
-        )
-        self.conn.commit()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO auth_config (key, value) VALUES (?, ?)",
+                (key, value),
+            )
+
+    def add_upload_job(self, job_id, file_name, spool_path, size_bytes, priority, content_hash=None, receiving=False):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                """
+                INSERT INTO upload_jobs
+                    (id, file_name, spool_path, size_bytes, priority, status, next_attempt_at, created_at,
+                     content_hash, receiving)
+                VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)
+                """,
+                (job_id, file_name, spool_path, size_bytes, priority, now, now, content_hash, int(receiving)),
+            )
+
+    def finish_receiving_upload_job(self, job_id, size_bytes, content_hash):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE upload_jobs SET size_bytes=?, content_hash=?, receiving=0 WHERE id=?",
+                (size_bytes, content_hash, job_id),
+            )
+
+    def claim_upload_job(self, now):
+        """Marks the next runnable job as running and returns it, or None."""
+        # One transaction, so two workers can't claim the same job.
+        with self.transaction() as conn:
+            row = conn.execute(
+                """
+                SELECT id, file_name, spool_path, size_bytes, attempts, content_hash
+                FROM upload_jobs
+                WHERE status='queued' AND next_attempt_at <= ?
+                ORDER BY priority DESC, created_at ASC
+                LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute("UPDATE upload_jobs SET status='running' WHERE id=?", (row[0],))
+        return {
+            "id": row[0],
+            "file_name": row[1],
+            "spool_path": row[2],
+            "size_bytes": row[3],
+            "attempts": row[4],
+            "content_hash": row[5],
+        }
+
+    def active_upload_names(self):
+        """File names of the upload jobs that are queued, running or still arriving."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT file_name FROM upload_jobs WHERE status IN ('queued', 'running')"
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def next_upload_attempt_at(self):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT MIN(next_attempt_at) FROM upload_jobs WHERE status='queued'"
+            ).fetchone()
+        return row[0]
+
+    def retry_upload_job(self, job_id, attempts, next_attempt_at, error):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE upload_jobs SET status='queued', attempts=?, next_attempt_at=?, error=? WHERE id=?",
+                (attempts, next_attempt_at, error, job_id),
+            )
+
+    def finish_upload_job(self, job_id, status, file_id=None, error=None):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE upload_jobs SET status=?, file_id=?, error=?, finished_at=? WHERE id=?",
+                (status, file_id, error, time.time(), job_id),
+            )
+
+    def get_upload_job(self, job_id):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT status, attempts, error, file_id FROM upload_jobs WHERE id=?",
+                (job_id,),
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "status": row[0],
+            "attempts": row[1],
+            "error": row[2],
+            "file_id": row[3],
+        }
+
+    def count_upload_jobs(self):
+        """Returns {status: number of jobs}."""
+        with self._connection() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM upload_jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def fail_receiving_upload_jobs(self, error):
+        """
+        Fails unfinished jobs whose file never finished arriving; the request
+        writing their spool died with the previous process. Jobs of upload
+        sessions are left alone, their chunks can still come in. Returns the
+        failed jobs' spool paths.
+        """
+        where = """
+            receiving=1 AND status IN ('queued', 'running')
+            AND id NOT IN (SELECT job_id FROM upload_sessions)
+        """
+        with self.transaction() as conn:
+            rows = conn.execute(f"SELECT spool_path FROM upload_jobs WHERE {where}").fetchall()
+            conn.execute(
+                f"UPDATE upload_jobs SET status='failed', error=?, finished_at=? WHERE {where}",
+                (error, time.time()),
+            )
+        return [row[0] for row in rows]
+
+    def wake_upload_job(self, job_id, now):
+        """Makes a queued job that is waiting out a delay runnable now."""
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE upload_jobs SET next_attempt_at=? WHERE id=? AND status='queued' AND next_attempt_at > ?",
+                (now, job_id, now),
+            )
+
+    def add_upload_session(self, job_id, size_bytes, chunk_size):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO upload_sessions (job_id, size_bytes, chunk_size, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, size_bytes, chunk_size, now, now),
+            )
+
+    def add_upload_session_chunk(self, job_id, chunk_index):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO upload_session_chunks (job_id, chunk_index) VALUES (?, ?)",
+                (job_id, chunk_index),
+            )
+            conn.execute("UPDATE upload_sessions SET updated_at=? WHERE job_id=?", (time.time(), job_id))
+
+    def _session_chunks(self, conn, job_id):
+        rows = conn.execute(
+            "SELECT chunk_index FROM upload_session_chunks WHERE job_id=? ORDER BY chunk_index",
+            (job_id,),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_upload_session(self, job_id):
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT size_bytes, chunk_size FROM upload_sessions WHERE job_id=?",
+                (job_id,),
+            ).fetchone()
+            if not row:
+                return None
+            received = self._session_chunks(conn, job_id)
+        return {"size_bytes": row[0], "chunk_size": row[1], "received": received}
+
+    def list_upload_sessions(self):
+        with self._connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT s.job_id, j.spool_path, s.size_bytes, s.chunk_size
+                FROM upload_sessions s JOIN upload_jobs j ON j.id = s.job_id
+                """
+            ).fetchall()
+            return [
+                {
+                    "job_id": row[0],
+                    "spool_path": row[1],
+                    "size_bytes": row[2],
+                    "chunk_size": row[3],
+                    "received": self._session_chunks(conn, row[0]),
+                }
+                for row in rows
+            ]
+
+    def delete_upload_session(self, job_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM upload_session_chunks WHERE job_id=?", (job_id,))
+            conn.execute("DELETE FROM upload_sessions WHERE job_id=?", (job_id,))
+
+    def expire_upload_sessions(self, idle_before, error):
+        """
+        Drops sessions with no chunk since ``idle_before`` and fails their
+        jobs. Returns [(job_id, spool_path)].
+        """
+        with self.transaction() as conn:
+            rows = conn.execute(
+                """
+                SELECT s.job_id, j.spool_path
+                FROM upload_sessions s JOIN upload_jobs j ON j.id = s.job_id
+                WHERE s.updated_at < ?
+                """,
+                (idle_before,),
+            ).fetchall()
+            for job_id, _ in rows:
+                conn.execute(
+                    "UPDATE upload_jobs SET status='failed', error=?, finished_at=? WHERE id=? AND status IN ('queued', 'running')",
+                    (error, time.time(), job_id),
+                )
+                self.delete_upload_session(job_id)
+        return [(row[0], row[1]) for row in rows]
+
+    def requeue_running_upload_jobs(self):
+        # Jobs that were mid-upload when the process died start over.
+        with self._connection() as conn:
+            conn.execute("UPDATE upload_jobs SET status='queued' WHERE status='running'")
+
+    def purge_upload_jobs(self, finished_before):
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id FROM upload_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (finished_before,),
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM upload_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (finished_before,),
+            )
+        return [row[0] for row in rows]
@@ -0,0 +1,254 @@
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from Telegram.metrics import Counter
+from Telegram.teleBot import CAPTION_PREFIX, parse_file_caption
+
+SYNC_MESSAGES = Counter("telearchive_sync_messages_total", "Channel messages read by the channel sync")
+SYNC_FILES = Counter("telearchive_sync_files_total", "Files found in the channel by the channel sync", ["result"])
+
+PART_NAME = re.compile(r"(.*)_part(\d+)\.txt", re.S)
+# A file whose newest message is younger than this may still be uploading,
+# or about to get its row from the upload that sent it, so it is left for
+# the next run.
+SETTLE_SECONDS = 15 * 60
+# Parts of a captioned upload with no final part are kept being looked for
+# this long after the newest one, in case another instance is still sending.
+ABANDON_SECONDS = 24 * 60 * 60
+# Files without a caption are probed this many at a time.
+PROBE_THREADS = 4
+
+
+class _Group:
+    """The _partN messages of one file, as they turn up in the history."""
+
+    def __init__(self, name):
+        self.name = name
+        self.parts = {}
+        self.info = None
+        # Sent by an upload that captions its parts, so it is only complete
+        # once the last one, with the file's caption, is in.
+        self.captioned = False
+
+    def add(self, index, message):
+        self.parts[index] = message
+        if (message.caption or "").startswith(CAPTION_PREFIX):
+            self.captioned = True
+        info = parse_file_caption(message.caption)
+        if info is not None:
+            self.info = info
+
+    @property
+    def messages(self):
+        return [self.parts[i] for i in sorted(self.parts)]
+
+    def first_id(self, shard):
+        """Id of the group's first message in ``shard``'s channel, or None."""
+        return min((m.document.msg_id for m in self.parts.values() if m.document.shard == shard), default=None)
+
+    def settled(self, now, seconds=None):
+        if seconds is None:
+            seconds = SETTLE_SECONDS
+        return max(m.date for m in self.parts.values()) <= now - seconds
+
+    def complete(self):
+        # Files uploaded before captions were added can only be taken as
+        # complete when no part is missing; see ChannelSync.
+        if self.info is None:
+            return not self.captioned and set(self.parts) == set(range(len(self.parts)))
+        return set(self.parts) == set(range(self.info["parts"]))
+
+
+class ChannelSync:
+    """
+    Rebuilds web_files from the channel itself: after losing the database,
+    or for files posted by another TeleArchive or other tools. Each
+    channel's history is read oldest first, in batches, from a high-water
+    message id kept in auth_config, so runs after the first only read what
+    was posted since.
+
+    _partN documents are grouped back into files. Since uploads caption
+    their last message with the part count, size, cipher and codec, those
+    files are listed without downloading anything; older uploads and plain
+    documents are probed by reading their first bytes. Messages a file row
+    already points at, or that this process sent, are skipped, so a run
+    never adds a file twice. Files named like an upload job that hasn't
+    finished are left for a later run: they may be that upload, still
+    sending its parts.
+    """
+
+    def __init__(self, client, store, interval):
+        self.client = client
+        self.store = store
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = False
+        self.last_result = None
+
+    def start(self):
+        threading.Thread(target=self._worker, name="channel-sync", daemon=True).start()
+
+    def trigger(self):
+        self.wake.set()
+
+    def _worker(self):
+        # Without an interval it only runs when triggered.
+        if self.interval <= 0:
+            self.wake.wait()
+        self.client.wait_ready(None)
+        while True:
+            self.wake.clear()
+            try:
+                self.sync()
+            except Exception as exc:
+                print(f"CHANNEL SYNC FAILED: {exc}")
+            self.wake.wait(self.interval if self.interval > 0 else None)
+
+    def sync(self):
+        with self.lock:
+            self.running = True
+            started = time.perf_counter()
+            result = {"messages": 0, "added": 0, "skipped": 0}
+            try:
+                self._sync(result)
+            finally:
+                self.running = False
+            result["seconds"] = round(time.perf_counter() - started, 3)
+            self.last_result = result
+            print(f"CHANNEL SYNC: {result}")
+            return result
+
+    def _sync(self, result):
+        channels = self.client.channels()
+        # Accounts sharing a channel see the same messages, so it is read
+        # through the first of them; file rows may name any of them.
+        canonical = {index: shards[0] for shards in channels.values() for index in shards}
+        cursors = {
+            channel_id: [shards[0], int(self.store.get_config(f"sync_high_water:{channel_id}") or 0)]
+            for channel_id, shards in channels.items()
+        }
+        # name -> groups still missing parts, or too new to be listed yet.
+        # With an account per channel a file's parts are spread over the
+        # channels, so they are read a batch from each at a time.
+        open_groups = defaultdict(list)
+        known = None
+        active = list(cursors)
+        while active:
+            messages = []
+            for channel_id in list(active):
+                shard, after = cursors[channel_id]
+                batch, last_id = self.client.channel_messages(shard, after)
+                if last_id == after:
+                    active.remove(channel_id)
+                    continue
+                cursors[channel_id][1] = last_id
+                messages.extend(batch)
+            SYNC_MESSAGES.inc(len(messages))
+            result["messages"] += len(messages)
+            if known is None and messages:
+                known = {(canonical.get(s, s), msg_id) for s, msg_id in self.store.file_parts()}
+            if known is not None:
+                # Uploads of this process may have sent more since the last batch.
+                known.update((canonical.get(s, s), msg_id) for s, msg_id in self.client.sent_messages())
+            now = time.time()
+            uploading = self.store.active_upload_names()
+            done = []
+            for message in sorted(messages, key=lambda m: m.date):
+                if (message.document.shard, message.document.msg_id) in known:
+                    continue
+                match = PART_NAME.fullmatch(message.name or "")
+                if match is None:
+                    # A plain document, e.g. posted by another tool
+                    group = _Group(message.name or f"message_{message.document.msg_id}")
+                    group.add(0, message)
+                    done.append(group)
+                    continue
+                name, index = match.group(1), int(match.group(2))
+                group = next((g for g in open_groups[name] if index not in g.parts), None)
+                if group is None:
+                    group = _Group(name)
+                    open_groups[name].append(group)
+                group.add(index, message)
+            for groups in open_groups.values():
+                for group in list(groups):
+                    if group.name in uploading:
+                        continue
+                    if group.info is not None and group.complete() and group.settled(now):
+                        groups.remove(group)
+                        done.append(group)
+            self._add(done, known, result)
+            self._save_high_water(cursors, open_groups)
+
+        # End of the history. Uncaptioned groups (uploads from before
+        # captions) are taken as whole files once nothing was added to them
+        # for a while; incomplete captioned ones are given up on much later.
+        now = time.time()
+        uploading = self.store.active_upload_names()
+        done = []
+        for groups in open_groups.values():
+            for group in list(groups):
+                if not group.settled(now) or group.name in uploading:
+                    continue
+                if group.info is None and group.complete():
+                    groups.remove(group)
+                    done.append(group)
+                elif group.settled(now, ABANDON_SECONDS):
+                    groups.remove(group)
+                    print(f"CHANNEL SYNC: skipping {group.name}, parts {sorted(group.parts)} are incomplete")
+                    SYNC_FILES.inc(result="skipped")
+                    result["skipped"] += 1
+        self._add(done, known, result)
+        self._save_high_water(cursors, open_groups)
+
+    def _save_high_water(self, cursors, open_groups):
+        # Messages of groups that may still grow are read again next time.
+        with self.store.transaction():
+            for channel_id, (shard, after) in cursors.items():
+                pending = [
+                    g.first_id(shard) for groups in open_groups.values() for g in groups if g.first_id(shard)
+                ]
+                high_water = min(pending) - 1 if pending else after
+                self.store.set_config(f"sync_high_water:{channel_id}", str(high_water))
+
+    def _describe(self, group):
+        if group.info is not None:
+            return group.info["cipher"], group.info["codec"], group.info["size"]
+        messages = group.messages
+        try:
+            return self.client.probe_file([m.document.msg_id for m in messages], [m.document.shard for m in messages])
+        except Exception as exc:
+            print(f"CHANNEL SYNC: skipping {group.name}: {exc}")
+            return None
+
+    def _add(self, groups, known, result):
+        if not groups:
+            return
+        with ThreadPoolExecutor(PROBE_THREADS) as pool:
+            described = list(pool.map(self._describe, groups))
+        documents = []
+        with self.store.transaction():
+            for group, description in zip(groups, described):
+                if description is None:
+                    SYNC_FILES.inc(result="skipped")
+                    result["skipped"] += 1
+                    continue
+                cipher, codec, size = description
+                messages = group.messages
+                self.store.add_file(
+                    group.name,
+                    [m.document.msg_id for m in messages],
+                    size,
+                    cipher=cipher,
+                    codec=codec,
+                    shards=[m.document.shard for m in messages],
+                    uploaded_at=int(min(m.date for m in messages)),
+                )
+                documents.extend(m.document for m in messages)
+                known.update((m.document.shard, m.document.msg_id) for m in messages)
+                SYNC_FILES.inc(result="added")
+                result["added"] += 1
+            self.store.save_documents(documents)
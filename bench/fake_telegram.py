@@ -0,0 +1,239 @@
+"""
+In-process stand-in for the parts of Telethon's TelegramClient that
+TelegramFileClient uses, with simulated latency and per-connection
+bandwidth. Uploaded documents are kept in a directory on disk, so multi-GB
+runs don't inflate the process's own memory.
+"""
+import asyncio
+import itertools
+import os
+import random
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from telethon.errors import FileReferenceExpiredError
+from telethon.tl.functions.upload import GetFileRequest, SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputPeerChannel
+
+# TelegramFileClient uploads fixed-size parts; only the last one is shorter.
+PART_SIZE = 512 * 1024
+# Telegram returns at most this many messages per history request.
+HISTORY_PAGE = 100
+# Every fake account has a channel of its own.
+_channel_ids = itertools.count(1)
+
+
+class _Link:
+    """
+    One simulated connection. Requests on it overlap their latency but take
+    turns on the bandwidth, like MTProto requests sharing a socket.
+    """
+
+    def __init__(self, latency, bandwidth):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = None
+        self.in_flight = 0
+
+    async def transfer(self, nbytes):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency / 2)
+            if self.bandwidth and nbytes:
+                async with self.lock:
+                    await asyncio.sleep(nbytes / self.bandwidth)
+            await asyncio.sleep(self.latency / 2)
+        finally:
+            self.in_flight -= 1
+
+
+class _Message:
+    def __init__(self, client, msg_id, document, name, caption=None):
+        self.id = msg_id
+        self.date = datetime.now(timezone.utc)
+        self.message = caption or ""
+        self.media = SimpleNamespace(document=document)
+        self.file = SimpleNamespace(size=document.size, name=name)
+        self._client = client
+
+    async def download_media(self, file=bytes, progress_callback=None):
+        out = bytearray()
+        async for chunk in self._client.iter_download(self.media):
+            out += chunk
+            if progress_callback:
+                progress_callback(len(out), self.file.size)
+        return bytes(out)
+
+
+class _Download:
+    def __init__(self, client, location, size, offset, limit, request_size):
+        self.client = client
+        self.location = location
+        self.size = size
+        self.offset = offset
+        self.limit = limit
+        self.request_size = request_size
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.offset >= self.size or self.limit == 0:
+            raise StopAsyncIteration
+        if self.limit is not None:
+            self.limit -= 1
+        result = await self.client.handle(
+            GetFileRequest(self.location, self.offset, self.request_size),
+            self.client.link,
+        )
+        self.offset += self.request_size
+        return result.bytes
+
+
+class FakeTelegramClient:
+    """
+    Implements what TelegramFileClient calls on a TelegramClient: start,
+    get_entity, part uploads and GetFileRequest through ``__call__``,
+    send_file, get_messages, iter_messages, iter_download, delete_messages
+    and Message.download_media. File references are checked, and
+    expire_references() makes every one handed out so far stale.
+    """
+
+    def __init__(self, storage_dir, latency=0.05, bandwidth=20e6, dc_id=2):
+        self.dir = storage_dir
+        os.makedirs(self.dir, exist_ok=True)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.session = SimpleNamespace(dc_id=dc_id, auth_key=None)
+        self.link = _Link(latency, bandwidth)
+        self.dc_id = dc_id
+        self.messages = {}
+        self.documents = {}
+        self.uploads = {}
+        self.message_ids = itertools.count(1)
+        self.channel_id = next(_channel_ids)
+        self.calls = {}
+
+    async def start(self):
+        return self
+
+    async def get_entity(self, link):
+        return InputPeerChannel(self.channel_id, 0)
+
+    async def disconnect(self):
+        for fd, _ in self.uploads.values():
+            os.close(fd)
+        self.uploads = {}
+
+    async def __call__(self, request):
+        return await self.handle(request, self.link)
+
+    def expire_references(self):
+        for message in self.messages.values():
+            message.media.document.file_reference = os.urandom(8)
+
+    async def handle(self, request, link):
+        name = type(request).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if isinstance(request, (SaveFilePartRequest, SaveBigFilePartRequest)):
+            await link.transfer(len(request.bytes))
+            fd, parts = self._upload(request.file_id)
+            os.pwrite(fd, request.bytes, request.file_part * PART_SIZE)
+            parts.add(request.file_part)
+            return True
+        if isinstance(request, GetFileRequest):
+            path, size, document = self.documents[request.location.id]
+            if request.location.file_reference != document.file_reference:
+                await link.transfer(0)
+                raise FileReferenceExpiredError(request)
+            length = max(0, min(request.limit, size - request.offset))
+            with open(path, "rb") as f:
+                data = os.pread(f.fileno(), length, request.offset)
+            await link.transfer(len(data))
+            return SimpleNamespace(bytes=data)
+        raise NotImplementedError(f"Fake Telegram can't handle {type(request).__name__}")
+
+    def _upload(self, file_id):
+        entry = self.uploads.get(file_id)
+        if entry is None:
+            path = os.path.join(self.dir, f"upload-{file_id}.part")
+            entry = self.uploads[file_id] = (os.open(path, os.O_RDWR | os.O_CREAT, 0o600), set())
+        return entry
+
+    async def send_file(self, entity, file, caption=None, **kwargs):
+        await self.link.transfer(0)
+        fd, parts = self.uploads.pop(file.id)
+        size = os.fstat(fd).st_size
+        os.close(fd)
+        if parts != set(range(file.parts)):
+            raise ValueError(f"FILE_PARTS_INVALID: got {len(parts)} of {file.parts} parts")
+        doc_id = random.getrandbits(63)
+        path = os.path.join(self.dir, f"{doc_id}.doc")
+        os.replace(os.path.join(self.dir, f"upload-{file.id}.part"), path)
+        document = SimpleNamespace(
+            id=doc_id,
+            access_hash=random.getrandbits(63),
+            file_reference=os.urandom(8),
+            dc_id=self.dc_id,
+            size=size,
+        )
+        self.documents[doc_id] = (path, size, document)
+        message = _Message(self, next(self.message_ids), document, file.name, caption)
+        self.messages[message.id] = message
+        return message
+
+    async def get_messages(self, entity, ids=None):
+        self.calls["get_messages"] = self.calls.get("get_messages", 0) + 1
+        await self.link.transfer(0)
+        if isinstance(ids, int):
+            return self.messages.get(ids)
+        return [self.messages.get(i) for i in ids]
+
+    async def iter_messages(self, entity, limit=None, min_id=0, reverse=False, **kwargs):
+        ids = sorted((i for i in self.messages if i > min_id), reverse=not reverse)[:limit]
+        for start in range(0, len(ids), HISTORY_PAGE):
+            self.calls["iter_messages"] = self.calls.get("iter_messages", 0) + 1
+            await self.link.transfer(0)
+            for msg_id in ids[start:start + HISTORY_PAGE]:
+                message = self.messages.get(msg_id)
+                if message is not None:
+                    yield message
+
+    def iter_download(self, file, offset=0, limit=None, request_size=PART_SIZE, file_size=None, **kwargs):
+        # A message's media, or an InputDocumentFileLocation with file_size
+        document = getattr(file, "document", None)
+        if document is not None:
+            file, file_size = document, document.size
+        return _Download(self, file, file_size, offset, limit, request_size)
+
+    async def delete_messages(self, entity, message_ids):
+        await self.link.transfer(0)
+        for msg_id in message_ids:
+            message = self.messages.pop(msg_id, None)
+            if message is None:
+                continue
+            path, _, _ = self.documents.pop(message.media.document.id)
+            os.remove(path)
+
+
+class FakeSenderPool:
+    """Stands in for transfer.SenderPool: ``size`` links with their own bandwidth each."""
+
+    def __init__(self, client, dc_id, size):
+        self.client = client
+        self.links = [_Link(client.latency, client.bandwidth) for _ in range(max(1, size))]
+
+    async def call(self, request):
+        link = min(self.links, key=lambda l: l.in_flight)
+        return await self.client.handle(request, link)
+
+    async def close(self):
+        pass
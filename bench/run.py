@@ -0,0 +1,408 @@
+"""
+Benchmarks TeleArchive end to end against the fake Telegram backend.
+
+Every scenario (file size x encryption) runs in its own process so peak RSS
+is measured per scenario; "rss growth/size" is how far it rose above the
+baseline, as a multiple of the file size. The child starts the real Flask app on a local
+port, uploads a generated file through /upload, waits for the upload job,
+downloads it back through /download, then downloads it from --concurrent
+clients at once and times random range requests.
+
+    python -m bench.run                # 1KB .. 5GB, with and without encryption
+    python -m bench.run --quick        # small sizes, for CI
+    python -m bench.run --sizes 1MB,1GB --encrypt on --json results.json
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+FULL_SIZES = "1KB,1MB,64MB,512MB,2GB,5GB"
+QUICK_SIZES = "1KB,1MB,32MB"
+UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+GEN_BLOCK = 8 * 1024 * 1024
+IO_CHUNK = 1024 * 1024
+PASSKEY = "bench"
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)]) * UNITS[unit])
+    return int(text)
+
+
+def format_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f}{unit}" if unit == "B" or n == int(n) else f"{n:.1f}{unit}"
+        n /= 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def make_input(path, size):
+    """Writes ``size`` incompressible bytes and returns their sha256."""
+    digest = hashlib.sha256()
+    block = os.urandom(min(GEN_BLOCK, max(size, 1)))
+    with open(path, "wb") as f:
+        left = size
+        while left:
+            buf = block[:min(left, len(block))]
+            f.write(buf)
+            digest.update(buf)
+            left -= len(buf)
+    return digest.hexdigest()
+
+
+class Http:
+    """Minimal cookie-keeping client, so uploads can stream from disk."""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+        headers = dict(headers or {})
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        cookie = resp.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return conn, resp
+
+    def json(self, method, path, body=None, headers=None):
+        conn, resp = self.request(method, path, body, headers)
+        try:
+            return resp.status, json.loads(resp.read() or b"null")
+        finally:
+            conn.close()
+
+
+def multipart_body(path, name, size):
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="files"; filename="{name}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def chunks():
+        yield head
+        with open(path, "rb") as f:
+            while True:
+                buf = f.read(IO_CHUNK)
+                if not buf:
+                    break
+                yield buf
+        yield tail
+
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + size + len(tail)),
+    }
+    return chunks(), headers
+
+
+def read_body(resp, started, digest=None):
+    """Drains a response; returns (bytes, seconds from ``started`` to the first body byte)."""
+    first = None
+    total = 0
+    while True:
+        buf = resp.read(IO_CHUNK)
+        if not buf:
+            break
+        if first is None:
+            first = time.perf_counter() - started
+        total += len(buf)
+        if digest:
+            digest.update(buf)
+    return total, first or 0.0
+
+
+def run_scenario(args):
+    workdir = tempfile.mkdtemp(prefix="telearchive-bench-")
+    try:
+        return _run_scenario(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _run_scenario(args, workdir):
+    os.environ.update(
+        PASSKEY=PASSKEY,
+        WEB_DB_PATH=os.path.join(workdir, "web.db"),
+        CACHE_DIR=os.path.join(workdir, "cache"),
+        UPLOAD_SPOOL_DIR=os.path.join(workdir, "spool"),
+        # Measure the Telegram path, not the download cache.
+        CACHE_MAX_BYTES=str(args.cache_bytes),
+        TRANSFER_CONNECTIONS=str(args.connections),
+        # Nothing to find in a new fake channel; keep it out of the timings.
+        SYNC_INTERVAL_SECONDS="0",
+    )
+    os.environ.pop("COMPRESSION", None)
+    if args.encrypt:
+        from cryptography.fernet import Fernet
+        os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+    else:
+        os.environ.pop("ENCRYPTION_KEY", None)
+
+    # Keep a developer's .env from changing the scenario.
+    import dotenv
+    dotenv.load_dotenv = lambda *a, **k: False
+
+    from werkzeug.serving import make_server
+
+    from bench.fake_telegram import FakeSenderPool, FakeTelegramClient
+    from Telegram.teleBot import TelegramFileClient
+    from Telegram.web.app import create_app
+
+    fakes = [
+        FakeTelegramClient(os.path.join(workdir, f"telegram{i}"), args.latency, args.bandwidth)
+        for i in range(args.accounts)
+    ]
+    client = TelegramFileClient(None, None, None, "bench", client=fakes, pool_factory=FakeSenderPool)
+    app = create_app(client)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http_client = Http(server.server_port)
+
+    input_path = os.path.join(workdir, "input.bin")
+    expected = make_input(input_path, args.size)
+    baseline_rss = rss_mb()
+
+    conn, resp = http_client.request(
+        "POST", "/login", f"passkey={PASSKEY}".encode(),
+        {"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    resp.read()
+    conn.close()
+    if "error" in (resp.getheader("Location") or "error"):
+        raise RuntimeError(f"login failed: {resp.status} {resp.getheader('Location')}")
+
+    # Upload: request body in, then wait for the job to reach Telegram.
+    started = time.perf_counter()
+    body, headers = multipart_body(input_path, "bench.bin", args.size)
+    status, data = http_client.json("POST", "/upload", body, headers)
+    upload_request_s = time.perf_counter() - started
+    if status != 200 or not data.get("ok"):
+        raise RuntimeError(f"upload failed: {status} {data}")
+    task_id = data["tasks"][0]["task_id"]
+    while True:
+        status, info = http_client.json("GET", f"/api/progress/{task_id}")
+        if info.get("done"):
+            break
+        time.sleep(0.02)
+    upload_s = time.perf_counter() - started
+    if info.get("status") != "done":
+        raise RuntimeError(f"upload job failed: {info}")
+    file_id = info["file_id"]
+
+    # Full download
+    digest = hashlib.sha256()
+    started = time.perf_counter()
+    conn, resp = http_client.request("GET", f"/download/{file_id}")
+    received, ttfb = read_body(resp, started, digest)
+    conn.close()
+    download_s = time.perf_counter() - started
+    if received != args.size or digest.hexdigest() != expected:
+        raise RuntimeError(f"downloaded {received} bytes that don't match the upload")
+
+    # The same file requested by several clients at once, as when a share
+    # link goes round: they should share one read from Telegram.
+    concurrent_s = telegram_ratio = None
+    if args.concurrent > 1:
+        from Telegram.teleBot import DOWNLOAD_BYTES
+        fetched = DOWNLOAD_BYTES.values[()]
+        sizes = []
+
+        def fetch():
+            conn, resp = http_client.request("GET", f"/download/{file_id}")
+            sizes.append(read_body(resp, time.perf_counter())[0])
+            conn.close()
+
+        threads = [threading.Thread(target=fetch) for _ in range(args.concurrent)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        concurrent_s = time.perf_counter() - started
+        if sizes != [args.size] * args.concurrent:
+            raise RuntimeError(f"concurrent downloads returned {sizes} bytes")
+        if args.size:
+            telegram_ratio = (DOWNLOAD_BYTES.values[()] - fetched) / args.size
+
+    # Random ranges
+    latencies = []
+    rng = random.Random(0)
+    for _ in range(args.ranges if args.size else 0):
+        length = min(args.range_bytes, args.size)
+        start = rng.randrange(args.size - length + 1)
+        began = time.perf_counter()
+        conn, resp = http_client.request(
+            "GET", f"/download/{file_id}", headers={"Range": f"bytes={start}-{start + length - 1}"}
+        )
+        got, _ = read_body(resp, began)
+        conn.close()
+        latencies.append(time.perf_counter() - began)
+        if resp.status != 206 or got != length:
+            raise RuntimeError(f"range request returned {resp.status} with {got} bytes")
+
+    server.shutdown()
+    mb = args.size / 2 ** 20
+    peak_rss = peak_rss_mb()
+    return {
+        "size": args.size,
+        "encrypted": args.encrypt,
+        "upload_s": round(upload_s, 4),
+        "upload_request_s": round(upload_request_s, 4),
+        "upload_mb_s": round(mb / upload_s, 2),
+        "download_s": round(download_s, 4),
+        "download_mb_s": round(mb / download_s, 2),
+        "download_ttfb_s": round(ttfb, 4),
+        "concurrent_s": None if concurrent_s is None else round(concurrent_s, 4),
+        # Bytes read from Telegram for the concurrent downloads, per file size
+        "concurrent_telegram_ratio": None if telegram_ratio is None else round(telegram_ratio, 2),
+        **{
+            f"range_p{p}_s": None if not latencies else round(percentile(latencies, p), 4)
+            for p in (50, 95, 99)
+        },
+        "baseline_rss_mb": round(baseline_rss, 1) if baseline_rss else None,
+        "peak_rss_mb": round(peak_rss, 1),
+        # How much the transfers grew the process, per byte of file. Small
+        # files only measure interpreter noise.
+        "rss_growth_per_size": round((peak_rss - baseline_rss) / mb, 2) if baseline_rss and mb >= 1 else None,
+    }
+
+
+def run_child(args, size, encrypt):
+    cmd = [
+        sys.executable, "-m", "bench.run", "--child",
+        "--sizes", str(size),
+        "--encrypt", "on" if encrypt else "off",
+        "--latency", str(args.latency),
+        "--bandwidth", str(args.bandwidth),
+        "--connections", str(args.connections),
+        "--accounts", str(args.accounts),
+        "--ranges", str(args.ranges),
+        "--range-bytes", str(args.range_bytes),
+        "--cache-bytes", str(args.cache_bytes),
+        "--concurrent", str(args.concurrent),
+    ]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(cmd, cwd=root, capture_output=True, text=True)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    return {"size": size, "encrypted": encrypt, "error": (proc.stderr or proc.stdout).strip().splitlines()[-1:]}
+
+
+def print_table(results):
+    columns = [
+        ("size", lambda r: format_size(r["size"])),
+        ("enc", lambda r: "yes" if r["encrypted"] else "no"),
+        ("upload MB/s", lambda r: r["upload_mb_s"]),
+        ("download MB/s", lambda r: r["download_mb_s"]),
+        ("ttfb ms", lambda r: round(r["download_ttfb_s"] * 1000, 1)),
+        ("concurrent s/fetched", lambda r: "-" if r["concurrent_s"] is None else (
+            f"{r['concurrent_s']}/{r['concurrent_telegram_ratio']}x"
+        )),
+        ("range p50/p95/p99 ms", lambda r: "/".join(
+            "-" if r[k] is None else str(round(r[k] * 1000, 1)) for k in ("range_p50_s", "range_p95_s", "range_p99_s")
+        )),
+        ("rss base/peak MB", lambda r: f"{r['baseline_rss_mb']}/{r['peak_rss_mb']}"),
+        ("rss growth/size", lambda r: "-" if r["rss_growth_per_size"] is None else f"{r['rss_growth_per_size']}x"),
+    ]
+    rows = []
+    for r in results:
+        if "error" in r:
+            rows.append([format_size(r["size"]), "yes" if r["encrypted"] else "no", f"FAILED: {r['error']}"])
+        else:
+            rows.append([str(fn(r)) for _, fn in columns])
+    widths = [max([len(name)] + [len(row[i]) for row in rows if len(row) == len(columns)]) for i, (name, _) in enumerate(columns)]
+    print("  ".join(name.ljust(w) for (name, _), w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(cell.ljust(w) for cell, w in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark TeleArchive against a fake Telegram backend.")
+    parser.add_argument("--sizes", help=f"comma separated, default {FULL_SIZES}")
+    parser.add_argument("--quick", action="store_true", help=f"sizes {QUICK_SIZES} with a fast fake network")
+    parser.add_argument("--encrypt", choices=("on", "off", "both"), default="both")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake round trip in seconds")
+    parser.add_argument("--bandwidth", type=parse_size, default=parse_size("20MB"), help="per connection, per second")
+    parser.add_argument("--connections", type=int, default=4, help="TRANSFER_CONNECTIONS")
+    parser.add_argument("--accounts", type=int, default=1, help="fake Telegram accounts to spread parts over")
+    parser.add_argument("--ranges", type=int, default=20, help="range requests timed per scenario")
+    parser.add_argument("--range-bytes", type=parse_size, default=parse_size("1MB"))
+    parser.add_argument("--concurrent", type=int, default=8, help="simultaneous downloads of the same file")
+    parser.add_argument("--cache-bytes", type=parse_size, default=0, help="CACHE_MAX_BYTES, 0 disables the disk cache")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.sizes = args.sizes or QUICK_SIZES
+        args.latency = min(args.latency, 0.005)
+        args.bandwidth = max(args.bandwidth, parse_size("200MB"))
+    sizes = [parse_size(s) for s in (args.sizes or FULL_SIZES).split(",")]
+    modes = {"on": [True], "off": [False], "both": [False, True]}[args.encrypt]
+
+    if args.child:
+        args.size = sizes[0]
+        args.encrypt = modes[0]
+        print(json.dumps(run_scenario(args)))
+        return 0
+
+    results = []
+    for size in sizes:
+        for encrypt in modes:
+            result = run_child(args, size, encrypt)
+            results.append(result)
+            status = "FAILED" if "error" in result else f"{result['upload_mb_s']} / {result['download_mb_s']} MB/s"
+            print(f"{format_size(size)} {'encrypted' if encrypt else 'plain'}: {status}", file=sys.stderr)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any("error" in r for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
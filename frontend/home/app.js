@@ -5,6 +5,8 @@ const fileList = document.getElementById("fileList");
 const searchInput = document.getElementById("searchInput");
 const logoutBtn = document.getElementById("logoutBtn");
 const toast = document.getElementById("toast");
+const bulkBar = document.getElementById("bulkBar");
+const bulkCount = document.getElementById("bulkCount");
 
 const escapeHtml = (value) =>
   String(value).replace(/[&<>"']/g, (ch) => ({ "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;" }[ch]));
@@ -22,189 +24,298 @@ function showToast(message, isError) {
   }, 3200);
 }
 
+async function copyText(text, message) {
+  try {
+    await navigator.clipboard.writeText(text);
+    showToast(message);
+  } catch (e) {
+    const input = document.createElement("textarea");
+    input.value = text;
+    document.body.appendChild(input);
+    input.select();
+    input.setSelectionRange(0, input.value.length);
+    try {
+      document.execCommand("copy");
+      showToast(message);
+    } catch (err) {
+      showToast(text);
+    }
+    input.remove();
+  }
+}
+
 logoutBtn.addEventListener("click", () => {
   window.location = "/logout";
 });
 
 let currentSort = "date";
 let currentDir = "desc";
-let allFiles = [];
 let currentQuery = "";
+const PAGE_SIZE = 100;
+// Bumped on every reset so responses for an old sort/search are dropped.
+let listGeneration = 0;
+let nextCursor = null;
+let loadingPage = false;
+let loadedCount = 0;
+
+const sentinel = document.createElement("div");
+sentinel.className = "list-sentinel";
 
 async function refreshFiles() {
-  const res = await apiFetch(`/api/files?sort=${currentSort}&dir=${currentDir}`);
-  const data = await res.json();
-  if (!data.ok) {
-    showToast(data.error || "Failed to load files", true);
-    return;
+  listGeneration += 1;
+  nextCursor = null;
+  loadedCount = 0;
+  loadingPage = false;
+  fileList.innerHTML = "";
+  await loadNextPage(true);
+}
+
+async function loadNextPage(first = false) {
+  if (loadingPage || (!first && !nextCursor)) return;
+  loadingPage = true;
+  const generation = listGeneration;
+  const params = new URLSearchParams({ sort: currentSort, dir: currentDir, limit: PAGE_SIZE });
+  if (currentQuery.trim()) params.set("q", currentQuery.trim());
+  if (!first) params.set("cursor", nextCursor);
+  try {
+    const res = await apiFetch(`/api/files?${params}`);
+    const data = await res.json();
+    if (generation !== listGeneration) return;
+    if (!data.ok) {
+      showToast(data.error || "Failed to load files", true);
+      return;
+    }
+    nextCursor = data.next_cursor || null;
+    appendFiles(data.files || []);
+  } finally {
+    if (generation === listGeneration) loadingPage = false;
+  }
+  // A short first page may not fill the screen, so the sentinel never
+  // leaves view and the observer wouldn't fire again.
+  if (generation === listGeneration && nextCursor && isNearBottom()) {
+    loadNextPage();
   }
-  allFiles = data.files || [];
-  renderFiles();
 }
 
-function renderFiles() {
-  const q = currentQuery.trim().toLowerCase();
-  const visibleFiles = q ? allFiles.filter((f) => f.name.toLowerCase().includes(q)) : allFiles;
-  fileList.innerHTML = "";
-  if (!visibleFiles.length) {
-    fileList.innerHTML = allFiles.length ? "<div class='empty'>No matching files.</div>" : "<div class='empty'>No uploads yet.</div>";
+function isNearBottom() {
+  return sentinel.getBoundingClientRect().top < window.innerHeight + 800;
+}
+
+function appendFiles(files) {
+  loadedCount += files.length;
+  sentinel.remove();
+  if (!loadedCount) {
+    fileList.innerHTML = currentQuery.trim() ? "<div class='empty'>No matching files.</div>" : "<div class='empty'>No uploads yet.</div>";
     return;
   }
-  for (const file of visibleFiles) {
-    const el = document.createElement("div");
-    el.className = "file";
-
-    const left = document.createElement("div");
-    left.innerHTML = `<strong title="${escapeHtml(file.name)}">${escapeHtml(file.name)}</strong><small>${file.size_human} | ${file.uploaded_at}</small>`;
-    const progress = document.createElement("div");
-    progress.className = "progress";
-    const bar = document.createElement("span");
-    progress.appendChild(bar);
-    left.appendChild(progress);
-    const progressLabel = document.createElement("div");
-    progressLabel.className = "progress-label";
-    left.appendChild(progressLabel);
-
-    const right = document.createElement("div");
-    right.className = "row-actions";
-
-    const download = document.createElement("button");
-    download.textContent = "Download";
-    download.addEventListener("click", async () => {
-      await downloadWithProgress(file, progress, bar, progressLabel);
-    });
+  const fragment = document.createDocumentFragment();
+  for (const file of files) {
+    fragment.appendChild(createFileRow(file));
+  }
+  fragment.appendChild(sentinel);
+  fileList.appendChild(fragment);
+}
+
+const listObserver = new IntersectionObserver(
+  (entries) => {
+    if (entries.some((entry) => entry.isIntersecting)) loadNextPage();
+  },
+  { rootMargin: "800px 0px" }
+);
+listObserver.observe(sentinel);
 
-    const del = document.createElement("button");
-    del.textContent = "Delete";
-    del.addEventListener("click", async () => {
-      if (!confirm("Delete this file from Telegram and the list?")) return;
-      const resp = await apiFetch("/delete/" + file.id, { method: "POST" });
-      const delData = await resp.json();
-      if (!delData.ok) {
-        showToast(delData.error || "Delete failed", true);
+function createFileRow(file) {
+  const el = document.createElement("div");
+  el.className = "file";
+
+  const left = document.createElement("div");
+  left.innerHTML = `<strong title="${escapeHtml(file.name)}">${escapeHtml(file.name)}</strong><small>${file.size_human} | ${file.uploaded_at}</small>`;
+
+  const right = document.createElement("div");
+  right.className = "row-actions";
+
+  const select = document.createElement("label");
+  select.className = "file-select";
+  select.title = "Select";
+  const check = document.createElement("input");
+  check.type = "checkbox";
+  check.checked = selectedIds.has(file.id);
+  check.addEventListener("change", () => {
+    if (check.checked) selectedIds.add(file.id);
+    else selectedIds.delete(file.id);
+    updateBulkBar();
+  });
+  select.appendChild(check);
+
+  const download = document.createElement("button");
+  download.textContent = "Download";
+  // /download streams the file as it comes in from Telegram, so the
+  // browser's own download progress is shown right away.
+  download.addEventListener("click", () => {
+    window.location = "/download/" + file.id;
+  });
+
+  const del = document.createElement("button");
+  del.textContent = "Delete";
+  del.addEventListener("click", async () => {
+    if (!confirm("Delete this file from Telegram and the list?")) return;
+    const resp = await apiFetch("/delete/" + file.id, { method: "POST" });
+    const delData = await resp.json();
+    if (!delData.ok) {
+      showToast(delData.error || "Delete failed", true);
+      return;
+    }
+    showToast("Deleted.");
+    selectedIds.delete(file.id);
+    updateBulkBar();
+    el.remove();
+  });
+
+  const share = document.createElement("button");
+  if (file.share_token) {
+    share.textContent = "Revoke";
+    share.addEventListener("click", async () => {
+      const resp = await apiFetch("/api/share/" + file.id + "/revoke", { method: "POST" });
+      const data = await resp.json();
+      if (!data.ok) {
+        showToast(data.error || "Revoke failed", true);
         return;
       }
-      showToast("Deleted.");
-      refreshFiles();
+      showToast("Share link revoked.");
+      el.replaceWith(createFileRow({ ...file, share_token: null }));
     });
+  } else {
+    share.textContent = "Share";
+    share.addEventListener("click", async () => {
+      const resp = await apiFetch("/api/share/" + file.id, { method: "POST" });
+      const data = await resp.json();
+      if (!data.ok) {
+        showToast(data.error || "Share failed", true);
+        return;
+      }
+      await copyText(data.link, "Share link copied!");
+      el.replaceWith(createFileRow({ ...file, share_token: data.token }));
+    });
+  }
 
-    const share = document.createElement("button");
-    if (file.share_token) {
-      share.textContent = "Revoke";
-      share.addEventListener("click", async () => {
-        const resp = await apiFetch("/api/share/" + file.id + "/revoke", { method: "POST" });
-        const data = await resp.json();
-        if (!data.ok) {
-          showToast(data.error || "Revoke failed", true);
-          return;
-        }
-        showToast("Share link revoked.");
-        refreshFiles();
-      });
-    } else {
-      share.textContent = "Share";
-      share.addEventListener("click", async () => {
-        const resp = await apiFetch("/api/share/" + file.id, { method: "POST" });
-        const data = await resp.json();
-        if (!data.ok) {
-          showToast(data.error || "Share failed", true);
-          return;
-        }
-        try {
-          await navigator.clipboard.writeText(data.link);
-          showToast("Share link copied!");
-        } catch (e) {
-          const input = document.createElement("input");
-          input.value = data.link;
-          document.body.appendChild(input);
-          input.select();
-          input.setSelectionRange(0, input.value.length);
-          try {
-            document.execCommand("copy");
-            showToast("Share link copied!");
-          } catch (err) {
-            showToast(data.link);
-          }
-          input.remove();
-        }
-        refreshFiles();
-      });
-    }
+  right.appendChild(select);
+  right.appendChild(download);
+  right.appendChild(share);
+  right.appendChild(del);
+  el.appendChild(left);
+  el.appendChild(right);
+  return el;
+}
 
-    right.appendChild(download);
-    right.appendChild(share);
-    right.appendChild(del);
-    el.appendChild(left);
-    el.appendChild(right);
-    fileList.appendChild(el);
+// Selected files stay selected across searches and sorts, so a selection
+// can be built from several searches before acting on it.
+const selectedIds = new Set();
+
+function updateBulkBar() {
+  bulkBar.hidden = selectedIds.size === 0;
+  bulkCount.textContent = `${selectedIds.size} selected`;
+}
+
+function clearSelection() {
+  selectedIds.clear();
+  updateBulkBar();
+  fileList.querySelectorAll(".file-select input").forEach((input) => {
+    input.checked = false;
+  });
+}
+
+// A form post rather than a fetch, so the browser saves the archive as it
+// streams instead of it being held in memory first.
+function downloadZip(fields) {
+  const form = document.createElement("form");
+  form.method = "POST";
+  form.action = "/api/export";
+  for (const [name, value] of Object.entries(fields)) {
+    const input = document.createElement("input");
+    input.type = "hidden";
+    input.name = name;
+    input.value = value;
+    form.appendChild(input);
   }
+  document.body.appendChild(form);
+  form.submit();
+  form.remove();
 }
 
-async function downloadWithProgress(file, progressEl, bar, labelEl) {
-  bar.style.width = "0%";
-  progressEl.style.display = "block";
-  labelEl.style.display = "block";
-  labelEl.textContent = "Downloading... 0 KB/s";
-
-  const startResp = await apiFetch(`/api/download/${file.id}/start`, { method: "POST" });
-  const startData = await startResp.json();
-  if (!startData.ok) {
-    showToast(startData.error || "Download failed", true);
-    progressEl.style.display = "none";
-    labelEl.style.display = "none";
+async function bulkRequest(action) {
+  const resp = await apiFetch(`/api/files/${action}`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ ids: Array.from(selectedIds) }),
+  });
+  const data = await resp.json();
+  if (!data.ok) throw new Error(data.error || `${action} failed`);
+  return data;
+}
+
+document.getElementById("bulkDownloadBtn").addEventListener("click", () => {
+  downloadZip({ ids: Array.from(selectedIds).join(",") });
+});
+
+document.getElementById("exportAllBtn").addEventListener("click", () => {
+  downloadZip({ q: currentQuery.trim(), sort: currentSort, dir: currentDir });
+});
+
+document.getElementById("bulkShareBtn").addEventListener("click", async () => {
+  try {
+    const data = await bulkRequest("share");
+    await copyText(data.links.map((l) => l.link).join("\n"), `${data.links.length} share links copied!`);
+  } catch (e) {
+    showToast(e.message, true);
     return;
   }
+  refreshFiles();
+});
 
-  let lastPercent = 0;
-  let lastTime = performance.now();
-  const totalBytes = file.size_bytes || 0;
-
-  const timer = setInterval(async () => {
-    const statusResp = await apiFetch(`/api/download/${file.id}/status`);
-    const statusData = await statusResp.json();
-    if (!statusData.ok) {
-      clearInterval(timer);
-      showToast(statusData.error || "Download failed", true);
-      progressEl.style.display = "none";
-      labelEl.style.display = "none";
-      return;
-    }
-
-    const percent = statusData.percent || 0;
-    bar.style.width = percent + "%";
+document.getElementById("bulkDeleteBtn").addEventListener("click", async () => {
+  if (!confirm(`Delete ${selectedIds.size} files from Telegram and the list?`)) return;
+  try {
+    const data = await bulkRequest("delete");
+    showToast(`Deleted ${data.deleted.length} files.`);
+  } catch (e) {
+    showToast(e.message, true);
+    return;
+  }
+  clearSelection();
+  refreshFiles();
+});
 
-    const now = performance.now();
-    const elapsed = (now - lastTime) / 1000;
-    if (elapsed >= 0.3 && totalBytes) {
-      const bytesNow = (percent / 100) * totalBytes;
-      const bytesPrev = (lastPercent / 100) * totalBytes;
-      const rate = (bytesNow - bytesPrev) / elapsed;
-      labelEl.textContent = `Downloading... ${formatRate(rate)}`;
-      lastPercent = percent;
-      lastTime = now;
-    }
+document.getElementById("bulkClearBtn").addEventListener("click", clearSelection);
+
+// One server-sent event stream carries progress for every transfer. The
+// latest event per transfer is kept so a listener registered after its
+// transfer already moved on still sees where it is.
+const transferListeners = new Map();
+const lastTransferEvents = new Map();
+const events = new EventSource("/api/events");
+
+function onTransferEvent(kind, e) {
+  const data = JSON.parse(e.data);
+  const key = `${kind}:${data.id}`;
+  lastTransferEvents.set(key, data);
+  const listener = transferListeners.get(key);
+  if (listener) listener(data);
+  if (data.done) {
+    transferListeners.delete(key);
+    setTimeout(() => lastTransferEvents.delete(key), 60000);
+  }
+}
 
-    if (statusData.error) {
-      clearInterval(timer);
-      showToast(statusData.error, true);
-      progressEl.style.display = "none";
-      labelEl.style.display = "none";
-      return;
-    }
+events.addEventListener("upload", (e) => onTransferEvent("upload", e));
 
-    if (statusData.done) {
-      clearInterval(timer);
-      bar.style.width = "100%";
-      labelEl.textContent = "Downloading... done";
-      window.location = "/download/" + file.id;
-      setTimeout(() => {
-        progressEl.style.display = "none";
-        bar.style.width = "0%";
-        labelEl.style.display = "none";
-        labelEl.textContent = "";
-      }, 400);
-    }
-  }, 600);
+function watchTransfer(kind, id, listener) {
+  const key = `${kind}:${id}`;
+  if (lastTransferEvents.has(key)) {
+    const last = lastTransferEvents.get(key);
+    listener(last);
+    if (last.done) return;
+  }
+  transferListeners.set(key, listener);
 }
 
 function createUploadRow(file) {
@@ -221,119 +332,242 @@ function createUploadRow(file) {
   const progressLabel = document.createElement("div");
   progressLabel.className = "progress-label";
   progressLabel.style.display = "block";
-  progressLabel.textContent = "Preparing...";
+  progressLabel.textContent = "Waiting...";
   left.appendChild(progressLabel);
   el.appendChild(left);
   fileList.prepend(el);
   return { el, progress, bar, progressLabel };
 }
 
-function pollTelegramUpload(taskId, row, totalBytes) {
-  let lastPercent = 0;
-  let lastTime = performance.now();
-  let smoothRate = 0;
-  const smoothing = 0.25;
-  const timer = setInterval(async () => {
-    const res = await apiFetch("/api/progress/" + taskId);
-    const data = await res.json();
-    if (!data.ok) {
-      clearInterval(timer);
-      showToast(data.error || "Upload failed", true);
-      row.progress.style.display = "none";
-      row.progressLabel.style.display = "none";
-      return;
-    }
-    row.bar.style.width = data.percent + "%";
-    const now = performance.now();
-    const elapsed = (now - lastTime) / 1000;
-    if (elapsed >= 0.3 && totalBytes) {
-      const bytesNow = (data.percent / 100) * totalBytes;
-      const bytesPrev = (lastPercent / 100) * totalBytes;
-      const rate = Math.max(0, (bytesNow - bytesPrev) / elapsed);
-      smoothRate = smoothRate ? smoothRate * (1 - smoothing) + rate * smoothing : rate;
-      row.progressLabel.textContent = `Uploading to Telegram... ${formatRate(smoothRate)}`;
-      lastPercent = data.percent;
-      lastTime = now;
-    }
+function watchTelegramUpload(taskId, row) {
+  watchTransfer("upload", taskId, (data) => {
     if (data.error) {
       showToast(data.error, true);
-      clearInterval(timer);
       row.progress.style.display = "none";
       row.progressLabel.style.display = "none";
       return;
     }
     if (data.done) {
-      clearInterval(timer);
       row.el.remove();
       refreshFiles();
+      return;
+    }
+    row.bar.style.width = (data.percent || 0) + "%";
+    if (data.status === "queued") {
+      row.progressLabel.textContent = data.attempts ? `Retrying (attempt ${data.attempts + 1})...` : "Queued...";
+    } else {
+      row.progressLabel.textContent = `Uploading to Telegram... ${formatRate(data.rate)}`;
     }
-  }, 300);
+  });
 }
 
-function uploadSingleFile(file) {
-  const clientId = window.crypto && crypto.randomUUID ? crypto.randomUUID() : String(Date.now() + Math.random());
-  const row = createUploadRow(file);
+// Files go up as resumable sessions: fixed-size chunks, a few at a time,
+// each retried on its own. The session id is remembered per file, so picking
+// the same file again after a reload sends only the missing chunks.
+const UPLOAD_PARALLEL_CHUNKS = 4;
+const CHUNK_RETRY_MAX_DELAY_MS = 30000;
 
-  const form = new FormData();
-  form.append("files", file);
-  form.append("client_id", clientId);
+class UploadHttpError extends Error {
+  constructor(status, message) {
+    super(message);
+    this.status = status;
+  }
+}
 
-  const xhr = new XMLHttpRequest();
-  xhr.open("POST", "/upload", true);
-  xhr.withCredentials = true;
+// Files up to this size are hashed before they are sent, so the server can
+// skip one it already has. crypto.subtle needs the whole file in memory and
+// only exists on secure origins; other files are deduplicated by the server
+// once they are in.
+const CLIENT_HASH_MAX_BYTES = 256 * 1024 * 1024;
+
+async function fileSha256(file) {
+  if (!window.crypto || !crypto.subtle || file.size > CLIENT_HASH_MAX_BYTES) return null;
+  try {
+    const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, "0")).join("");
+  } catch (e) {
+    return null;
+  }
+}
 
-  let lastBytes = 0;
-  let lastTime = performance.now();
+const uploadSessionKey = (file) => `upload:${file.name}:${file.size}:${file.lastModified}`;
+
+async function uploadRequest(url, options = {}) {
+  const res = await apiFetch(url, options);
+  let data = null;
+  try {
+    data = await res.json();
+  } catch (e) {
+    data = null;
+  }
+  if (!res.ok || !data || !data.ok) {
+    throw new UploadHttpError(res.status, (data && data.error) || "Upload failed");
+  }
+  return data;
+}
 
-  xhr.upload.onprogress = (event) => {
-    row.progressLabel.textContent = "Uploading to server...";
-    if (event.lengthComputable) {
-      const percent = Math.min(100, Math.round((event.loaded / event.total) * 100));
-      row.bar.style.width = percent + "%";
+// Network errors and 5xx are retried with backoff, waiting for the browser
+// to come back online; anything else is final.
+async function withRetry(fn, onRetry) {
+  let delay = 1000;
+  for (;;) {
+    try {
+      return await fn();
+    } catch (e) {
+      if (e instanceof UploadHttpError && e.status < 500) throw e;
+      if (onRetry) onRetry(e);
+      if (!navigator.onLine) {
+        await new Promise((resolve) => window.addEventListener("online", resolve, { once: true }));
+      } else {
+        await new Promise((resolve) => setTimeout(resolve, delay));
+      }
+      delay = Math.min(delay * 2, CHUNK_RETRY_MAX_DELAY_MS);
+    }
+  }
+}
+
+async function openUploadSession(file) {
+  const key = uploadSessionKey(file);
+  const saved = localStorage.getItem(key);
+  if (saved) {
+    try {
+      const data = await uploadRequest(`/api/uploads/${saved}`);
+      return { id: saved, chunkSize: data.chunk_size, received: new Set(data.received), resumed: true };
+    } catch (e) {
+      if (!(e instanceof UploadHttpError) || e.status >= 500) throw e;
+      localStorage.removeItem(key);
     }
+  }
+  const sha256 = await fileSha256(file);
+  const data = await uploadRequest("/api/uploads", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(sha256 ? { name: file.name, size: file.size, sha256 } : { name: file.name, size: file.size }),
+  });
+  if (data.deduplicated) return { deduplicated: true, fileId: data.file_id };
+  localStorage.setItem(key, data.upload_id);
+  return { id: data.upload_id, chunkSize: data.chunk_size, received: new Set(), resumed: false };
+}
+
+function putChunk(uploadId, blob, offset, onProgress) {
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+    xhr.open("PUT", `/api/uploads/${uploadId}?offset=${offset}`, true);
+    xhr.withCredentials = true;
+    xhr.setRequestHeader("Content-Type", "application/octet-stream");
+    xhr.upload.onprogress = (event) => onProgress(event.loaded);
+    xhr.onerror = () => reject(new Error("Network error"));
+    xhr.onload = () => {
+      let data = null;
+      try {
+        data = JSON.parse(xhr.responseText);
+      } catch (e) {
+        data = null;
+      }
+      if (xhr.status >= 200 && xhr.status < 300 && data && data.ok) {
+        resolve(data);
+      } else {
+        reject(new UploadHttpError(xhr.status, (data && data.error) || "Upload failed"));
+      }
+    };
+    xhr.send(blob);
+  });
+}
+
+async function uploadSingleFile(file, row) {
+  row.progressLabel.textContent = "Preparing...";
+  const fail = (message) => {
+    showToast(message || "Upload failed", true);
+    row.progress.style.display = "none";
+    row.progressLabel.style.display = "none";
+  };
+
+  let session;
+  try {
+    session = await withRetry(() => openUploadSession(file));
+  } catch (e) {
+    fail(e.message);
+    return;
+  }
+  if (session.deduplicated) {
+    // Already stored: the server added it without any bytes being sent.
+    row.el.remove();
+    refreshFiles();
+    return;
+  }
+
+  const chunkCount = Math.ceil(file.size / session.chunkSize);
+  const chunkBytes = (index) => Math.min(session.chunkSize, file.size - index * session.chunkSize);
+  const inFlight = new Map();
+  let sentBytes = 0;
+  session.received.forEach((index) => {
+    sentBytes += chunkBytes(index);
+  });
+  let lastBytes = sentBytes;
+  let lastTime = performance.now();
+  let rate = 0;
+  let status = session.resumed ? "Resuming upload..." : "Uploading to server...";
+
+  const render = () => {
+    let loaded = sentBytes;
+    inFlight.forEach((value) => {
+      loaded += value;
+    });
     const now = performance.now();
     const elapsed = (now - lastTime) / 1000;
-    if (elapsed >= 0.2) {
-      const rate = (event.loaded - lastBytes) / elapsed;
-      row.progressLabel.textContent = `Uploading to server... ${formatRate(rate)}`;
-      lastBytes = event.loaded;
+    if (elapsed >= 0.5) {
+      rate = Math.max(0, (loaded - lastBytes) / elapsed);
+      lastBytes = loaded;
       lastTime = now;
     }
+    row.bar.style.width = Math.min(100, Math.round((loaded / file.size) * 100)) + "%";
+    row.progressLabel.textContent = `${status} ${formatRate(rate)}`;
   };
+  render();
 
-  xhr.onerror = () => {
-    showToast("Upload failed", true);
-    row.progress.style.display = "none";
-    row.progressLabel.style.display = "none";
+  const pending = [];
+  for (let i = 0; i < chunkCount; i += 1) {
+    if (!session.received.has(i)) pending.push(i);
+  }
+
+  const sendChunk = async (index) => {
+    const offset = index * session.chunkSize;
+    const blob = file.slice(offset, offset + chunkBytes(index));
+    await withRetry(
+      () => putChunk(session.id, blob, offset, (loaded) => {
+        inFlight.set(index, loaded);
+        render();
+      }),
+      () => {
+        inFlight.delete(index);
+        status = "Connection lost, retrying...";
+        render();
+      }
+    );
+    inFlight.delete(index);
+    sentBytes += blob.size;
+    status = "Uploading to server...";
+    render();
   };
 
-  xhr.onload = () => {
-    if (xhr.status < 200 || xhr.status >= 300) {
-      showToast("Upload failed", true);
-      row.progress.style.display = "none";
-      row.progressLabel.style.display = "none";
-      return;
+  const worker = async () => {
+    while (pending.length) {
+      await sendChunk(pending.shift());
     }
-    let data = null;
-    try {
-      data = JSON.parse(xhr.responseText);
-    } catch (e) {
-      showToast("Upload failed", true);
-      row.progress.style.display = "none";
-      row.progressLabel.style.display = "none";
-      return;
-    }
-    if (!data.ok || !data.tasks || !data.tasks.length) {
-      showToast(data && data.error ? data.error : "Upload failed", true);
-      row.progress.style.display = "none";
-      row.progressLabel.style.display = "none";
-      return;
-    }
-    row.progressLabel.textContent = "Processing...";
-    pollTelegramUpload(data.tasks[0].task_id, row, file.size);
   };
 
-  xhr.send(form);
+  try {
+    await Promise.all(Array.from({ length: Math.min(UPLOAD_PARALLEL_CHUNKS, pending.length) }, worker));
+    const done = await withRetry(() => uploadRequest(`/api/uploads/${session.id}/finish`, { method: "POST" }));
+    localStorage.removeItem(uploadSessionKey(file));
+    row.progressLabel.textContent = "Processing...";
+    watchTelegramUpload(done.task_id, row);
+  } catch (e) {
+    if (e instanceof UploadHttpError && (e.status === 404 || e.status === 410)) {
+      localStorage.removeItem(uploadSessionKey(file));
+    }
+    fail(e.message);
+  }
 }
 
 function formatBytes(value) {
@@ -359,12 +593,31 @@ function formatRate(bytesPerSecond) {
   return `${value.toFixed(1)} ${units[unit]}`;
 }
 
-async function uploadFiles(files) {
+// Files are sent this many at a time. The others wait in the page with
+// no session and unhashed, so dropping many files at once neither holds
+// them all in memory nor ties up the server with idle sessions.
+const UPLOAD_PARALLEL_FILES = 2;
+const uploadQueue = [];
+let uploadsRunning = 0;
+
+function startQueuedUploads() {
+  while (uploadsRunning < UPLOAD_PARALLEL_FILES && uploadQueue.length) {
+    const { file, row } = uploadQueue.shift();
+    uploadsRunning += 1;
+    uploadSingleFile(file, row).finally(() => {
+      uploadsRunning -= 1;
+      startQueuedUploads();
+    });
+  }
+}
+
+function uploadFiles(files) {
   for (const f of files) {
     if (f.size > 0) {
-      uploadSingleFile(f);
+      uploadQueue.push({ file: f, row: createUploadRow(f) });
     }
   }
+  startQueuedUploads();
 }
 
 dropzone.addEventListener("dragover", (e) => {
@@ -404,9 +657,11 @@ sortBar.addEventListener("click", (e) => {
   refreshFiles();
 });
 
+let searchTimer = null;
 searchInput.addEventListener("input", (e) => {
   currentQuery = e.target.value || "";
-  renderFiles();
+  clearTimeout(searchTimer);
+  searchTimer = setTimeout(refreshFiles, 250);
 });
 
 refreshFiles();
@@ -0,0 +1,75 @@
+import io
+import time
+
+import dotenv
+import pytest
+
+# Keep a developer's .env out of the tests, as bench/run.py does.
+dotenv.load_dotenv = lambda *a, **k: False
+
+from bench.fake_telegram import FakeSenderPool, FakeTelegramClient
+from Telegram import teleBot
+from Telegram.web.app import create_app
+
+PASSKEY = "test"
+
+
+@pytest.fixture
+def make_client(tmp_path, monkeypatch):
+    """
+    Builds TelegramFileClients on one fake Telegram channel, with their
+    download cache under ``tmp_path``.
+    """
+    monkeypatch.delenv("ENCRYPTION_KEY", raising=False)
+    monkeypatch.setattr(teleBot, "CACHE_DIR", str(tmp_path / "cache"))
+    fake = FakeTelegramClient(str(tmp_path / "telegram"), latency=0.001, bandwidth=500e6)
+
+    def make(cache_max_bytes=0, encryption_key=None):
+        if encryption_key is None:
+            monkeypatch.delenv("ENCRYPTION_KEY", raising=False)
+        else:
+            monkeypatch.setenv("ENCRYPTION_KEY", encryption_key)
+        monkeypatch.setattr(teleBot, "CACHE_MAXSIZE", cache_max_bytes)
+        return teleBot.TelegramFileClient(None, None, None, "test", client=fake, pool_factory=FakeSenderPool)
+
+    return make
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch, make_client):
+    """
+    Builds the web app around a client from make_client; returns the client
+    and a logged-in Flask test client.
+    """
+    monkeypatch.setenv("PASSKEY", PASSKEY)
+    monkeypatch.setenv("WEB_DB_PATH", str(tmp_path / "web.db"))
+    monkeypatch.setenv("UPLOAD_SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setenv("SYNC_INTERVAL_SECONDS", "0")
+    monkeypatch.setenv("PREFETCH_MAX_BYTES", "0")
+
+    def make(**kwargs):
+        client = make_client(**kwargs)
+        http = create_app(client).test_client()
+        http.post("/login", data={"passkey": PASSKEY})
+        return client, http
+
+    return make
+
+
+@pytest.fixture
+def upload():
+    """Uploads ``data`` through /upload and returns the file id once it is in Telegram."""
+
+    def upload(http, name, data):
+        resp = http.post("/upload", data={"files": (io.BytesIO(data), name)}, content_type="multipart/form-data")
+        task_id = resp.get_json()["tasks"][0]["task_id"]
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            info = http.get(f"/api/progress/{task_id}").get_json()
+            if info["done"]:
+                assert info["status"] == "done", info
+                return info["file_id"]
+            time.sleep(0.02)
+        raise TimeoutError(f"Upload of {name} didn't finish")
+
+    return upload
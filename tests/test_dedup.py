@@ -0,0 +1,35 @@
+import hashlib
+import os
+
+import pytest
+
+from Telegram.crypto import CIPHER_AESGCM, CIPHER_NONE
+from Telegram.web.storage import WebStore
+
+KEY = "k" * 32
+
+
+@pytest.mark.parametrize("stored_key, upload_key", [(None, KEY), (KEY, None)])
+def test_upload_is_not_deduplicated_onto_another_cipher(tmp_path, make_client, make_app, upload, stored_key, upload_key):
+    data = os.urandom(1024 * 1024)
+    earlier = make_client(encryption_key=stored_key)
+    docs = earlier.upload_file(data, "earlier.bin")
+    store = WebStore(str(tmp_path / "web.db"))
+    earlier_id = store.add_file(
+        "earlier.bin",
+        [doc.msg_id for doc in docs],
+        len(data),
+        cipher=earlier.upload_cipher,
+        content_hash=hashlib.sha256(data).hexdigest(),
+    )
+
+    client, http = make_app(encryption_key=upload_key)
+    file_id = upload(http, "again.bin", data)
+    row = store.get_file(file_id)
+    assert row["cipher"] == (CIPHER_NONE if upload_key is None else CIPHER_AESGCM)
+    assert row["msg_ids"] != store.get_file(earlier_id)["msg_ids"]
+    assert http.get(f"/download/{file_id}").data == data
+
+    # The same content under the same cipher is still stored once.
+    again_id = upload(http, "third.bin", data)
+    assert store.get_file(again_id)["msg_ids"] == row["msg_ids"]
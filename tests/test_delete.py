@@ -0,0 +1,28 @@
+import os
+import time
+
+import pytest
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_deleted_file_leaves_the_cache(make_app, upload, bulk):
+    client, http = make_app(cache_max_bytes=100 * 1024 * 1024, encryption_key="x" * 32)
+    data = os.urandom(3 * 1024 * 1024)
+    file_id = upload(http, "secret.bin", data)
+    assert http.get(f"/download/{file_id}").data == data
+    # The fetch commits to the cache right after the last byte went out.
+    deadline = time.monotonic() + 5
+    while file_id not in client.cached_files and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert file_id in client.cached_files
+    path = client.cached_files._path(file_id)
+    assert path.exists()
+
+    if bulk:
+        resp = http.post("/api/files/delete", json={"ids": [file_id]})
+    else:
+        resp = http.post(f"/delete/{file_id}")
+    assert resp.get_json()["ok"]
+    assert file_id not in client.cached_files
+    assert client.cached_files.get(file_id) is None
+    assert not path.exists()
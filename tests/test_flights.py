@@ -0,0 +1,39 @@
+import os
+import threading
+import time
+
+import pytest
+
+from Telegram import teleBot
+from Telegram.compression import CODEC_NONE, CODEC_ZLIB
+
+
+@pytest.mark.parametrize("codec", [CODEC_NONE, CODEC_ZLIB])
+def test_paused_reader_does_not_hold_back_a_shared_download(make_client, monkeypatch, codec):
+    monkeypatch.setattr(teleBot, "FLIGHT_BUFFER_BYTES", 2 * 1024 * 1024)
+    monkeypatch.setattr(teleBot, "FLIGHT_STALL_SECONDS", 0.5)
+    client = make_client(cache_max_bytes=1024 * 1024)
+    data = os.urandom(1024) * 20 * 1024
+    msg_ids = [doc.msg_id for doc in client.upload_file(data, "f.bin", codec=codec)]
+    dropped = teleBot.DOWNLOAD_FLIGHTS.values.get(("dropped",), 0)
+
+    # The fetch is held until both readers are in, so they share it.
+    gate = threading.Event()
+    paused = client.iter_file(1, msg_ids, total_size=len(data), codec=codec, progress_cb=lambda *a: gate.wait())
+    head = []
+    threading.Thread(target=lambda: head.append(next(paused))).start()
+    got = []
+    reader = threading.Thread(
+        target=lambda: got.append(b"".join(client.iter_file(1, msg_ids, total_size=len(data), codec=codec)))
+    )
+    reader.start()
+    while not client._flights or client._flights[1].users < 2:
+        time.sleep(0.01)
+    gate.set()
+
+    reader.join(timeout=10)
+    assert not reader.is_alive()
+    assert got == [data]
+    assert teleBot.DOWNLOAD_FLIGHTS.values.get(("dropped",), 0) == dropped + 1
+    # Let go of by the shared fetch, the paused reader fetches the rest itself.
+    assert head[0] + b"".join(paused) == data